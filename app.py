@@ -1,63 +1,394 @@
 #!/usr/bin/env python3
 from http.server import HTTPServer, BaseHTTPRequestHandler
-import os
-from pathlib import Path
-from fim import Epigram, EpigramStore, SoloEpigramImporter, \
-    FortuneFileImporter, Bucket, Impression
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import json
+import queue
+import signal
+import threading
+import fim
+from fim import FastEpigramStore, default_db_path, log
 
 
-CONTAINER_PATH = "/var/fim/fim.db"
-HOME_DIR = str(Path.home())+"/.fim/fim.db"
+class LRUCache():
+    """ A thread safe mapping that forgets the least recently used entries
 
-def get_db():
-    if os.path.exists(CONTAINER_PATH):
-        # this is a container with a mounted fim dir
-        db = EpigramStore(CONTAINER_PATH)
-    elif os.path.exists(HOME_DIR):
-        db = EpigramStore(HOME_DIR)
-    else:
-        # This means we are running inside of the container
-        db = EpigramStore("/app/fim.db", force_random=True)
-    return db
+    Keyword Arguments:
+    - maxsize (int) - the number of entries kept
+    """
+
+    def __init__(self, maxsize=256):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+
+class PooledHTTPServer(HTTPServer):
+    """ An HTTPServer that handles connections on a fixed pool of worker threads.
+
+        Every worker opens its own FastEpigramStore the first time it needs one
+        (sqlite3 connections can't cross threads), so a slow commit only holds up
+        the request that made it.  When all the workers are busy, accepted
+        connections wait in a bounded queue and then in the listen backlog.
+
+        shutdown() stops accepting; server_close() lets the queued and in-flight
+        requests finish, then closes each worker's store.
+
+        The read only API responses are shared by the workers in an LRUCache,
+        keyed by the store generation they were built at.
+
+        With engine="memory" the epigrams are selected by one shared
+        fim_engine.MemoryEpigramStore (which needs numpy) instead of SQL queries on
+        the workers' stores, and impressions are written in the background.  The
+        responses then have no impression_id.
+
+    Positional Arguments:
+    - server_address (tuple) - the (host, port) to bind
+    - handler_class (class) - a BaseHTTPRequestHandler subclass
+
+    Keyword Arguments:
+    - db_path (str) - the database every worker connects to
+    - workers (int) - the number of worker threads
+    - cache_size (int) - the number of responses cached
+    - engine (str) - how epigrams are selected, one of ENGINES
+    """
+    WORKERS = 8
+    CACHE_SIZE = 256
+    # accepted connections waiting for a free worker
+    QUEUE_SIZE = 64
+    ENGINES = ("sqlite", "memory")
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, db_path=None,
+                 workers=WORKERS, cache_size=CACHE_SIZE, engine="sqlite"):
+        if engine not in self.ENGINES:
+            raise ValueError(f"engine must be one of {', '.join(self.ENGINES)}")
+        self.db_path = db_path or default_db_path()
+        # migrate once here, rather than racing the workers to it
+        FastEpigramStore(self.db_path).close()
+        self.engine = None
+        if engine == "memory":
+            from fim_engine import MemoryEpigramStore
+            self.engine = MemoryEpigramStore(self.db_path)
+        super().__init__(server_address, handler_class)
+        self.shutting_down = threading.Event()
+        self.cache = LRUCache(cache_size)
+        self._local = threading.local()
+        self._connections = queue.Queue(self.QUEUE_SIZE)
+        self._workers = [threading.Thread(target=self._work, daemon=True,
+                                          name=f"fim-http-{n}")
+                         for n in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def get_db(self):
+        """ The store owned by the calling worker thread """
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = FastEpigramStore(self.db_path)
+        return db
+
+    def get_selector(self):
+        """ The store that selects epigrams and records impressions: the shared memory
+            engine, or the calling worker's own store """
+        return self.engine if self.engine is not None else self.get_db()
+
+    def process_request(self, request, client_address):
+        self._connections.put((request, client_address))
+
+    def _work(self):
+        while (item := self._connections.get()) is not None:
+            (request, client_address) = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+
+    def shutdown(self):
+        self.shutting_down.set()
+        super().shutdown()
+
+    def server_close(self):
+        super().server_close()
+        # the sentinels queue up behind any connections still waiting
+        for _ in self._workers:
+            self._connections.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self.engine is not None:
+            self.engine.close()
 
-globalDB = get_db()
 
 class S(BaseHTTPRequestHandler):
-    def _set_headers(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
+    """ Any path outside /api/ answers with the text of one epigram.  The JSON API:
+
+        GET|POST /api/epigram?count=N&bucket=NAME&max_length=N
+            select N epigrams (default 1), recording their impressions in one
+            transaction
+        GET /api/impressions?bucket=NAME
+
+        and the read only resources, which only change when the store generation
+        does.  They carry an ETag and Last-Modified and answer If-None-Match and
+        If-Modified-Since with a 304:
+
+        GET /api/buckets
+        GET /api/stats
+        GET /api/epigrams/UUID
+        GET /api/search?q=WORDS&limit=N&offset=N&bucket=NAME
+
+        POST /api/epigrams/UUID shows that epigram, e.g. a search result, recording
+        the impression
+    """
+    # keep-alive, with every response carrying a Content-Length
+    protocol_version = "HTTP/1.1"
+    # seconds an idle keep-alive connection may hold a worker
+    timeout = 5
+    # headers and body go out in separate writes
+    disable_nagle_algorithm = True
+    # the most epigrams one /api/epigram request may select
+    MAX_COUNT = 100
+    # the largest /api/search page
+    MAX_LIMIT = 100
+
+    def _set_headers(self, length=None, status=200, content_type="text/html; charset=utf-8", headers=()):
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        for (name, value) in headers:
+            self.send_header(name, value)
+        if length is not None:
+            self.send_header("Content-Length", str(length))
+        if self.server.shutting_down.is_set():
+            self.send_header("Connection", "close")
+            self.close_connection = True
         self.end_headers()
 
     def _html(self, message):
         """This just generates an HTML document that includes `message`
         in the body. Override, or re-write this do do more interesting stuff.
         """
-        content =  globalDB.get_epigram_impression().epigram.content
+        content = self.server.get_selector().get_epigram_impression().epigram.content
         #content = f"<html><body><h1>{message}</h1></body></html>"
         return content.encode("utf8")  # NOTE: must return a bytes object!
 
+    def _send(self, body, **kwargs):
+        self._set_headers(len(body), **kwargs)
+        self.wfile.write(body)
+
+    def _json(self, obj, status=200):
+        self._send(json.dumps(obj).encode("utf8"), status=status, content_type="application/json")
+
+    def _cached(self, path, resource):
+        """ Answer with the cached resource, or a 304 if the client's copy is current.
+            resource(db) builds the response and raises KeyError for a 404 or
+            ValueError for a 400
+        """
+        db = self.server.get_db()
+        # read before the resource, so a response is never older than its ETag
+        (generation, modified) = db.get_generation()
+        headers = [("ETag", f'"{generation}"'),
+                   ("Last-Modified", formatdate(modified, usegmt=True)),
+                   # proxies may store it, but must revalidate
+                   ("Cache-Control", "no-cache")]
+
+        if self._not_modified(generation, modified):
+            return self._set_headers(status=304, content_type="application/json", headers=headers)
+
+        # the query string is part of the resource
+        key = (generation, self.path)
+        body = self.server.cache.get(key)
+        if body is None:
+            try:
+                body = json.dumps(resource(db)).encode("utf8")
+            except KeyError:
+                return self._json({"error": f"{path} not found"}, status=404)
+            except ValueError as e:
+                return self._json({"error": str(e)}, status=400)
+            self.server.cache.put(key, body)
+        self._send(body, content_type="application/json", headers=headers)
+
+    def _not_modified(self, generation, modified):
+        etags = self.headers.get("If-None-Match")
+        if etags is not None:
+            return etags.strip() == "*" or f'"{generation}"' in [t.strip() for t in etags.split(",")]
+
+        since = self.headers.get("If-Modified-Since")
+        if since is not None:
+            try:
+                return modified <= parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _route(self, default):
+        url = urlsplit(self.path)
+        (path, query) = (url.path, parse_qs(url.query))
+        if not path.startswith("/api/"):
+            return self._send(default())
+
+        params = {name: values[-1] for (name, values) in query.items()}
+        cached = {"/api/buckets": self._api_buckets,
+                  "/api/stats": self._api_stats,
+                  "/api/search": lambda db: self._api_search(db, params)}
+        routes = {"/api/epigram": self._api_epigram,
+                  "/api/impressions": self._api_impressions}
+        if path.startswith("/api/epigrams/"):
+            epigram_uuid = path[len("/api/epigrams/"):]
+            cached[path] = lambda db: self._api_epigram_lookup(db, epigram_uuid)
+            routes[path] = lambda params: self._api_show_epigram(epigram_uuid)
+
+        if path not in routes and path not in cached:
+            return self._json({"error": f"no such endpoint {path}"}, status=404)
+        if self.command == "GET" and path in cached:
+            return self._cached(path, cached[path])
+        if path not in routes or self.command == "POST" and path == "/api/impressions":
+            return self._json({"error": f"{path} is read only"}, status=405)
+
+        try:
+            self._json(routes[path](params))
+        except KeyError:
+            self._json({"error": f"{path} not found"}, status=404)
+        except ValueError as e:
+            self._json({"error": str(e)}, status=400)
+
+    def _int_param(self, params, name, default):
+        try:
+            return int(params.get(name, default))
+        except ValueError:
+            raise ValueError(f"{name} must be an integer") from None
+
+    def _api_epigram(self, params):
+        count = self._int_param(params, "count", 1)
+        if not 1 <= count <= self.MAX_COUNT:
+            raise ValueError(f"count must be between 1 and {self.MAX_COUNT}")
+
+        imps = self.server.get_selector().get_epigram_impressions(
+            count, bucket_name=params.get("bucket"),
+            max_length=self._int_param(params, "max_length", fim.MAX_CONTENT_LENGTH))
+        return {"epigrams": [{"epigram_uuid": imp.epigram_uuid,
+                              "bucket_id": imp.bucket_id,
+                              "content": imp.epigram.content,
+                              "impression_id": imp.impression_id,
+                              "impression_date": imp.impression_date} for imp in imps]}
+
+    def _api_buckets(self, db):
+        return {"buckets": [b._asdict() for b in db.get_buckets()]}
+
+    def _api_stats(self, db):
+        stats = {bucket_id: (epigram_count, weighted_count)
+                 for (bucket_id, epigram_count, weighted_count, impression_count) in db.get_bucket_stats()}
+        buckets = []
+        for b in db.get_buckets():
+            (epigram_count, weighted_count) = stats.get(b.bucket_id, (0, 0))
+            buckets.append(dict(b._asdict(), epigram_count=epigram_count, weighted_count=weighted_count))
+        # impression counts move with every request, they are in /api/impressions
+        return {"buckets": buckets}
+
+    def _api_epigram_lookup(self, db, epigram_uuid):
+        x = db.get_epigram(epigram_uuid)
+        if x is None:
+            raise KeyError(epigram_uuid)
+        return {"epigram_uuid": x.epigram_uuid, "bucket_id": x.bucket_id,
+                "content": x.content, "content_length": x.content_length}
+
+    def _api_show_epigram(self, epigram_uuid):
+        imp = self.server.get_selector().show_epigram(epigram_uuid)
+        if imp is None:
+            raise KeyError(epigram_uuid)
+        return {"epigram_uuid": imp.epigram_uuid, "bucket_id": imp.bucket_id, "content": imp.epigram.content,
+                "impression_id": imp.impression_id, "impression_date": imp.impression_date}
+
+    def _api_search(self, db, params):
+        query = params.get("q", "")
+        limit = self._int_param(params, "limit", 10)
+        offset = self._int_param(params, "offset", 0)
+        if not 1 <= limit <= self.MAX_LIMIT or offset < 0:
+            raise ValueError(f"limit must be between 1 and {self.MAX_LIMIT} and offset positive")
+
+        bucket_name = params.get("bucket")
+        return {"query": query,
+                "total": db.count_matches(query, bucket_name=bucket_name),
+                "results": [{"epigram_uuid": r.epigram.epigram_uuid, "bucket": r.bucket_name,
+                             "content": r.epigram.content, "snippet": r.snippet, "rank": r.rank}
+                            for r in db.search(query, limit=limit, offset=offset, bucket_name=bucket_name)]}
+
+    def _api_impressions(self, params):
+        bucket_name = params.get("bucket")
+        return {"bucket": bucket_name,
+                "impression_count": self.server.get_selector().get_impression_count(bucket_name)}
+
     def do_GET(self):
-        self._set_headers()
-        self.wfile.write(self._html("hi!"))
+        self._route(lambda: self._html("hi!"))
 
     def do_HEAD(self):
         self._set_headers()
 
     def do_POST(self):
-        self._set_headers()
-        self.wfile.write(self._html("POST!"))
+        # drain the body so the next request on this connection parses
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self._route(lambda: self._html("POST!"))
 
+    def log_message(self, format, *args):
+        log.debug("%s - " + format, self.address_string(), *args)
 
-def run(server_class=HTTPServer, handler_class=S, addr="localhost", port=8000):
+
+def run(server_class=PooledHTTPServer, handler_class=S, addr="localhost",
+        port=8000, workers=PooledHTTPServer.WORKERS, db_path=None, engine="sqlite"):
     server_address = (addr, port)
-    httpd = server_class(server_address, handler_class)
+    httpd = server_class(server_address, handler_class, db_path=db_path,
+                         workers=workers, engine=engine)
+
+    def stop(signum, frame):
+        # shutdown() waits on serve_forever, so it can't run on this thread
+        threading.Thread(target=httpd.shutdown).start()
+
+    # docker stop sends SIGTERM
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
 
-    print(f"Starting httpd server on {addr}:{port}")
+    print(f"Starting httpd server on {addr}:{port} with {workers} workers and the {engine} engine")
     httpd.serve_forever()
+    httpd.server_close()
+    print("Stopped httpd server")
 
 
 if __name__ == "__main__":
-    run(addr="0.0.0.0", port=8080)
+    parser = argparse.ArgumentParser(description="Serve epigrams over HTTP")
+    parser.add_argument("--addr", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int,
+                        default=PooledHTTPServer.WORKERS)
+    parser.add_argument("--db", help="defaults to the fim database")
+    parser.add_argument("--engine", choices=PooledHTTPServer.ENGINES, default="sqlite",
+                        help="memory keeps BucketSort in NumPy arrays and writes impressions "
+                             "in the background, it needs numpy")
+    args = parser.parse_args()
+    run(addr=args.addr, port=args.port, workers=args.workers,
+        db_path=args.db, engine=args.engine)
 
 
 """
@@ -0,0 +1,843 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Benchmarks for fim - fortune improved
+
+    These are not unit tests, they build synthetic corpora and print timings.  With
+    --json the results are also written to a file, and compare lines two of those up
+    so runs can be compared across commits (make bench runs the suite).
+
+    python bench_fim.py --json before.json suite --quick
+    python bench_fim.py compare before.json after.json --threshold 0.1
+    python bench_fim.py --lengths fortune --history 2 corpus /tmp/fim.db --size 13000
+    python bench_fim.py selection --sizes 1000,13000,1000000
+    python bench_fim.py impressions --size 13000
+    python bench_fim.py parse --sizes 1,8,32
+    python bench_fim.py import --files 16 --megabytes 4 --workers 1,2,4,8 --min-per-s 5000
+    python bench_fim.py startup --max-ms 100
+    python bench_fim.py concurrency --processes 1,4,8 --selections 200
+    python bench_fim.py http --workers 1,8 --clients 8 --requests 100
+    python bench_fim.py search --sizes 13000,100000,1000000
+    python bench_fim.py dedupe --sizes 13000,100000,1000000
+    python bench_fim.py engine --sizes 13000,100000,1000000 --selections 20000
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fim
+import fim_core
+from fim import FastEpigramStore, ImpressionJournal, log
+from fim_core import content_hash, generate_uuid, read_fortune_file
+from fim_store import EpigramStore, Epigram, FortuneFileImporter
+
+BENCH_DIR = tempfile.gettempdir()
+# content lengths as (weight, shortest, longest) ranges.  fortune is roughly the legacy
+# files: mostly one liners, some paragraphs and a tail over MAX_CONTENT_LENGTH
+LENGTHS = {
+    "uniform": [(1, 20, 200)],
+    "fortune": [(50, 20, 80), (40, 80, 300), (10, 300, 1500)],
+}
+# the slowest bulk import the suite accepts, in epigrams per second
+IMPORT_PER_SECOND = 5000
+# every result recorded by the benchmarks, written out by --json
+RESULTS = []
+
+
+def build_corpus(db_path, epigrams, buckets=20, seed=42, vocabulary=None, lengths="uniform", history=0):
+    """ Create a fresh store at db_path holding `epigrams` random epigrams
+        spread evenly over `buckets` buckets.  With a vocabulary the content is
+        made of its words, Zipf distributed, otherwise it is random letters.
+
+        Keyword Arguments:
+        lengths (str) - the content length distribution, a key of LENGTHS
+        history (float) - impressions to record per epigram, spread over the last
+                          30 days, so selections see a store that has been in use
+    """
+    remove_db(db_path)
+
+    # let the store create the schema, views, triggers and indexes
+    EpigramStore(db_path).close()
+
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany("insert into bucket (bucket_id, name, item_weight) values (?, ?, 1)",
+                         [(b + 1, f"bucket_{b}") for b in range(buckets)])
+
+    alphabet = string.ascii_letters + "      "
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)] if vocabulary else None
+    ranges = LENGTHS[lengths]
+    batch = []
+    for n in range(epigrams):
+        (weight, shortest, longest) = rng.choices(ranges, [r[0] for r in ranges])[0]
+        length = rng.randint(shortest, longest)
+        if vocabulary:
+            content = ' '.join(rng.choices(vocabulary, weights, k=max(4, length // 5)))
+        else:
+            content = ''.join(rng.choices(alphabet, k=length))
+        batch.append((generate_uuid(), n % buckets + 1, content))
+        if len(batch) == 10000:
+            _insert_epigrams(conn, batch)
+            batch = []
+    _insert_epigrams(conn, batch)
+    uuids = conn.execute("select epigram_uuid, bucket_id from epigram").fetchall()
+    conn.close()
+
+    if history and uuids:
+        _record_history(db_path, uuids, int(epigrams * history), rng)
+
+
+def _record_history(db_path, uuids, impressions, rng):
+    """ Impressions of random epigrams, oldest first, the way the stores write them """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    start = datetime.datetime.now() - datetime.timedelta(days=30)
+    step = datetime.timedelta(days=30) / impressions
+    entries = []
+    for n in range(impressions):
+        (epigram_uuid, bucket_id) = rng.choice(uuids)
+        entries.append((epigram_uuid, bucket_id, str(start + step * n)))
+        if len(entries) == 10000:
+            fim.write_impressions(conn, entries, bump_generation=False)
+            entries = []
+    if entries:
+        fim.write_impressions(conn, entries, bump_generation=False)
+    conn.close()
+
+
+def remove_db(db_path):
+    for suffix in ("", "-wal", "-shm", ImpressionJournal.SUFFIX):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+
+def _insert_epigrams(conn, rows):
+    """ Insert (epigram_uuid, bucket_id, content) rows hashed like the importer does, so
+        content that is already in the store is skipped """
+    with conn:
+        conn.executemany("insert or ignore into epigram (epigram_uuid, bucket_id, content, content_hash) "
+                         "values (?, ?, ?, ?)", [(u, b, c, content_hash(c)) for (u, b, c) in rows])
+
+
+def _legacy_offset_select(conn, bucket_id, internal_fetch_ratio=0.1):
+    """ The selection query used before keyset sampling: count, then OFFSET into the sort """
+    where = "from epigram where bucket_id = ? and length(content) < 300"
+    count = conn.execute("select count(1) " + where, (bucket_id,)).fetchone()[0]
+    offset = int(count * internal_fetch_ratio * random.random())
+    return conn.execute("select epigram_uuid " + where +
+                        " order by last_impression_date limit 1 offset ?",
+                        (bucket_id, offset)).fetchone()
+
+
+def _timed(fn, iterations):
+    samples = []
+    for x in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def record(benchmark, label, size=None, **metrics):
+    """ Keep a result for --json.  Metrics ending in _per_s are better higher, ones
+        ending in _ms or _s are better lower and compare only reports the rest """
+    RESULTS.append(dict(benchmark=benchmark, label=label, size=size, **metrics))
+
+
+def _report(label, size, samples, benchmark="selection"):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{label:<18} {size:>9} epigrams  "
+          f"median {statistics.median(samples) * 1000:8.3f} ms  "
+          f"p95 {p95 * 1000:8.3f} ms")
+    record(benchmark, label, size, median_ms=statistics.median(samples) * 1000, p95_ms=p95 * 1000)
+
+
+def bench_selection(sizes, iterations, corpus=None):
+    """ Selection latency for the legacy OFFSET query, the keyset sampler and the
+        full get_epigram_impression call (including the impression commit), through
+        the ORM and through the sqlite3 fast path.  corpus holds build_corpus options """
+    for size in sizes:
+        db_path = os.path.join(BENCH_DIR, f"fim_bench_selection_{size}.db")
+        start = time.perf_counter()
+        build_corpus(db_path, size, **(corpus or {}))
+        print(f"built {size} epigrams in {time.perf_counter() - start:.1f}s")
+        record("selection", "build", size, build_s=time.perf_counter() - start)
+
+        db = EpigramStore(db_path)
+        bucket_ids = [b.bucket_id for b in db.get_buckets()]
+
+        # show a slice of the corpus so both the unseen and seen paths are exercised
+        for x in range(iterations):
+            db.get_epigram_impression()
+
+        conn = sqlite3.connect(db_path)
+        _report("offset", size, _timed(
+            lambda: _legacy_offset_select(conn, random.choice(bucket_ids)), iterations))
+        conn.close()
+
+        def keyset():
+            q = db._session.query(Epigram).filter(Epigram.bucket_id == random.choice(bucket_ids))
+            db._select_epigram(q, 0.1, True)
+
+        _report("keyset", size, _timed(keyset, iterations))
+        _report("impression", size, _timed(db.get_epigram_impression, iterations))
+
+        fast = FastEpigramStore(db_path)
+        _report("fast impression", size, _timed(fast.get_epigram_impression, iterations))
+        fast.close()
+
+        queued = FastEpigramStore(db_path, queue_size=FastEpigramStore.QUEUE_SIZE)
+        _report("queued impression", size, _timed(queued.get_epigram_impression, iterations))
+        queued.close()
+
+        journaled = FastEpigramStore(db_path, journal=True)
+        _report("journaled", size, _timed(journaled.get_epigram_impression, iterations))
+        journaled.compact()
+        journaled.close()
+
+        db.close()
+        remove_db(db_path)
+
+
+def bench_impressions(size, iterations, corpus=None):
+    """ What recording an impression costs once the epigram is chosen: an ORM commit,
+        a sqlite3 commit, a journal append (and its compaction) and write_impressions
+        batches, which the memory engine and compaction use """
+    db_path = os.path.join(BENCH_DIR, "fim_bench_impressions.db")
+    build_corpus(db_path, size, **(corpus or {}))
+
+    db = EpigramStore(db_path)
+    epigrams = db._session.query(Epigram).limit(iterations).all()
+    shown = [(e.epigram_uuid, e.bucket_id) for e in epigrams]
+    uuids = [epigram_uuid for (epigram_uuid, bucket_id) in shown]
+    _report("orm commit", size, _timed(lambda: db.add_impression(epigrams.pop()), iterations), "impressions")
+    db.close()
+
+    fast = FastEpigramStore(db_path)
+    picks = list(uuids)
+    _report("fast commit", size, _timed(lambda: fast.show_epigram(picks.pop()), iterations), "impressions")
+    fast.close()
+
+    journaled = FastEpigramStore(db_path, journal=True)
+    picks = list(uuids)
+    _report("journal append", size, _timed(lambda: journaled.show_epigram(picks.pop()), iterations),
+            "impressions")
+    start = time.perf_counter()
+    compacted = journaled.compact()
+    _per_impression("journal compact", size, time.perf_counter() - start, compacted)
+    journaled.close()
+
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    now = str(datetime.datetime.now())
+    for batch in (10, 1000):
+        entries = [shown[n % len(shown)] + (now, ) for n in range(batch)]
+        start = time.perf_counter()
+        fim.write_impressions(conn, entries)
+        _per_impression(f"batch of {batch}", size, time.perf_counter() - start, batch)
+    conn.close()
+
+    remove_db(db_path)
+
+
+def _per_impression(label, size, elapsed, count):
+    print(f"{label:<18} {size:>9} epigrams  {elapsed / count * 1000:8.3f} ms per impression")
+    record("impressions", label, size, per_impression_ms=elapsed / count * 1000)
+
+
+def build_fortune_file(path, megabytes, seed=42):
+    """ Write a fortune file of roughly `megabytes` MB with a mix of one liners
+        and long multi-line entries """
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + "      "
+    target = megabytes * 1024 * 1024
+    written = 0
+    with open(path, "w") as f:
+        while written < target:
+            lines = [''.join(rng.choices(alphabet, k=rng.randint(10, 72)))
+                     for x in range(rng.choice([1, 1, 2, 4, 40]))]
+            entry = "\n".join(lines) + "\n%\n"
+            f.write(entry)
+            written += len(entry)
+
+
+def _line_by_line_parse(path):
+    """ The parser used before the streaming one: read, split, regex and concatenate """
+    import re
+    delimiter = re.compile(r'^%$')
+    with open(path, 'r') as fortune_file:
+        e = ''
+        for f in fortune_file.read().split("\n"):
+            if re.search(delimiter, f):
+                yield e.rstrip()
+                e = ""
+            else:
+                e += f + "\n"
+
+
+def bench_parse(sizes, iterations):
+    """ Throughput of the line by line parser against the mmap scanner """
+    for size in sizes:
+        path = os.path.join(BENCH_DIR, f"fim_bench_parse_{size}mb.txt")
+        build_fortune_file(path, size)
+        megabytes = os.path.getsize(path) / 1024 / 1024
+
+        for (label, parse) in [("line-by-line", _line_by_line_parse),
+                               ("mmap", lambda p: (text for (o, l, text) in read_fortune_file(p)))]:
+            samples = _timed(lambda: sum(1 for x in parse(path)), iterations)
+            print(f"{label:<16} {megabytes:>7.1f} MB  "
+                  f"median {statistics.median(samples) * 1000:9.1f} ms  "
+                  f"{megabytes / statistics.median(samples):8.1f} MB/s")
+            record("parse", label, size, median_ms=statistics.median(samples) * 1000,
+                   mb_per_s=megabytes / statistics.median(samples))
+
+        os.remove(path)
+
+
+def bench_import(files, megabytes, workers, min_per_s=0):
+    """ Wall clock of a bulk import of `files` fortune files against the number of
+        parse workers, both parse only and all the way into the database
+
+        Return:
+        False if an import was slower than min_per_s epigrams per second
+    """
+    corpus = os.path.join(BENCH_DIR, "fim_bench_import")
+    shutil.rmtree(corpus, ignore_errors=True)
+    os.makedirs(corpus)
+    for n in range(files):
+        build_fortune_file(os.path.join(corpus, f"bucket_{n:03}"), megabytes, seed=n)
+
+    db_path = os.path.join(BENCH_DIR, "fim_bench_import.db")
+    baseline = {}
+    fast_enough = True
+    for count in workers:
+        start = time.perf_counter()
+        entries = sum(1 for x in FortuneFileImporter(corpus, workers=count).process_content())
+        parsed = time.perf_counter() - start
+
+        remove_db(db_path)
+        db = EpigramStore(db_path)
+        start = time.perf_counter()
+        db.bulk_add_epigrams_via_importer(FortuneFileImporter(corpus, workers=count))
+        imported = time.perf_counter() - start
+        db.close()
+
+        baseline.setdefault("parse", parsed)
+        baseline.setdefault("import", imported)
+        print(f"{count:>2} workers  {entries} epigrams  "
+              f"parse {parsed:7.2f}s ({baseline['parse'] / parsed:4.2f}x)  "
+              f"import {imported:7.2f}s ({baseline['import'] / imported:4.2f}x)")
+        record("import", f"{count} workers", entries, parse_s=parsed, import_s=imported,
+               epigrams_per_s=entries / imported)
+        if entries / imported < min_per_s:
+            print(f"FAIL: the import with {count} workers did {entries / imported:.0f} epigrams/s, "
+                  f"less than {min_per_s:.0f}")
+            fast_enough = False
+
+    remove_db(db_path)
+    shutil.rmtree(corpus)
+    return fast_enough
+
+
+def _import_times(stderr):
+    """ Parse `python -X importtime` output into {module: cumulative microseconds} """
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            (self_us, cumulative, module) = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative)
+    return times
+
+
+def bench_startup(iterations, max_ms):
+    """ Cold start: the cost of `import fim` (from -X importtime) and the wall clock
+        of a `fim fortune` run, which never touches the database, and of the default
+        command against a 13k epigram store.
+
+        Return:
+        False if the median import time is over max_ms
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    corpus = os.path.join(BENCH_DIR, "fim_bench_startup")
+    shutil.rmtree(corpus, ignore_errors=True)
+    os.makedirs(corpus)
+    build_fortune_file(os.path.join(corpus, "startup"), 1)
+
+    imports = []
+    slowest = {}
+    for x in range(iterations):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import fim"],
+                                cwd=here, capture_output=True, text=True, check=True)
+        times = _import_times(result.stderr)
+        imports.append(times["fim"] / 1000000)
+        for (module, us) in times.items():
+            slowest[module] = max(slowest.get(module, 0), us)
+
+    wall = _timed(lambda: subprocess.run([sys.executable, os.path.join(here, "fim.py"), "fortune", corpus],
+                                         cwd=here, capture_output=True, check=True), iterations)
+
+    home = os.path.join(corpus, "home")
+    os.makedirs(os.path.join(home, ".fim"))
+    build_corpus(os.path.join(home, ".fim", "fim.db"), 13000)
+    default = _timed(lambda: subprocess.run([sys.executable, os.path.join(here, "fim.py")], cwd=here,
+                                            env=dict(os.environ, HOME=home), capture_output=True,
+                                            check=True), iterations)
+    shutil.rmtree(corpus)
+
+    median = statistics.median(imports) * 1000
+    print(f"{'import fim':<16} median {median:8.1f} ms" + (f"  (limit {max_ms} ms)" if max_ms < float("inf") else ""))
+    print(f"{'fim fortune':<16} median {statistics.median(wall) * 1000:8.1f} ms  wall clock")
+    print(f"{'fim':<16} median {statistics.median(default) * 1000:8.1f} ms  wall clock")
+    record("startup", "import fim", median_ms=median)
+    record("startup", "fim fortune", median_ms=statistics.median(wall) * 1000)
+    record("startup", "fim", 13000, median_ms=statistics.median(default) * 1000)
+    slowest.pop("fim")
+    for (module, us) in sorted(slowest.items(), key=lambda m: -m[1])[:5]:
+        print(f"    {module:<28} {us / 1000:8.1f} ms")
+    return median <= max_ms
+
+
+# the settings before WAL: rollback journal, a sync per commit and no busy handling
+LEGACY_PRAGMAS = {"journal_mode": "delete", "synchronous": "full", "busy_timeout": 0, "mmap_size": 0}
+
+
+def _selector(db_path, pragmas, retries, selections, barrier, results):
+    """ One fim process: time `selections` fast path impressions against the shared db """
+    log.setLevel(logging.WARNING)
+    fim_core.BUSY_RETRIES = retries
+    store = FastEpigramStore(db_path, pragmas=pragmas)
+    latencies = []
+    errors = 0
+
+    barrier.wait()
+    for x in range(selections):
+        start = time.perf_counter()
+        try:
+            store.get_epigram_impression()
+            latencies.append(time.perf_counter() - start)
+        except sqlite3.OperationalError:
+            errors += 1
+    store.close()
+    results.put((latencies, errors))
+
+
+def bench_concurrency(processes, selections, size):
+    """ Throughput and tail latency of N processes selecting at once, with the old
+        rollback journal settings and with the WAL defaults """
+    db_path = os.path.join(BENCH_DIR, "fim_bench_concurrency.db")
+
+    for (label, pragmas, retries) in [("rollback", LEGACY_PRAGMAS, 0),
+                                      ("wal", None, fim.BUSY_RETRIES)]:
+        for count in processes:
+            build_corpus(db_path, size)
+            # journal_mode is stored in the database, set it before the selectors start
+            FastEpigramStore(db_path, pragmas=pragmas).close()
+
+            barrier = multiprocessing.Barrier(count + 1)
+            results = multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=_selector,
+                                               args=(db_path, pragmas, retries, selections, barrier, results))
+                       for x in range(count)]
+            for w in workers:
+                w.start()
+            barrier.wait()
+            start = time.perf_counter()
+            outcomes = [results.get() for w in workers]
+            elapsed = time.perf_counter() - start
+            for w in workers:
+                w.join()
+
+            latencies = sorted(l for (ls, e) in outcomes for l in ls)
+            errors = sum(e for (ls, e) in outcomes)
+            if not latencies:
+                latencies = [float("nan")]
+            print(f"{label:<10} {count:>2} processes  {len(latencies) / elapsed:8.0f} selections/s  "
+                  f"p50 {latencies[len(latencies) // 2] * 1000:7.2f} ms  "
+                  f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.2f} ms  "
+                  f"max {latencies[-1] * 1000:7.2f} ms  {errors} locked")
+            record("concurrency", f"{label} {count} processes", size,
+                   selections_per_s=len(latencies) / elapsed,
+                   p50_ms=latencies[len(latencies) // 2] * 1000,
+                   p99_ms=latencies[int(len(latencies) * 0.99)] * 1000, locked=errors)
+
+    remove_db(db_path)
+
+
+def _http_client(port, requests, latencies):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    for x in range(requests):
+        start = time.perf_counter()
+        conn.request("GET", "/")
+        conn.getresponse().read()
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+def bench_http(workers, clients, requests, size, engine="sqlite", corpus=None):
+    """ Requests per second and tail latency of app.py's server for each pool size,
+        with every client holding one keep-alive connection """
+    import app
+    db_path = os.path.join(BENCH_DIR, "fim_bench_http.db")
+
+    for count in workers:
+        build_corpus(db_path, size, **(corpus or {}))
+        server = app.PooledHTTPServer(("127.0.0.1", 0), app.S, db_path=db_path, workers=count, engine=engine)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        latencies = []
+        threads = [threading.Thread(target=_http_client,
+                                    args=(server.server_address[1], requests, latencies))
+                   for x in range(clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+        latencies.sort()
+        print(f"{count:>2} workers {clients:>2} clients  {len(latencies) / elapsed:8.0f} requests/s  "
+              f"p50 {latencies[len(latencies) // 2] * 1000:7.2f} ms  "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.2f} ms")
+        record("http", f"{engine} {count} workers {clients} clients", size,
+               requests_per_s=len(latencies) / elapsed,
+               p50_ms=latencies[len(latencies) // 2] * 1000,
+               p99_ms=latencies[int(len(latencies) * 0.99)] * 1000)
+
+    remove_db(db_path)
+
+
+def build_vocabulary(words, seed=42):
+    rng = random.Random(seed)
+    return list({''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))) for x in range(words)})
+
+
+def bench_search(sizes, iterations):
+    """ A page of ranked FTS5 results plus the match count, against the LIKE scan
+        it replaces """
+    db_path = os.path.join(BENCH_DIR, "fim_bench_search.db")
+    vocabulary = build_vocabulary(5000)
+    rng = random.Random(7)
+
+    for size in sizes:
+        build_corpus(db_path, size, vocabulary=vocabulary)
+        fast = FastEpigramStore(db_path)
+        conn = sqlite3.connect(db_path)
+
+        # common, middling and rare words
+        for (label, rank) in [("common", 10), ("middling", 300), ("rare", 3000)]:
+            word = vocabulary[rank]
+
+            def like():
+                pattern = f"%{word}%"
+                conn.execute("select count(1) from epigram where content like ?", (pattern,)).fetchone()
+                conn.execute("select epigram_uuid, content from epigram where content like ? limit 10",
+                             (pattern,)).fetchall()
+
+            def fts():
+                fast.count_matches(word)
+                fast.search(word, limit=10)
+
+            _report(f"like {label}", size, _timed(like, iterations), "search")
+            _report(f"fts5 {label}", size, _timed(fts, iterations), "search")
+
+        # two words, so the index intersects them
+        words = [" ".join(rng.sample(vocabulary[50:500], 2)) for x in range(iterations)]
+        _report("fts5 two words", size, _timed(lambda: fast.search(words.pop(), limit=10), iterations), "search")
+
+        conn.close()
+        fast.close()
+
+    remove_db(db_path)
+
+
+def plant_near_duplicates(db_path, fraction, seed=42):
+    """ Copy a fraction of the epigrams into other buckets the way the legacy files
+        repeat them: re-wrapped, attributed and with a word missing from the long
+        ones.  Return the number planted """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    (buckets, ) = conn.execute("select count(1) from bucket").fetchone()
+    originals = conn.execute("select bucket_id, content from epigram").fetchall()
+    copies = []
+    for (bucket_id, content) in rng.sample(originals, int(len(originals) * fraction)):
+        words = content.split()
+        if len(words) >= 30:
+            del words[rng.randrange(len(words))]
+        wrapped = "\n".join(" ".join(words[n:n + 8]) for n in range(0, len(words), 8))
+        copies.append((generate_uuid(), bucket_id % buckets + 1, wrapped + "\n\t\t-- Anonymous"))
+    _insert_epigrams(conn, copies)
+    conn.close()
+    return len(copies)
+
+
+def bench_dedupe(sizes, fraction):
+    """ fim dedupe --report over a store with planted near duplicates, the scan rate
+        and how many of them it finds """
+    db_path = os.path.join(BENCH_DIR, "fim_bench_dedupe.db")
+    vocabulary = build_vocabulary(5000)
+
+    for size in sizes:
+        build_corpus(db_path, size, vocabulary=vocabulary)
+        planted = plant_near_duplicates(db_path, fraction)
+        fast = FastEpigramStore(db_path)
+
+        start = time.perf_counter()
+        found = fast.find_near_duplicates()
+        elapsed = time.perf_counter() - start
+
+        total = size + planted
+        print(f"{total:>9} epigrams  scan {elapsed:8.2f}s  ({total / elapsed:8.0f} epigrams/s)  "
+              f"found {len(found)} of {planted} planted near duplicates")
+        record("dedupe", "scan", total, scan_s=elapsed, epigrams_per_s=total / elapsed,
+               found=len(found), planted=planted)
+        fast.close()
+
+    remove_db(db_path)
+
+
+def bench_engine(sizes, selections):
+    """ Selections per second for FastEpigramStore and the memory engine, and how far
+        apart the share of impressions each bucket got is """
+    from fim_engine import MemoryEpigramStore
+    db_path = os.path.join(BENCH_DIR, "fim_bench_engine.db")
+    copy_path = os.path.join(BENCH_DIR, "fim_bench_engine_copy.db")
+
+    for size in sizes:
+        build_corpus(db_path, size)
+        remove_db(copy_path)
+        shutil.copy(db_path, copy_path)
+
+        shares = []
+        for (label, store) in [("sqlite", FastEpigramStore(db_path)), ("memory", MemoryEpigramStore(copy_path))]:
+            random.seed(42)
+            start = time.perf_counter()
+            for n in range(selections):
+                store.get_epigram_impression()
+            elapsed = time.perf_counter() - start
+            stats = store.get_bucket_stats()
+            store.close()
+            shares.append([i / selections for (b, e, w, i) in stats])
+            print(f"{label:<8} {size:>9} epigrams  {selections / elapsed:9.0f} selections/s")
+            record("engine", label, size, selections_per_s=selections / elapsed)
+
+        difference = max(abs(a - b) for (a, b) in zip(*shares))
+        print(f"{'':<8} {'':>9}           largest difference in a bucket's share {difference:.4f}")
+        record("engine", "share difference", size, difference=difference)
+
+    remove_db(db_path)
+    remove_db(copy_path)
+
+
+def write_results(path, argv):
+    """ Write RESULTS to path as JSON, with what they were measured on """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    with open(path, "w") as f:
+        json.dump({"commit": commit,
+                   "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "argv": argv,
+                   "python": platform.python_version(),
+                   "sqlite": sqlite3.sqlite_version,
+                   "platform": platform.platform(),
+                   "cpus": os.cpu_count(),
+                   "results": RESULTS}, f, indent=2)
+    print(f"wrote {len(RESULTS)} results to {path}")
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """ Print each metric of the results two --json runs share, and the change
+
+        Return:
+        the number of metrics that got worse by more than threshold (a fraction)
+    """
+    def results(path):
+        with open(path) as f:
+            return {(r["benchmark"], r["label"], r["size"]): r for r in json.load(f)["results"]}
+
+    (before, after) = (results(baseline), results(current))
+    regressions = 0
+    for key in [k for k in after if k in before]:
+        for (metric, value) in after[key].items():
+            old = before[key].get(metric)
+            if metric in ("benchmark", "label", "size") or not isinstance(value, (int, float)) or not old:
+                continue
+            change = value / old - 1
+            if metric.endswith("_per_s"):
+                worse = change < -threshold
+            elif metric.endswith(("_ms", "_s")):
+                worse = change > threshold
+            else:
+                worse = False
+            regressions += worse
+            size = "" if key[2] is None else key[2]
+            print(f"{key[0]:<12} {key[1]:<28} {size:>9}  {metric:<18} {old:12.3f} {value:12.3f}  "
+                  f"{change * 100:+7.1f}%{'  WORSE' if worse else ''}")
+    return regressions
+
+
+def bench_suite(quick=False, corpus=None):
+    """ The benchmarks make bench runs: import, selection at 1k, 13k and 1M epigrams (not
+        1M with quick), the impression write paths, cold start and HTTP throughput
+
+        Return:
+        False if a benchmark failed its check, e.g. the import was slower than IMPORT_PER_SECOND
+    """
+    sizes = [1000, 13000] if quick else [1000, 13000, 1000000]
+    passed = True
+    for (title, run) in [
+            ("import", lambda: bench_import(4 if quick else 16, 1 if quick else 4, [1, 2],
+                                            min_per_s=IMPORT_PER_SECOND)),
+            ("selection", lambda: bench_selection(sizes, 50 if quick else 200, corpus)),
+            ("impressions", lambda: bench_impressions(13000, 50 if quick else 200, corpus)),
+            ("startup", lambda: bench_startup(3 if quick else 10, float("inf"))),
+            ("http", lambda: bench_http([1, 8], 8, 25 if quick else 100, 13000, corpus=corpus))]:
+        print(f"== {title}")
+        passed = run() is not False and passed
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_fim.py')
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--buckets', type=int, default=20, help="buckets in the synthetic corpus")
+    parser.add_argument('--lengths', choices=sorted(LENGTHS), default="uniform",
+                        help="content length distribution of the synthetic corpus")
+    parser.add_argument('--history', type=float, default=0,
+                        help="impressions already recorded, per epigram of the synthetic corpus")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    suite_parser = subparsers.add_parser('suite')
+    suite_parser.add_argument('--quick', action='store_true', help="smaller corpora and no 1M store")
+
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('baseline', help="a --json file")
+    compare_parser.add_argument('current', help="a --json file")
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help="exit non zero if a metric gets worse by more than this fraction")
+
+    corpus_parser = subparsers.add_parser('corpus')
+    corpus_parser.add_argument('path', help="the database to create, it is replaced")
+    corpus_parser.add_argument('--size', type=int, default=13000, help="epigrams")
+    corpus_parser.add_argument('--seed', type=int, default=42)
+
+    selection_parser = subparsers.add_parser('selection')
+    selection_parser.add_argument('--sizes', default="1000,13000,1000000",
+                                  help="comma separated epigram counts")
+    selection_parser.add_argument('--iterations', type=int, default=200)
+
+    impressions_parser = subparsers.add_parser('impressions')
+    impressions_parser.add_argument('--size', type=int, default=13000, help="epigrams in the store")
+    impressions_parser.add_argument('--iterations', type=int, default=200)
+
+    parse_parser = subparsers.add_parser('parse')
+    parse_parser.add_argument('--sizes', default="1,8,32", help="comma separated file sizes in MB")
+    parse_parser.add_argument('--iterations', type=int, default=5)
+
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('--files', type=int, default=16)
+    import_parser.add_argument('--megabytes', type=int, default=4, help="size of each file")
+    import_parser.add_argument('--workers', default="1,2,4,8", help="comma separated worker counts")
+    import_parser.add_argument('--min-per-s', type=float, default=0,
+                               help="exit non zero if an import does fewer epigrams per second than this")
+
+    startup_parser = subparsers.add_parser('startup')
+    startup_parser.add_argument('--iterations', type=int, default=10)
+    startup_parser.add_argument('--max-ms', type=float, default=100,
+                                help="exit non zero if importing fim takes longer than this")
+
+    concurrency_parser = subparsers.add_parser('concurrency')
+    concurrency_parser.add_argument('--processes', default="1,4,8", help="comma separated process counts")
+    concurrency_parser.add_argument('--selections', type=int, default=200, help="per process")
+    concurrency_parser.add_argument('--size', type=int, default=13000, help="epigrams in the store")
+
+    search_parser = subparsers.add_parser('search')
+    search_parser.add_argument('--sizes', default="13000,100000,1000000", help="comma separated epigram counts")
+    search_parser.add_argument('--iterations', type=int, default=50)
+
+    dedupe_parser = subparsers.add_parser('dedupe')
+    dedupe_parser.add_argument('--sizes', default="13000,100000,1000000", help="comma separated epigram counts")
+    dedupe_parser.add_argument('--fraction', type=float, default=0.05, help="near duplicates to plant")
+
+    engine_parser = subparsers.add_parser('engine')
+    engine_parser.add_argument('--sizes', default="13000,100000,1000000", help="comma separated epigram counts")
+    engine_parser.add_argument('--selections', type=int, default=20000)
+
+    http_parser = subparsers.add_parser('http')
+    http_parser.add_argument('--workers', default="1,8", help="comma separated pool sizes")
+    http_parser.add_argument('--clients', type=int, default=8, help="concurrent keep-alive connections")
+    http_parser.add_argument('--requests', type=int, default=100, help="per client")
+    http_parser.add_argument('--size', type=int, default=13000, help="epigrams in the store")
+    http_parser.add_argument('--engine', choices=["sqlite", "memory"], default="sqlite")
+
+    args = parser.parse_args()
+    log.setLevel(logging.WARNING)
+    status = 0
+    corpus = {"buckets": args.buckets, "lengths": args.lengths, "history": args.history}
+
+    if args.command == 'compare':
+        if compare_results(args.baseline, args.current, args.threshold):
+            sys.exit(1)
+        return
+    elif args.command == 'corpus':
+        build_corpus(args.path, args.size, seed=args.seed, **corpus)
+    elif args.command == 'suite':
+        if not bench_suite(args.quick, corpus):
+            status = 1
+    elif args.command == 'selection':
+        bench_selection([int(s) for s in args.sizes.split(",")], args.iterations, corpus)
+    elif args.command == 'impressions':
+        bench_impressions(args.size, args.iterations, corpus)
+    elif args.command == 'parse':
+        bench_parse([int(s) for s in args.sizes.split(",")], args.iterations)
+    elif args.command == 'import':
+        if not bench_import(args.files, args.megabytes, [int(w) for w in args.workers.split(",")],
+                            args.min_per_s):
+            status = 1
+    elif args.command == 'startup':
+        if not bench_startup(args.iterations, args.max_ms):
+            status = 1
+    elif args.command == 'concurrency':
+        bench_concurrency([int(p) for p in args.processes.split(",")], args.selections, args.size)
+    elif args.command == 'search':
+        bench_search([int(s) for s in args.sizes.split(",")], args.iterations)
+    elif args.command == 'dedupe':
+        bench_dedupe([int(s) for s in args.sizes.split(",")], args.fraction)
+    elif args.command == 'engine':
+        bench_engine([int(s) for s in args.sizes.split(",")], args.selections)
+    elif args.command == 'http':
+        bench_http([int(w) for w in args.workers.split(",")], args.clients, args.requests, args.size,
+                   args.engine, corpus)
+
+    if args.json:
+        write_results(args.json, sys.argv[1:])
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,561 +1,1055 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import uuid as uuid_stdlib
 import logging
-import re
 import os
-import glob
 import random
 import sys
-import secrets
-from pathlib import Path
-
-import toml as toml
-# from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base
-from sqlalchemy.sql.expression import func
-from sqlalchemy import (
-    Column,
-    Integer,
-    String,
-    Boolean,
-    ForeignKey,
-    create_engine
-)
 import datetime
-from prompt_toolkit import prompt
-import argparse
-import toml
-import openai
-
-""" fim - fortune improved """
+import fcntl
+import json
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+""" fim - fortune improved
+
+    fim is run from shell rc files and prompts, so this module only holds what
+    the command line needs to start: the output formatting and FastEpigramStore
+    for showing an epigram, on top of the fortune file readers and helpers in
+    fim_core (re-exported here).  The SQLAlchemy models, importers and
+    EpigramStore live in fim_store and the OpenAI, prompt_toolkit and toml
+    dependencies are imported by the commands that use them.
+"""
+
+from fim_core import (
+    MAX_CONTENT_LENGTH,
+    BULK_BATCH_SIZE,
+    NO_RESULTS_FOUND_TEXT,
+    list_fortune_files,
+    StrfileIndex,
+    list_sql_files,
+    default_db_path,
+    apply_pragmas,
+    retry_on_busy,
+    BucketSampler,
+    random_pivot,
+    impression_cutoff,
+    NearDuplicateIndex,
+)
 
-log = logging.getLogger(__name__)
+# by name, so run as a script the fim_core and fim_store loggers still log under it
+log = logging.getLogger("fim")
 log.addHandler(logging.StreamHandler(sys.stdout))
 # logging.basicConfig(level=logging.ERROR)
 log.setLevel(logging.INFO)
 
-Session = sessionmaker()
-Base = declarative_base()
-
-# this is my homebrew id generator for bucket id generatio
-i = 0
-
-
-def mydefault():
-    global i
-    i += 1
-    return i
-
-
-class Bucket(Base):
-    """ Epigrams belong to a single bucket, which is used to classify content.
-
-        Buckets are categories and the primary mechanism of organization within
-        FIM.  They will typically map to a single content source (e.g. fortune
-        text file), however this is not a requirement.
-
-        Buckets are the primary mechanism used by the "Bucket Sort" algothorim.
-        See the readme for the details
-    """
-
-    __tablename__ = 'bucket'
-    bucket_id = Column(Integer, primary_key=True)
-    name = Column(String(50))
-    item_weight = Column(Integer, default=1)
-
-    #    def __init__(self, name, **kwargs):
-    #        super()
-    #        self.name = name
-    #        self.bucket_id = mydefault()
+# the names that fim re-exports from fim_store, loaded on first access
+_STORE_NAMES = frozenset([
+    "Session", "Base", "Bucket", "Epigram", "Impression", "ImportedFile", "SchemaVersion", "Completion",
+    "BaseImporter", "FortuneFileImporter", "SoloEpigramImporter",
+    "EpigramStore", "FIM",
+])
 
-    def __str__(self):
-        return f"<Bucket bucket_id={self.bucket_id}, name={self.name}>"
 
+def __getattr__(name):
+    if name in _STORE_NAMES:
+        import fim_store
+        return getattr(fim_store, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-def generate_uuid():
-    return str(uuid_stdlib.uuid4())
 
+FortuneEntry = namedtuple("FortuneEntry", ["content", "path", "index"])
 
-class Epigram(Base):
-    """ This is the basic unit of content in fim.
 
-        An epigram is a brief, interesting, memorable, and sometimes surprising
-        or satirical statement. The word is derived from the Greek: ἐπίγραμμα
-        epigramma "inscription" from ἐπιγράφειν epigraphein "to write on, to
-        inscribe", and the literary device has been employed for over two
-        millennia.
+class FortuneFileReader():
+    """ Serve epigrams straight from fortune files, without importing them.
 
-        BTW 'epigram' was directly lifted from the fortune man page *shrugs*.
+        This is the classic fortune behaviour: a file is chosen in proportion to
+        the number of epigrams it holds and then a random entry is read through
+        its strfile index.  Nothing is recorded, so there is no BucketSort.
 
+    Positional Arguments:
+    - uri (str) - a fortune file or a directory of them
     """
-    __tablename__ = 'epigram'
-
-    epigram_uuid = Column(
-        String, default=generate_uuid(), primary_key=True)
-    bucket = relationship("Bucket", backref="epigram")
-    bucket_id = Column(Integer, ForeignKey("bucket.bucket_id"))
-    created_date = Column(String, default=datetime.datetime.now())
-    modified_date = Column(String)
-    last_impression_date = Column(String)
-    content_source = Column(String)
-    content_text = Column(String)
-    content = Column(String)
-    # where the content originated from, (i.e. intro blog post)
-    source_url = Column(String)
-    # used with content_type (i.e. asciicast overview)
-    action_url = Column(String)
-    context_url = Column(String)  # deep dive info link (i.e. github repo)
-    gpt_completion = Column(String)
-
-    def __init__(self, **kwargs):
-        self.epigram_uuid = generate_uuid()
-
-        if 'content' in kwargs:
-            self.content = kwargs['content']
-
-        if 'bucket' in kwargs:
-            self.bucket = kwargs['bucket']
-            self.bucket_id = self.bucket.bucket_id
-        # if 'uuid' not in kwargs:
-
-    def __str__(self):
-        return f"<Epigram epigram_uuid={self.epigram_uuid}, " + \
-            f"bucket_id={self.bucket_id}, " + \
-            f"bucket={self.bucket}>"
-
-    @classmethod
-    def generate_uuid(cls):
-        return str(uuid_stdlib.uuid1())
-
-
-class Impression(Base):
-    """ Track the views for each epigram """
-    __tablename__ = 'impression'
-    impression_id = Column(Integer, primary_key=True)
-    bucket_id = Column(Integer, ForeignKey("bucket.bucket_id"))
-    bucket = relationship("Bucket", backref="impression")
-    epigram_uuid = Column(String, ForeignKey("epigram.epigram_uuid"))
-    epigram = relationship("Epigram", backref="impression")
-    impression_date = Column(String)
-    saved = Column(Boolean)
-    gpt_completion = Column(String)
-
-    def __init__(self, **kwargs):
-
-        if 'epigram' in kwargs:
-            self.epigram = kwargs['epigram']
-            self.epigram_uuid = self.epigram.epigram_uuid
-            self.impression_date = datetime.datetime.now()
-
-            if self.epigram.bucket is not None:
-                self.bucket = self.epigram.bucket
-                self.bucket_id = self.bucket.bucket_id
-
-    def __str__(self):
-        return f"<Impression impression_id={self.impression_id}, " + \
-            f"epigram_uuid={self.epigram_uuid}, " + \
-            f"bucket_id={self.bucket_id}, " + \
-            f"bucket={self.bucket}>"
-
-
-class BaseImporter():
-    """ Base class for all of the content type """
 
     def __init__(self, uri):
-        pass
+        self._filenames = list_fortune_files(uri)
+        self._indexes = None
+
+    def indexes(self):
+        if self._indexes is None:
+            self._indexes = [StrfileIndex.for_file(f) for f in self._filenames]
+        return self._indexes
+
+    def get_epigram(self, rng=random):
+        """ Return a random FortuneEntry, or None if the files are empty """
+        indexes = [i for i in self.indexes() if i.numstr > 0]
+        if not indexes:
+            return None
 
-    def process(self):
-        yield None
+        index = rng.choices(indexes, weights=[i.numstr for i in indexes])[0]
+        i = rng.randrange(index.numstr)
+        return FortuneEntry(index.read(i), index.path, i)
 
 
-class FortuneFileImporter(BaseImporter):
-    """ This file handles the loading of epigram from files in the legacy
-        fortune format.  This is a simple structure with content delimited by
-        % characters on single markers.  Like:
+EpigramRecord = namedtuple("EpigramRecord", ["epigram_uuid", "bucket_id", "content",
+                                             "content_length", "last_impression_date"])
+ImpressionRecord = namedtuple("ImpressionRecord", ["impression_id", "epigram_uuid", "bucket_id",
+                                                   "impression_date", "epigram"])
+BucketRecord = namedtuple("BucketRecord", ["bucket_id", "name", "item_weight"])
+SearchResult = namedtuple("SearchResult", ["epigram", "bucket_name", "rank", "snippet"])
 
-        redfish
-        %
-        bluefish
-        %
-        onefish
-        twofish
-        %
-        something else
-        %
 
-    Positional Arguments:
-    - uri (str) - the file path to the fortunes.  If this is a directory,
-                  then the entire directory will be loaded
+def write_impressions(conn, entries, bump_generation=True):
+    """ Record impressions in one transaction: the impression rows, last_impression_date
+        (which never moves backwards) and optionally a new store generation
 
+        Positional Arguments:
+        conn (sqlite3.Connection) - an autocommit connection to the database
+        entries (list) - (epigram_uuid, bucket_id, impression_date) tuples
 
-    Keyword Arguments:
-    - bucket (Bucket) - the bucket that this fortune file should belone to
-                          if not specified, this is the the basename of the
-                          of the file w\\o extension
+        Keyword Arguments:
+        bump_generation (bool) - invalidate what was cached at the current generation
     """
+    conn.execute("begin immediate")
+    try:
+        conn.executemany("""
+            insert into impression (bucket_id, epigram_uuid, impression_date)
+            values ((select bucket_id from bucket where bucket_id = ?), ?, ?)
+            """, [(bucket_id, epigram_uuid, date) for (epigram_uuid, bucket_id, date) in entries])
+        conn.executemany("""
+            update epigram set last_impression_date = ?
+             where epigram_uuid = ? and ifnull(last_impression_date, '') < ?
+            """, [(date, epigram_uuid, date) for (epigram_uuid, bucket_id, date) in entries])
+        if bump_generation:
+            conn.execute("""
+                update store_generation set generation = generation + 1,
+                       modified = cast(strftime('%s', 'now') as integer)
+                """)
+        conn.execute("commit")
+    except BaseException:
+        conn.execute("rollback")
+        raise
+
+
+class ImpressionJournal():
+    """ An append only log of the impressions that haven't been written to SQLite.
+
+        Recording an impression in SQLite is a transaction, and a sync, per fortune
+        shown.  With the journal an invocation appends one line instead and the
+        lines are compacted into the impression table (and last_impression_date)
+        in a single transaction later.  Appends and compaction hold an exclusive
+        flock on the journal so concurrent fims don't lose lines.
+
+        Each line is "epigram_uuid<TAB>bucket_id<TAB>impression_date".
 
-    def __init__(self, uri, bucket=None):
+    Positional Arguments:
+    - db_filename (str) - the database the journal belongs to, it lives next to it
+    """
 
-        if not os.path.exists(uri):
-            raise AttributeError(f"File {uri} does not exist")
+    SUFFIX = "-impressions"
 
-        # normalize this
-        uri = os.path.realpath(uri)
+    def __init__(self, db_filename):
+        self.path = db_filename + self.SUFFIX
 
-        if os.path.isdir(uri):
-            self._filenames = glob.glob(uri + "/*")
-            log.debug(self._filenames)
-        elif os.path.isfile(uri):
-            self._filenames = [uri]
-        else:
-            raise RuntimeError("Unexpected filetype for " + uri)
-
-        self._bucket = bucket
-
-    def process(self):
-        for fname in self._filenames:
-            with open(fname, 'r') as fortune_file:
-                bucket = None
-                if self._bucket is None:
-                    bucket = self._determine_bucket(fname)
-                else:
-                    bucket = self._bucket
-
-                for snippet in self.process_fortune_file(fortune_file.read()):
-                    yield Epigram(content=snippet, bucket=bucket)
-
-    def _determine_bucket(self, file_name):
-        base_name = os.path.basename(file_name)
-        bucket_name = os.path.splitext(base_name)[0]
-        return Bucket(name=bucket_name)
-
-    @classmethod
-    def process_fortune_file(cls, file_contents):
-        delimiter = re.compile(r'^%$')
-        e = ''
-        for f in file_contents.split("\n"):
-            if re.search(delimiter, f):
-                yield e.rstrip()
-                e = ""
-            else:
-                e += f + "\n"
+    def append(self, epigram_uuid, bucket_id, impression_date):
+        line = f"{epigram_uuid}\t{'' if bucket_id is None else bucket_id}\t{impression_date}\n"
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
 
+    def entries(self):
+        """ The journaled impressions as a list of (epigram_uuid, bucket_id, impression_date) """
+        try:
+            with open(self.path, "rb") as f:
+                return self._parse(f.read())
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _parse(data):
+        entries = []
+        # a line without its newline is still being written
+        for line in data.decode("utf-8").split("\n")[:-1]:
+            (epigram_uuid, bucket_id, impression_date) = line.split("\t")
+            entries.append((epigram_uuid, int(bucket_id) if bucket_id else None, impression_date))
+        return entries
+
+    def compact(self, conn):
+        """ Move the journaled impressions into the database and empty the journal
 
-class SoloEpigramImporter(BaseImporter):
-    """ Add a single epigram """
+            Positional Arguments:
+            conn (sqlite3.Connection) - an autocommit connection to the database
 
-    def __init__(self, epigram):
-        self._epigram = epigram
+            Return:
+            the number of impressions compacted
+        """
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            return 0
 
-    def process(self):
-        yield self._epigram
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with os.fdopen(os.dup(fd), "rb") as f:
+                entries = self._parse(f.read())
+            if not entries:
+                return 0
+
+            retry_on_busy(lambda: self._write(conn, entries))
+            os.ftruncate(fd, 0)
+            log.debug(f"Compacted {len(entries)} impressions")
+            return len(entries)
+        finally:
+            os.close(fd)
+
+    _write = staticmethod(write_impressions)
+
+
+class FastEpigramStore():
+    """ The hot path of fim, select an epigram and record the impression, on the
+        stdlib sqlite3 module.
+
+        This makes the same choices as EpigramStore.get_epigram_impression (the
+        same queries, the same BucketSort math and the same calls into the random
+        module) but without the ORM: no session, model instances or relationship
+        loading.  The selection, the impression insert and the last_impression_date
+        update run in one transaction.  Rows come back as EpigramRecord and
+        ImpressionRecord tuples.
+
+        Everything else (imports, admin, GPT) uses EpigramStore.  If the database
+        needs migrations, EpigramStore is loaded once to apply them.
+
+        With a queue_size, unfiltered selections are precomputed in bulk into the
+        selection_queue table and an invocation just pops the head.  The queue is
+        filled by running the real selections inside a savepoint and rolling them
+        back, so it follows BucketSort as if those epigrams had been shown one
+        after another.  It refills when it runs low and is emptied by triggers
+        when the buckets, weights or content change, or skipped when impressions
+        were recorded without it.
+
+        With journal=True impressions are appended to an ImpressionJournal rather
+        than written to SQLite, so showing an epigram is read only.  Selection
+        counts the journaled impressions in the bucket stats and skips journaled
+        epigrams (they are the most recently shown), so BucketSort stays fair.
+        The journal is compacted once it holds COMPACT_AFTER impressions, or by
+        compact().  The queue is not used with the journal, popping it is a write.
 
+    Positional Arguments:
+    - filename (str) - the path to the SQLite database
 
-class EpigramStore():
-    """ This class encapsulates the internal datastore (SQLite)"""
+    Keyword Arguments:
+    - queue_size (int) - the number of selections to precompute, 0 disables the queue
+    - journal (bool) - record impressions in the journal instead of the database
+    - pragmas (dict) - overrides for PRAGMAS
+    """
 
-    ERROR_BUCKET = Bucket(bucket_id=123, name="error")
-    NO_RESULTS_FOUND = Epigram(
-        content="Your princess is in another castle. (404: File Not Found) ", bucket_id=123)
-    GENERAL_ERROR = Epigram(content="Always bring a towel (500: General Error)", bucket_id=123)
-    SQL_DIR = "sql"
+    NO_RESULTS_FOUND = EpigramRecord(None, 123, NO_RESULTS_FOUND_TEXT, len(NO_RESULTS_FOUND_TEXT), None)
 
-    def __init__(self, filename):
-        """ Construct the store (connect to db, optionally retrieve all rows)
+    SELECT_COLUMNS = "select epigram_uuid, bucket_id, content, content_length, last_impression_date from epigram"
+    ORDER_BY = " order by last_impression_date asc, epigram_uuid asc limit 1"
+    # the queue size used by the command line
+    QUEUE_SIZE = 64
+    # journaled impressions are compacted into the database at this many
+    COMPACT_AFTER = 100
 
-            Positional Arguments:
-            filename (str) - the path to the SQLite database
-
-            Optional Params:
-            force_random (Bool)  -
-        """
+    def __init__(self, filename, queue_size=0, journal=False, pragmas=None):
         self._filename = filename
+        self._queue_size = queue_size
+        self._journal = ImpressionJournal(filename) if journal else None
+        self._pending = []
+        self._sampler = None
+        self._sampler_key = None
+        if self._pending_migrations():
+            from fim_store import EpigramStore
+            EpigramStore(filename, pragmas=pragmas)._session.close()
+
+        self._conn = sqlite3.connect(filename, isolation_level=None)
+        apply_pragmas(self._conn, pragmas)
+
+    def _pending_migrations(self):
+        if not os.path.exists(self._filename):
+            return True
+
+        conn = sqlite3.connect(self._filename)
+        try:
+            applied = {row[0] for row in conn.execute("select version from schema_version")}
+        except sqlite3.OperationalError:
+            return True
+        finally:
+            conn.close()
+
+        return any(version not in applied for (version, fname) in list_sql_files())
+
+    def close(self):
+        self._conn.close()
+
+    def get_bucket_stats(self):
+        """ The bucket_stats rows, with the journaled impressions counted in """
+        stats = self._conn.execute("""
+            select bucket_id, epigram_count, weighted_count, impression_count
+              from bucket_stats order by bucket_id
+            """).fetchall()
+
+        if self._pending:
+            pending = {}
+            for (epigram_uuid, bucket_id, date) in self._pending:
+                pending[bucket_id] = pending.get(bucket_id, 0) + 1
+            stats = [(b, e, w, i + pending.get(b, 0)) for (b, e, w, i) in stats]
+        return stats
+
+    def get_generation(self):
+        """ The content generation, bumped whenever the buckets, their weights or the
+            epigrams change and when the journal is compacted
 
-        db_uri = 'sqlite:///' + self._filename
-        self._engine = create_engine(db_uri, echo=False)
-        log.debug("Initializing db" + db_uri)
-        Session.configure(bind=self._engine)
-        self._session = Session()
-        Base.metadata.create_all(self._engine)
-        self._load_sql_files()
-
-    def _load_sql_files(self, file_dir=SQL_DIR):
-        uri = os.path.realpath(file_dir)
-
-        if os.path.isdir(uri):
-            sql_files = glob.glob(uri + "/*")
-        elif os.path.isfile(uri):
-            sql_files = [uri]
-        else:
-            raise RuntimeError("FileNotFound: " + uri)
-
-        sql_files.sort()
-
-        for fname in sql_files:
-            with open(fname, 'r') as sql_text:
-                log.debug(f"Processing %s file" % (fname))
-                self._execute_sql(sql_text.read())
-
-    def _execute_sql(self, sql_text):
-        with self._engine.connect() as conn:
-            conn.exec_driver_sql(sql_text)
-            # onn self._engine.execute(sql_text)
-
-    def _get_weighted_bucket(self):
+            Return:
+            A (generation, modified) tuple, modified is in unix seconds
         """
-        Using the patented BucketSort(TM) Technology this queries the impressions_calculated
-        table.  This factors in the relative weights of each bucket compared to its actual
-        impressions.  Buckets that have exceeded their allowable view percentage are excluded
-        from selection.
+        return self._conn.execute("select generation, modified from store_generation").fetchone()
 
-        The selection itself is using the random.choice() method based on the probabilities
+    def get_epigram(self, epigram_uuid):
+        """ The EpigramRecord with this uuid, or None """
+        return self._first(" where epigram_uuid = ?", [epigram_uuid])
 
-        :return: the bucket_id to use in the get epigram query
-        """
+    def get_buckets(self):
+        """ All the buckets, as BucketRecord tuples """
+        return [BucketRecord(*row) for row in self._conn.execute(
+            "select bucket_id, name, item_weight from bucket order by bucket_id")]
 
-        rs = []
+    def get_impression_count(self, bucket_name=None):
+        """ The number of impressions, including the journaled ones
 
-        with self._engine.connect() as conn:
-            rs = conn.exec_driver_sql("""
-            select bucket_id, effective_impression_percentage from impressions_calculated 
-             where impression_delta >= 0
-            """).all()
+            Keyword Arguments:
+            bucket_name (str) - constrain to a single bucket
+        """
+        buckets = {b.bucket_id for b in self.get_buckets()
+                   if bucket_name is None or b.name == bucket_name}
 
-        buckets = []
-        probabilties = []
+        (count, ) = self._conn.execute("""
+            select count(1) from impression join bucket using (bucket_id)
+             where ? is null or bucket.name = ?
+            """, (bucket_name, bucket_name)).fetchone()
+        if self._journal is not None:
+            count += sum(1 for (uuid, bucket_id, date) in self._journal.entries() if bucket_id in buckets)
+        return count
 
-        for row in rs:
-            buckets.append(row[0])
-            probabilties.append(row[1])
+    def compact(self):
+        """ Write the journaled impressions to the database
 
-        try:
-            bucket = random.choices(buckets, weights=probabilties)[0]
-            return bucket
-        except:
-            return None
+            Return:
+            the number of impressions compacted
+        """
+        self._pending = []
+        return ImpressionJournal(self._filename).compact(self._conn)
 
-    def get_epigram_impression(self, uuid=None, internal_fetch_ratio=0.1, force_random=True, bucket_name=None,
-                               bucket=None):
-        """ Get a epigram considering filter criteria and weight rules
+    def get_epigram_impression(self, internal_fetch_ratio=0.1, force_random=True, bucket_name=None,
+                               max_length=MAX_CONTENT_LENGTH):
+        """ Get a epigram considering filter criteria and weight rules, and record the impression
 
             Keyword Arguments:
-            uuid (str) - return this specific epigram
             internal_fetch_ratio (int) - see the README.adoc for info on the
                                                   weighting algorithm
             bucket_name (str) - the natural key for the buckets
-            bucket - a bucket object
+            max_length (int) - only epigrams shorter than this are selected,
+                               None disables the filter
 
             Return:
-            An Epigram (obviously)
+            An ImpressionRecord, which isn't saved if nothing matched
         """
-        q = self._session.query(Epigram).join(Bucket) \
-            .filter(func.length(Epigram.content) < 300) \
-            .order_by(Epigram.last_impression_date.asc())
+        if self._journal is not None:
+            return retry_on_busy(lambda: self._get_journaled_impression(
+                internal_fetch_ratio, force_random, bucket_name, max_length))
 
-        if bucket_name is not None:
-            q = q.filter(Bucket.name == bucket_name)
-        else:
-            bucket = self._get_weighted_bucket()
-            if bucket is not None:
-                q = q.filter_by(bucket_id=bucket)
+        imps = retry_on_busy(lambda: self._get_impressions(
+            1, internal_fetch_ratio, force_random, bucket_name, max_length))
+        return imps[0] if imps else self._no_results()
+
+    def get_epigram_impressions(self, count, internal_fetch_ratio=0.1, force_random=True, bucket_name=None,
+                                max_length=MAX_CONTENT_LENGTH):
+        """ Select up to count epigrams, as if get_epigram_impression was called count
+            times, and record all of their impressions in one transaction
 
-        if force_random == True:
-            rowCount = q.count() * internal_fetch_ratio * random.random()
-            log.debug(f"offsetting by %s rows" % rowCount)
-            q = q.offset(int(rowCount))
+            Positional Arguments:
+            count (int) - the number of epigrams to select
 
-        # x = q.first()
-        x = q.first()
+            Keyword Arguments:
+            see get_epigram_impression
+
+            Return:
+            A list of ImpressionRecord, shorter than count if the matching epigrams ran out
+        """
+        if self._journal is not None:
+            imps = []
+            for x in range(count):
+                imp = self.get_epigram_impression(internal_fetch_ratio, force_random, bucket_name, max_length)
+                if imp.epigram_uuid is None:
+                    break
+                imps.append(imp)
+            return imps
+
+        return retry_on_busy(lambda: self._get_impressions(
+            count, internal_fetch_ratio, force_random, bucket_name, max_length))
+
+    def _get_impressions(self, count, internal_fetch_ratio, force_random, bucket_name, max_length):
+        queued = self._queue_size > 0 and bucket_name is None
+        selection = (max_length, internal_fetch_ratio, int(force_random))
+
+        self._conn.execute("begin immediate")
+        try:
+            imps = []
+            for n in range(count):
+                x = self._pop_queue(selection) if queued else None
+                if x is None:
+                    x = self._select(internal_fetch_ratio, force_random, bucket_name, max_length)
+                log.debug(f"Retrieved Epigram {x}")
+                if x is None:
+                    break
+                imps.append(self._add_impression(x))
+
+            if queued and imps and self.queue_length() <= self._queue_size // 4:
+                self._fill_queue(selection)
+
+            self._conn.execute("commit")
+            return imps
+        except BaseException:
+            self._conn.execute("rollback")
+            raise
+
+    def _get_journaled_impression(self, internal_fetch_ratio, force_random, bucket_name, max_length):
+        self._pending = self._journal.entries()
+        if len(self._pending) >= self.COMPACT_AFTER:
+            self.compact()
+
+        # a read transaction, so the selection sees one snapshot
+        self._conn.execute("begin")
+        try:
+            x = self._select(internal_fetch_ratio, force_random, bucket_name, max_length)
+        finally:
+            self._conn.execute("commit")
+
+        if x is None and self._pending:
+            # everything that matches is in the journal, start over from the database
+            self.compact()
+            return self._get_journaled_impression(internal_fetch_ratio, force_random, bucket_name,
+                                                  max_length)
 
         log.debug(f"Retrieved Epigram {x}")
         if x is None:
-            return Impression(epigram=self.NO_RESULTS_FOUND)
-        else:
-            imp = self.add_impression(x)
-            return imp
+            return self._no_results()
 
-    def get_last_impression(self):
-        q = self._session.query(Impression).join(Epigram) \
-            .order_by(Epigram.last_impression_date.desc())
-        return q.first()
+        return self._journal_impression(x)
 
-    def add_epigram(self, epigram):
-        """ Add an epigram to the store
+    def _journal_impression(self, x):
+        now = str(datetime.datetime.now())
+        self._journal.append(x.epigram_uuid, x.bucket_id, now)
+        self._pending.append((x.epigram_uuid, x.bucket_id, now))
+        self._count_impression(x.bucket_id)
+        return ImpressionRecord(None, x.epigram_uuid, x.bucket_id, now, x._replace(last_impression_date=now))
 
-        Positional Arguments:
-        epigram - the epigram to add
-
-        Returns: the newly generated epigram
+    def show_epigram(self, epigram_uuid):
+        """ Record an impression of a particular epigram, e.g. a search result
 
+            Return:
+            An ImpressionRecord, or None if there is no such epigram
         """
-        solo = SoloEpigramImporter(epigram)
-        self.add_epigrams_via_importer(solo)
+        if self._journal is not None:
+            x = self.get_epigram(epigram_uuid)
+            return None if x is None else self._journal_impression(x)
+
+        return retry_on_busy(lambda: self._show_epigram(epigram_uuid))
+
+    def _show_epigram(self, epigram_uuid):
+        self._conn.execute("begin immediate")
+        try:
+            x = self.get_epigram(epigram_uuid)
+            imp = None if x is None else self._add_impression(x)
+            self._conn.execute("commit")
+            return imp
+        except BaseException:
+            self._conn.execute("rollback")
+            raise
 
-    def add_epigrams_via_importer(self, importer):
-        """ Method that does stuff
+    def search(self, query, limit=10, offset=0, bucket_name=None):
+        """ Full text search of the epigram content, best matches first
+
+            Every word of the query has to match, after stemming ("fishing" finds
+            "fish").  The words are quoted, so FTS5 query syntax isn't interpreted.
 
             Positional Arguments:
-            content (str) - the plain text content of the epigram
+            query (str) - the words to look for
 
             Keyword Arguments:
-            uuid (str) - a unique id for the item (generated if blank)
+            limit (int) - the page size
+            offset (int) - the number of results to skip
+            bucket_name (str) - only search this bucket
 
             Return:
-            object (str) - desc
+            A list of SearchResult, rank is the bm25 score (lower is better)
         """
-        for e in importer.process():
-            log.debug("Inserting Epigram " + str(e))
-            self._session.add(e)
-        self._session.commit()
+        match = self._match_expression(query)
+        if match is None:
+            return []
+
+        return [SearchResult(EpigramRecord(*row[:5]), *row[5:]) for row in self._conn.execute("""
+            select e.epigram_uuid, e.bucket_id, e.content, e.content_length, e.last_impression_date,
+                   b.name, epigram_fts.rank, snippet(epigram_fts, 0, '[', ']', '...', 12)
+              from epigram_fts
+              join epigram e on e.rowid = epigram_fts.rowid
+              left join bucket b on b.bucket_id = e.bucket_id
+             where epigram_fts match ? and (? is null or b.name = ?)
+             order by epigram_fts.rank, e.epigram_uuid
+             limit ? offset ?
+            """, (match, bucket_name, bucket_name, limit, offset))]
+
+    def count_matches(self, query, bucket_name=None):
+        """ The number of epigrams search() would find, for paging """
+        match = self._match_expression(query)
+        if match is None:
+            return 0
+
+        return self._conn.execute("""
+            select count(1)
+              from epigram_fts
+              join epigram e on e.rowid = epigram_fts.rowid
+              left join bucket b on b.bucket_id = e.bucket_id
+             where epigram_fts match ? and (? is null or b.name = ?)
+            """, (match, bucket_name, bucket_name)).fetchone()[0]
+
+    def rebuild_search_index(self):
+        """ Re-index all the content, e.g. after a VACUUM renumbered the epigram rowids """
+        retry_on_busy(lambda: self._conn.execute("insert into epigram_fts (epigram_fts) values ('rebuild')"))
+
+    @staticmethod
+    def _match_expression(query):
+        words = query.split()
+        if not words:
+            return None
+        return " ".join('"' + word.replace('"', '""') + '"' for word in words)
 
-    def add_impression(self, epigram):
-        """ Add the impression for the epigram
+    def find_near_duplicates(self):
+        """ Scan every epigram for near duplicates without changing the store, the
+            index is built in a temporary table
 
-            Positional Arguments:
-            epigram (Epigram) - the epigram viewed
-        """
-        imp = Impression(epigram=epigram)
-        log.debug(f"Impression tracked - {imp}")
-        epigram.last_impression_date = datetime.datetime.now()
-        self._session.add(imp)
-        self._session.commit()
-        return imp
-
-    def get_impression_count(self, bucket_name=None, unique=False):
+            Return:
+            A list of NearDuplicate, in the order the epigrams were imported
         """
-        This function will retrieve a count of the impressions.  By default,
-        it will return the number of all impressions.  You can filter via
-        these keyword arguments:
+        self._conn.execute("begin")
+        try:
+            self._conn.execute("create temp table epigram_lsh_scan (band_key integer not null, "
+                               "epigram_uuid text not null)")
+            self._conn.execute("create index temp.ix_epigram_lsh_scan on epigram_lsh_scan (band_key)")
+            return NearDuplicateIndex(self._conn, table="temp.epigram_lsh_scan").scan()
+        finally:
+            self._conn.execute("rollback")
+
+    def dedupe(self):
+        """ Rebuild the near duplicate index from scratch and link every near duplicate
+            to its canonical epigram.  This holds the write lock for the whole scan.
 
-        * epigram_uuid (not implemented)
-        * bucket_name (str) - constrain to a single bucket
-        * unique (bool) - only count unique impressions
+            Return:
+            A list of NearDuplicate
         """
+        return retry_on_busy(self._dedupe)
 
-        q = self._session.query(Impression).join(Bucket)
+    def _dedupe(self):
+        self._conn.execute("begin immediate")
+        try:
+            self._conn.execute("delete from epigram_lsh")
+            self._conn.execute("update epigram set canonical_uuid = null where canonical_uuid is not null")
+            index = NearDuplicateIndex(self._conn)
+            duplicates = index.scan()
+            index.link(duplicates)
+            index.mark_indexed()
+            # the recency of whole groups may have changed
+            self._conn.execute("delete from selection_queue")
+            self._conn.execute("""
+                update store_generation set generation = generation + 1,
+                       modified = cast(strftime('%s', 'now') as integer)
+                """)
+            self._conn.execute("commit")
+            return duplicates
+        except BaseException:
+            self._conn.execute("rollback")
+            raise
+
+    def _no_results(self):
+        return ImpressionRecord(None, None, self.NO_RESULTS_FOUND.bucket_id, None, self.NO_RESULTS_FOUND)
+
+    def _select(self, internal_fetch_ratio, force_random, bucket_name, max_length):
+        where = " where bucket_id is not null"
+        params = []
+
+        if self._pending:
+            where += " and epigram_uuid not in (select value from json_each(?))"
+            params.append(json.dumps([epigram_uuid for (epigram_uuid, bucket_id, date) in self._pending]))
+
+        if max_length is not None:
+            where += " and content_length < ?"
+            params.append(max_length)
 
         if bucket_name is not None:
-            q = q.filter(Bucket.name == bucket_name)
+            where += " and bucket_id in (select bucket_id from bucket where name = ?)"
+            params.append(bucket_name)
+        else:
+            bucket = self._bucket_sampler().choose()
+            if bucket is not None:
+                where += " and bucket_id = ?"
+                params.append(bucket)
 
-        return q.count()
+        return self._select_epigram(where, params, internal_fetch_ratio, force_random)
 
-    def get_bucket(self, bucket_name):
+    def _bucket_sampler(self):
+        """ A BucketSampler of get_bucket_stats(), kept between selections.  This store's
+            own impressions are counted into it as they are recorded, so it is rebuilt
+            only when the generation moves or the impressions are not the ones it
+            counted (another process showed an epigram, or a savepoint rolled back)
         """
-        Retrieve the Bucket specified by the name
-
-        :return: a Bucket object
+        key = self._conn.execute("""
+            select generation, (select ifnull(max(impression_id), 0) from impression)
+              from store_generation
+            """).fetchone() + (len(self._pending), )
+        if key != self._sampler_key:
+            self._sampler = BucketSampler(self.get_bucket_stats())
+            self._sampler_key = key
+        return self._sampler
+
+    def _count_impression(self, bucket_id, impression_id=None):
+        """ Count an impression this store just recorded, with its impression_id or
+            journaled, in the sampler.  The sampler is dropped instead if anything
+            else was recorded since it last counted
         """
-        return self._session.query(Bucket).filter(Bucket.name == bucket_name).first()
+        if self._sampler is None:
+            return
 
-    def get_buckets(self):
-        """
-        Retrieve all the Buckets in the system
-        """
-        return self._session.query(Bucket).all()
+        (generation, last_id, pending) = self._sampler_key
+        if impression_id is not None:
+            (counted, key) = (impression_id == last_id + 1, (generation, impression_id, pending))
+        else:
+            (counted, key) = (len(self._pending) == pending + 1, (generation, last_id, len(self._pending)))
 
-    def commit(self):
-        return self._session.commit()
+        if not counted:
+            self._sampler = self._sampler_key = None
+            return
+        if bucket_id in self._sampler:
+            self._sampler.add_impression(bucket_id)
+        self._sampler_key = key
 
+    def _select_epigram(self, where, params, internal_fetch_ratio, force_random):
+        """ The same keyset seeks as EpigramStore._select_epigram """
+        oldest = self._first(where, params)
 
-class FIM():
-    _db = None
+        if oldest is None or not force_random:
+            return oldest
 
-    """ This class """
-    pass
+        if oldest.last_impression_date is None:
+            x = self._first(where + " and last_impression_date is null and epigram_uuid >= ?",
+                            params + [random_pivot()])
+            # wrap around to the smallest uuid
+            return oldest if x is None else x
 
-    def __init__(self, **kwargs):
-        self._load_db()
+        (newest, ) = self._conn.execute(
+            "select last_impression_date from epigram" + where +
+            " order by last_impression_date desc limit 1", params).fetchone()
+        cutoff = impression_cutoff(oldest.last_impression_date, newest,
+                                   internal_fetch_ratio * random.random())
+        if cutoff is None:
+            return oldest
 
-    def _load_db(self):
-        CONTAINER_PATH = "/var/fim/fim.db"
-        HOME_DIR = str(Path.home()) + "/.fim/fim.db"
+        x = self._first(where + " and last_impression_date >= ?", params + [cutoff])
+        return oldest if x is None else x
 
-        if os.path.exists(CONTAINER_PATH):
-            # this is a container with a mounted fim dir
-            self._db = EpigramStore(CONTAINER_PATH)
-        elif os.path.exists(HOME_DIR):
-            self._db = EpigramStore(HOME_DIR)
-        else:
-            # This means we are running inside of the container
-            self._db = EpigramStore("/app/fim.db", force_random=True)
+    def queue_length(self):
+        return self._conn.execute("select count(1) from selection_queue").fetchone()[0]
+
+    def _impression_total(self):
+        return self._conn.execute("select ifnull(sum(impression_count), 0) from bucket_stats").fetchone()[0]
+
+    def upcoming_epigrams(self, count=None, internal_fetch_ratio=0.1, force_random=True,
+                          max_length=MAX_CONTENT_LENGTH):
+        """ The epigrams the next unfiltered selections will show, in order.
+
+            The selection queue is topped up to count, so with a queue_size these are
+            exactly what get_epigram_impression pops next, unless impressions are
+            recorded or the content changes in between.
+
+            Keyword Arguments:
+            count (int) - how many, defaults to queue_size
+            the rest as get_epigram_impression
+
+            Return:
+            A list of EpigramRecord
+        """
+        selection = (max_length, internal_fetch_ratio, int(force_random))
+        return retry_on_busy(lambda: self._upcoming(count or self._queue_size, selection))
+
+    def _upcoming(self, count, selection):
+        self._conn.execute("begin immediate")
+        try:
+            # drops a queue made for other selections
+            self._queue_head(selection)
+            if self.queue_length() < count:
+                self._fill_queue(selection, count)
+            upcoming = self._queued()[:count]
+            self._conn.execute("commit")
+            return upcoming
+        except BaseException:
+            self._conn.execute("rollback")
+            raise
+
+    def _queue_head(self, selection):
+        """ The head row of the queue, or None if the queue is empty or stale for this
+            selection, in which case it is emptied
+        """
+        head = self._conn.execute("""
+            select q.position, q.max_length, q.internal_fetch_ratio, q.force_random, q.impression_total,
+                   e.epigram_uuid, e.bucket_id, e.content, e.content_length, e.last_impression_date
+              from selection_queue q join epigram e on e.epigram_uuid = q.epigram_uuid
+             order by q.position limit 1
+            """).fetchone()
+        if head is None:
+            return None
 
-    def import_fortune(self, path):
-        self._db.add_epigrams_via_importer(
-            FortuneFileImporter(path))
+        if tuple(head[1:4]) != selection or head[4] != self._impression_total():
+            log.debug("Discarding the stale selection queue")
+            self._conn.execute("delete from selection_queue")
+            return None
+        return head
 
-    def get_epigram_impression(self, bucket_name):
-        return self._db.get_epigram_impression(bucket_name=bucket_name)
+    def _pop_queue(self, selection):
+        """ Take the head of the queue if it is still valid for this selection
 
-    def get_last_impression(self):
-        return self._db.get_last_impression()
+            Return:
+            An EpigramRecord, or None if the queue is empty or stale
+        """
+        head = self._queue_head(selection)
+        if head is None:
+            return None
+
+        self._conn.execute("delete from selection_queue where position = ?", (head[0], ))
+        return EpigramRecord(*head[5:])
 
-    def save_gpt_output(self, impression: Impression, output):
-        impression.gpt_completion = output
-        self.commit_db()
+    def _queued(self):
+        return [EpigramRecord(*row) for row in self._conn.execute("""
+            select e.epigram_uuid, e.bucket_id, e.content, e.content_length, e.last_impression_date
+              from selection_queue q join epigram e on e.epigram_uuid = q.epigram_uuid
+             order by q.position
+            """)]
 
-    def commit_db(self):
-        self._db.commit()
+    def _fill_queue(self, selection, size=None):
+        """ Top the queue back up to size, queue_size by default.  The queued epigrams are
+            replayed and the new selections made inside a savepoint, which is then rolled
+            back, so nothing but the queue rows is written.
+        """
+        (max_length, internal_fetch_ratio, force_random) = selection
+        queued = self._queued()
+        total = self._impression_total() + len(queued)
+
+        picks = []
+        self._conn.execute("savepoint fill_queue")
+        try:
+            for x in queued:
+                self._add_impression(x)
+
+            for n in range((size or self._queue_size) - len(queued)):
+                x = self._select(internal_fetch_ratio, force_random, None, max_length)
+                if x is None:
+                    break
+                self._add_impression(x)
+                picks.append(x.epigram_uuid)
+        finally:
+            self._conn.execute("rollback to fill_queue")
+            self._conn.execute("release fill_queue")
+
+        log.debug(f"Queued {len(picks)} selections")
+        self._conn.executemany("""
+            insert into selection_queue
+                (epigram_uuid, max_length, internal_fetch_ratio, force_random, impression_total)
+            values (?, ?, ?, ?, ?)
+            """, [(uuid, max_length, internal_fetch_ratio, force_random, total + n)
+                  for (n, uuid) in enumerate(picks)])
+
+    def _first(self, where, params):
+        row = self._conn.execute(self.SELECT_COLUMNS + where + self.ORDER_BY, params).fetchone()
+        return None if row is None else EpigramRecord(*row)
+
+    def _add_impression(self, epigram):
+        # stored the way sqlite3 adapts datetimes for the ORM, "YYYY-MM-DD HH:MM:SS.ffffff"
+        now = str(datetime.datetime.now())
+
+        cursor = self._conn.execute("""
+            insert into impression (bucket_id, epigram_uuid, impression_date)
+            values ((select bucket_id from bucket where bucket_id = ?), ?, ?)
+            """, (epigram.bucket_id, epigram.epigram_uuid, now))
+        self._conn.execute("update epigram set last_impression_date = ? where epigram_uuid = ?",
+                           (now, epigram.epigram_uuid))
+
+        self._count_impression(epigram.bucket_id, cursor.lastrowid)
+
+        log.debug(f"Impression tracked - {epigram.epigram_uuid}")
+        return ImpressionRecord(cursor.lastrowid, epigram.epigram_uuid, epigram.bucket_id, now,
+                                epigram._replace(last_impression_date=now))
 
 
 def console(args):
     print("console")
 
 class OpenAI():
+    """ A chat with an OpenAI compatible chat completions endpoint, with explanations
+        of epigrams cached in the EpigramStore.
+
+    Positional Arguments:
+    - api_key (str) - the bearer token
+
+    Keyword Arguments:
+    - base_url (str) - the API root, defaults to $OPENAI_BASE_URL or BASE_URL
+    - cache (EpigramStore) - where explanations are cached, None disables the cache
+    - cache_ttl (float) - re-explain epigrams explained more than this many seconds ago
+    - cache_size (int) - the number of explanations cached
+    - rate_limiter (RateLimiter) - shared by clients that must stay under one rate limit
+    """
     EXPLAIN_PROMPT = """
     This output is from an application that is designed to display pithy, insightful, meaningful epigrams to users.  
     Please explain this epigram, including any information about individuals referenced within, explaining the humor, 
     identifying the origin.  If possible, cite any references of this in popular culture. 
     """
+    # bump this when EXPLAIN_PROMPT changes, explanations from the old prompt are then ignored
+    PROMPT_VERSION = 1
 
     MODEL = 'gpt-3.5-turbo'
     #MODEL = 'gpt-4'
 
-    def __init__(self, api_key):
-        openai.api_key = api_key
+    BASE_URL = "https://api.openai.com/v1"
+    # seconds
+    TIMEOUT = 60
+    CACHE_SIZE = 1000
+    # rate limited (429) and server error responses are retried with exponential backoff
+    RETRIES = 3
+    BACKOFF = 1.0
+
+    def __init__(self, api_key, base_url=None, cache=None, cache_ttl=None, cache_size=CACHE_SIZE,
+                 rate_limiter=None):
+        self._api_key = api_key
+        self._base_url = (base_url or os.environ.get("OPENAI_BASE_URL") or self.BASE_URL).rstrip("/")
+        self._cache = cache
+        self._cache_ttl = cache_ttl
+        self._cache_size = cache_size
+        self._rate_limiter = rate_limiter
         self.messages = []
 
-    def complete_epigram(self, epigram):
-        self.messages.append({"role": "user", "content": self.EXPLAIN_PROMPT})
-        self.messages.append({"role": "user", "content": "The epigram comes from a file called " + epigram.bucket.name})
-        self.messages.append({"role": "user", "content": epigram.content})
+    def explain_messages(self, epigram):
+        """ The messages that ask for an explanation of the epigram """
+        return [{"role": "user", "content": self.EXPLAIN_PROMPT},
+                {"role": "user", "content": "The epigram comes from a file called " + epigram.bucket.name},
+                {"role": "user", "content": epigram.content}]
 
-        return self._send_message()
+    def cached_explanation(self, epigram):
+        """ The cached explanation of the epigram, or None """
+        if self._cache is None:
+            return None
+        return self._cache.get_completion(epigram, self.MODEL, self.PROMPT_VERSION, ttl=self._cache_ttl)
 
-    def chat(self, chat_prompt):
+    def cache_explanation(self, epigram, output):
+        if self._cache is not None:
+            self._cache.save_completion(epigram, self.MODEL, self.PROMPT_VERSION, output,
+                                        max_entries=self._cache_size)
+
+    def complete_epigram(self, epigram, refresh=False, on_token=None):
+        """ Explain the epigram, from the cache unless refresh is set.  With on_token the
+            explanation is streamed, see _send_message, a cached one arrives in one piece
+        """
+        self.messages.extend(self.explain_messages(epigram))
+
+        if not refresh:
+            output = self.cached_explanation(epigram)
+            if output is not None:
+                log.debug(f"Cached explanation of {epigram.epigram_uuid}")
+                # a chat carries on from it as if it had just been sent
+                self.messages.append({"role": "assistant", "content": output})
+                if on_token is not None:
+                    on_token(output)
+                return output
+
+        output = self._send_message(on_token)
+        self.cache_explanation(epigram, output)
+        return output
+
+    def chat(self, chat_prompt, on_token=None):
         self.messages.append({"role": "user", "content": chat_prompt})
-        return self._send_message()
+        return self._send_message(on_token)
+
+    def _send_message(self, on_token=None):
+        """ Send the conversation and add the reply to it.  With on_token the reply is
+            streamed, on_token(text) is called as each piece arrives
+
+            Return:
+            the whole reply
+        """
+        body = {"model": self.MODEL, "messages": self.messages}
+        if on_token is not None:
+            body["stream"] = True
+
+        with self._post(body) as response:
+            if on_token is None:
+                completion = json.load(response)
+                log.debug(completion)
+                content = completion["choices"][0]["message"]["content"]
+            else:
+                content = "".join(self._stream(response, on_token))
+
+        self.messages.append({"role": "assistant", "content": content})
+        return content
+
+    @staticmethod
+    def _stream(response, on_token):
+        """ Read the server-sent events of a streamed completion, yielding the content """
+        for line in response:
+            line = line.decode("utf-8").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+
+            token = json.loads(data)["choices"][0].get("delta", {}).get("content")
+            if token:
+                on_token(token)
+                yield token
+
+    def _post(self, body):
+        """ POST to the chat completions endpoint, retrying rate limits and server errors
+
+            Return:
+            the open response
+        """
+        import urllib.error
+        import urllib.request
+
+        request = urllib.request.Request(
+            self._base_url + "/chat/completions",
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Authorization": f"Bearer {self._api_key}", "Content-Type": "application/json"})
+
+        for attempt in range(self.RETRIES + 1):
+            if self._rate_limiter is not None:
+                self._rate_limiter.wait()
+            try:
+                return urllib.request.urlopen(request, timeout=self.TIMEOUT)
+            except urllib.error.HTTPError as e:
+                if attempt == self.RETRIES or (e.code != 429 and e.code < 500):
+                    raise
+                delay = float(e.headers.get("Retry-After") or self.BACKOFF * 2 ** attempt)
+                log.warning(f"Chat completion failed with {e.code}, retrying in {delay}s")
+            except (urllib.error.URLError, TimeoutError) as e:
+                if attempt == self.RETRIES:
+                    raise
+                delay = self.BACKOFF * 2 ** attempt
+                log.warning(f"Chat completion failed with {e}, retrying in {delay}s")
+            time.sleep(delay)
+
+
+class RateLimiter():
+    """ Spaces calls to wait() at least 1 / rate seconds apart, across threads
+
+    Positional Arguments:
+    - rate (float) - calls per second
+    """
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        time.sleep(start - now)
 
-    def _send_message(self):
-        completion = openai.ChatCompletion.create(model=self.MODEL, messages=self.messages)
-        log.debug(completion)
-        choices = completion.choices[0]
-        # self.messages.append(completion.choices[0])
-        return completion.choices[0].message.content
 
+def prefetch_explanations(openai_api, store, epigrams, concurrency=4, rate=None, base_url=None,
+                          cache_ttl=None, refresh=False):
+    """ Fill the explanation cache for the epigrams that aren't in it yet.
 
-def context(openai_api, imp, chat=False):
-    gpt = OpenAI(openai_api)
-    output = gpt.complete_epigram(imp.epigram)
-    print(fmt(output))
+        The requests run on up to concurrency threads, spaced to at most rate per
+        second, and each is retried as OpenAI._send_message does.  Only this thread
+        touches the store.
+
+    Positional Arguments:
+    openai_api (str) - the API token
+    store (EpigramStore) - the explanation cache
+    epigrams (list) - Epigram instances, in the order they will be shown
+
+    Keyword Arguments:
+    concurrency (int) - the most requests in flight
+    rate (float) - the most requests per second, None for no limit
+    base_url (str) - see OpenAI
+    cache_ttl (float) - explanations older than this many seconds are fetched again
+    refresh (bool) - fetch them all again
+
+    Return:
+    the number of explanations fetched
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    gpt = OpenAI(openai_api, base_url=base_url, cache=store, cache_ttl=cache_ttl)
+    missing = epigrams if refresh else [e for e in epigrams if gpt.cached_explanation(e) is None]
+    log.info(f"Prefetching {len(missing)} of {len(epigrams)} explanations")
+    rate_limiter = RateLimiter(rate) if rate else None
+
+    def fetch(messages):
+        worker = OpenAI(openai_api, base_url=base_url, rate_limiter=rate_limiter)
+        worker.messages = messages
+        return worker._send_message()
+
+    fetched = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(fetch, gpt.explain_messages(e)): e for e in missing}
+        for future in as_completed(futures):
+            epigram = futures[future]
+            try:
+                output = future.result()
+            except Exception as e:
+                log.warning(f"Could not prefetch the explanation of {epigram.epigram_uuid}: {e}")
+                continue
+            gpt.cache_explanation(epigram, output)
+            fetched += 1
+    return fetched
+
+
+def context(openai_api, imp, chat=False, cache=None, refresh=False, cache_ttl=None):
+    gpt = OpenAI(openai_api, cache=cache, cache_ttl=cache_ttl)
+    formatter = StreamFormatter()
+    output = gpt.complete_epigram(imp.epigram, refresh=refresh,
+                                  on_token=lambda token: print(formatter.feed(token), end="", flush=True))
+    print(formatter.close())
     print()
 
     if chat:
+        from prompt_toolkit import prompt
         print(r'''
  
  ENTERING Chat Session ( quit ) to exit, Ctrl+Enter to send
         ''')
 
-    while chat:
-        input_prompt = prompt('Enter prompt: ', multiline=True, vi_mode=True)
+        while chat:
+            input_prompt = prompt('Enter prompt: ', multiline=True, vi_mode=True)
 
-        if input_prompt == "quit":
-            chat = False
-        else:
-            print()
-            print(fmt(gpt.chat(input_prompt)))
-            print()
+            if input_prompt == "quit":
+                chat = False
+            else:
+                print()
+                formatter = StreamFormatter()
+                gpt.chat(input_prompt, on_token=lambda token: print(formatter.feed(token), end="", flush=True))
+                print(formatter.close())
+                print()
+
+    return output
 
 
 def fmt(text, width=78, indent=2):
@@ -578,57 +1072,277 @@ def fmt(text, width=78, indent=2):
     return '\n'.join(formatted_lines)
 
 
+
+class StreamFormatter():
+    """ fmt() for text that arrives in pieces.  Each word is written as soon as the
+        whitespace after it arrives, and everything feed() and close() return,
+        joined, is exactly fmt() of the whole text.
+
+    Keyword Arguments:
+    - width (int) - as fmt
+    - indent (int) - as fmt
+    """
+
+    def __init__(self, width=78, indent=2):
+        self._width = width - indent
+        self._prefix = ' ' * indent + " > "
+        # the length fmt's current_line would have, words plus a space each
+        self._line_length = 0
+        self._word = []
+        self._lines = 0
+
+    def feed(self, text):
+        """ Return: the formatted text that is now settled """
+        out = []
+        for c in text:
+            if c == '\n':
+                self._end_word(out)
+                self._line_length = 0
+            elif c.isspace():
+                self._end_word(out)
+            else:
+                self._word.append(c)
+        return "".join(out)
+
+    def close(self):
+        """ Return: the rest of the formatted text """
+        out = []
+        self._end_word(out)
+        self._line_length = 0
+        return "".join(out)
+
+    def _new_line(self, out):
+        out.append(("\n" if self._lines else "") + self._prefix)
+        self._lines += 1
+
+    def _end_word(self, out):
+        if not self._word:
+            return
+        word = "".join(self._word)
+        self._word = []
+
+        if self._line_length + len(word) + 1 <= self._width:
+            if self._line_length == 0:
+                self._new_line(out)
+            else:
+                out.append(" ")
+        else:
+            if self._line_length == 0:
+                # fmt emits an empty line before a word too long for any line
+                self._new_line(out)
+            self._new_line(out)
+            self._line_length = 0
+        out.append(word)
+        self._line_length += len(word) + 1
+
+
+def search(db, query, bucket_name=None, limit=10, page=1, show=None):
+    """ Print a page of search results, numbered from 1 across pages, or show result
+        number show as an epigram """
+    if show is not None:
+        results = db.search(query, limit=1, offset=show - 1, bucket_name=bucket_name) if show > 0 else []
+        if not results:
+            print(f"There is no result {show}")
+            return
+        print_epigram(db.show_epigram(results[0].epigram.epigram_uuid).epigram)
+        return
+
+    offset = (page - 1) * limit
+    total = db.count_matches(query, bucket_name=bucket_name)
+    print()
+    for (n, result) in enumerate(db.search(query, limit=limit, offset=offset, bucket_name=bucket_name),
+                                 start=offset + 1):
+        print(f"{n:>5}. {' '.join(result.snippet.split())}  ({result.bucket_name})")
+    print()
+    print(f"{total} matches, page {page} of {max(1, -(-total // limit))}")
+
+
+def dedupe(db, report=False):
+    """ Link the near duplicates (or with report, just find them) and print them
+        grouped under the epigram they duplicate """
+    start = time.perf_counter()
+    duplicates = db.find_near_duplicates() if report else db.dedupe()
+    elapsed = time.perf_counter() - start
+
+    buckets = {b.bucket_id: b.name for b in db.get_buckets()}
+    groups = {}
+    for d in duplicates:
+        groups.setdefault(d.canonical_uuid, []).append(d)
+
+    def line(epigram_uuid):
+        x = db.get_epigram(epigram_uuid)
+        return f"{' '.join(x.content.split())[:60]}  ({buckets.get(x.bucket_id)})"
+
+    for (canonical_uuid, group) in groups.items():
+        print()
+        print(f"       {line(canonical_uuid)}")
+        for d in group:
+            print(f"  {d.similarity:.2f} {line(d.epigram_uuid)}")
+    print()
+    print(f"{len(duplicates)} near duplicates of {len(groups)} epigrams "
+          f"{'found' if report else 'linked'} in {elapsed:.1f}s")
+
+
 def print_epigram(epigram):
     print()
     print(epigram.content)
     print()
 
 
+def openai_token(args):
+    """ The OpenAI token from the command line, the environment or the fimrc """
+    if args.openai is not None:
+        openai_api = args.openai[0]
+    elif os.environ.get('OPENAI_ACCESS_TOKEN') is not None:
+        openai_api = os.environ['OPENAI_ACCESS_TOKEN']
+    else:
+        import toml
+        with open("fimrc") as f:
+            config = toml.load(f)
+        openai_api = config['main']['openai_token']
+
+    log.debug("OpenAI Token : " + openai_api)
+    return openai_api
+
+
+def add_gpt_cache_arguments(parser, default=None):
+    """ The explanation cache options, on the main parser and again (with
+        argparse.SUPPRESS defaults, so they don't clobber it) on the GPT commands """
+    parser.add_argument('--refresh', action='store_true', default=default or False,
+                        help="ask GPT again rather than using the cached explanation")
+    parser.add_argument('--cache-ttl', type=float, metavar='SECONDS', default=default,
+                        help="only use cached explanations younger than this")
+
+
 def main():
+    import argparse
+
     parser = argparse.ArgumentParser(prog='fim.py')
 
     parser.add_argument('--openai', nargs=1, help="Your OpenAI API Token")
     parser.add_argument('--gpt', help="Query ChatGPT to get context about this epigram", action="store_true")
+    add_gpt_cache_arguments(parser)
     parser.add_argument('--bucket', help="constrain searches to this bucket")
+    parser.add_argument('--max-length', type=int, default=MAX_CONTENT_LENGTH,
+                        help="only show epigrams shorter than this many characters")
+
+    parser.add_argument('--queue-size', type=int, default=FastEpigramStore.QUEUE_SIZE,
+                        help="precompute this many selections, 0 disables the selection queue")
+
+    parser.add_argument('--journal', action='store_true',
+                        help="append the impression to a journal instead of writing the database, "
+                             "see fim compact")
+
+    parser.add_argument('--pragma', action='append', metavar='NAME=VALUE',
+                        help="override a SQLite pragma, e.g. journal_mode=delete on NFS")
 
     subparsers = parser.add_subparsers(dest='command')
 
     import_parser = subparsers.add_parser('import')
     import_parser.add_argument('source_type', choices=['fortune'])
     import_parser.add_argument('path', help='path to the file or directory to import', metavar='PATH')
+    import_parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE,
+                               help='number of epigrams inserted per batch')
+    import_parser.add_argument('--force', action='store_true',
+                               help='re-read files even if the import manifest says they are unchanged')
+    import_parser.add_argument('--no-dedupe', dest='dedupe', action='store_false',
+                               help="don't look for near duplicates of the new epigrams, fim dedupe does it later")
+    import_parser.add_argument('--workers', type=int, default=1,
+                               help='number of processes used to parse the files')
 
     console_parser = subparsers.add_parser('console')
     console_parser.set_defaults(func=console)
 
     context_parser = subparsers.add_parser('context')
     context_parser.add_argument('--openai', nargs=1, help="Your OpenAI API Token")
+    add_gpt_cache_arguments(context_parser, argparse.SUPPRESS)
     # context_parser.add_argument('context_type', choices=['gpt','dalle'])
 
-    save_parser = subparsers.add_parser('save')
-    chat_parser = subparsers.add_parser('chat')
+    subparsers.add_parser('compact', help="write the journaled impressions to the database")
 
-    args = parser.parse_args()
+    prefetch_parser = subparsers.add_parser('prefetch', help="explain the next epigrams ahead of time")
+    prefetch_parser.add_argument('--openai', nargs=1, help="Your OpenAI API Token")
+    prefetch_parser.add_argument('--count', type=int, default=10, help="how many upcoming epigrams")
+    prefetch_parser.add_argument('--concurrency', type=int, default=4, help="the most requests in flight")
+    prefetch_parser.add_argument('--rate', type=float, metavar='PER_SECOND',
+                                 help="the most requests per second")
+    add_gpt_cache_arguments(prefetch_parser, argparse.SUPPRESS)
 
-    with open("fimrc") as f:
-        config = toml.load(f)
+    save_parser = subparsers.add_parser('save')
+    chat_parser = subparsers.add_parser('chat')
+    add_gpt_cache_arguments(chat_parser, argparse.SUPPRESS)
 
-    MAIN = 'main'
+    search_parser = subparsers.add_parser('search', help="full text search of the epigrams")
+    search_parser.add_argument('query', nargs='*', help='the words to look for', metavar='WORD')
+    search_parser.add_argument('--limit', type=int, default=10, help='results per page')
+    search_parser.add_argument('--page', type=int, default=1)
+    search_parser.add_argument('--show', type=int, metavar='N',
+                               help='show result N as an epigram, recording the impression')
+    search_parser.add_argument('--rebuild', action='store_true', help='re-index all the content first')
 
-    openai_env = os.environ['OPENAI_ACCESS_TOKEN']
-    if (args.openai != None):
-        openai_api = args.openai[0]
-    elif (openai_env != None):
-        openai_api = openai_env
-    else:
-        openai_api = config[MAIN]['openai_token']
+    dedupe_parser = subparsers.add_parser('dedupe', help="link near duplicate epigrams, so each is shown once")
+    dedupe_parser.add_argument('--report', action='store_true',
+                               help='only list the near duplicates, nothing is changed')
 
-    log.debug("OpenAI Token : " + openai_api)
+    fortune_parser = subparsers.add_parser('fortune')
+    fortune_parser.add_argument('path', help='fortune file or directory to read, nothing is imported',
+                                metavar='PATH')
 
-    fim = FIM()
+    args = parser.parse_args()
+    pragmas = dict(p.split("=", 1) for p in args.pragma or [])
+
+    if args.command == "fortune":
+        # no database, no config, just like the original
+        entry = FortuneFileReader(args.path).get_epigram()
+        print_epigram(entry if entry is not None else FortuneEntry(NO_RESULTS_FOUND_TEXT, None, None))
+        return
+
+    if args.command is None:
+        # the common case, one epigram without loading the ORM
+        db = FastEpigramStore(default_db_path(), queue_size=args.queue_size, journal=args.journal,
+                              pragmas=pragmas)
+        shown = db.get_epigram_impression(bucket_name=args.bucket, max_length=args.max_length)
+        print_epigram(shown.epigram)
+        db.close()
+        if not args.gpt or shown.epigram_uuid is None:
+            return
+
+    if args.command == "search":
+        db = FastEpigramStore(default_db_path(), journal=args.journal, pragmas=pragmas)
+        if args.rebuild:
+            db.rebuild_search_index()
+        search(db, " ".join(args.query), bucket_name=args.bucket, limit=args.limit, page=args.page,
+               show=args.show)
+        db.close()
+        return
+
+    if args.command == "dedupe":
+        db = FastEpigramStore(default_db_path(), pragmas=pragmas)
+        dedupe(db, report=args.report)
+        db.close()
+        return
+
+    if args.command == "compact" or ImpressionJournal(default_db_path()).entries():
+        # everything else reads the impression table, so bring it up to date
+        db = FastEpigramStore(default_db_path(), pragmas=pragmas)
+        log.info(f"Compacted {db.compact()} impressions")
+        db.close()
+        if args.command == "compact":
+            return
+
+    if args.command == "prefetch":
+        # the queue holds exactly what the default command will show next
+        db = FastEpigramStore(default_db_path(), queue_size=args.queue_size, pragmas=pragmas)
+        upcoming = db.upcoming_epigrams(args.count, max_length=args.max_length)
+        db.close()
+
+    from fim_store import FIM
+    fim = FIM(pragmas=pragmas)
 
     if args.command == "import":
         if args.source_type == 'fortune':
-            fim.import_fortune(args.path)
+            fim.import_fortune(args.path, batch_size=args.batch_size, force=args.force,
+                               workers=args.workers, dedupe=args.dedupe)
         else:
             raise NotImplemented()
     elif args.command == "console":
@@ -637,8 +1351,14 @@ def main():
         imp = fim.get_last_impression()
         print_epigram(imp.epigram)
         chatMode = True if args.command == "chat" else False
-        output = context(openai_api, imp, chat=chatMode)
+        output = context(openai_token(args), imp, chat=chatMode, cache=fim.db, refresh=args.refresh,
+                         cache_ttl=args.cache_ttl)
         fim.save_gpt_output(imp, output)
+    elif args.command == "prefetch":
+        epigrams = [fim.db.get_epigram(x.epigram_uuid) for x in upcoming]
+        fetched = prefetch_explanations(openai_token(args), fim.db, epigrams, concurrency=args.concurrency,
+                                        rate=args.rate, cache_ttl=args.cache_ttl, refresh=args.refresh)
+        log.info(f"Prefetched {fetched} explanations")
     elif args.command == "save":
         imp = fim.get_last_impression()
         imp.saved = True
@@ -649,10 +1369,9 @@ def main():
         print(" ********* SAVED *********")
 
     else:
-        e = fim.get_epigram_impression(args.bucket)
-        print_epigram(e.epigram)
-        if args.gpt:
-            context(openai_api, e)
+        # --gpt, the epigram was shown above from the same queue that prefetch explains
+        imp = fim.get_last_impression()
+        context(openai_token(args), imp, cache=fim.db, refresh=args.refresh, cache_ttl=args.cache_ttl)
 
 
 if __name__ == '__main__':
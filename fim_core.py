@@ -0,0 +1,811 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import uuid as uuid_stdlib
+import hashlib
+import logging
+import os
+import glob
+import re
+import mmap
+import random
+import struct
+import codecs
+import datetime
+import sqlite3
+import time
+from pathlib import Path
+from collections import namedtuple
+
+""" fim_core - what fim and fim_store share: the settings, the fortune file readers,
+    the SQLite helpers, the BucketSort math and the near duplicate index.  Both
+    import it, it imports neither, and like fim it only needs the standard library.
+"""
+
+log = logging.getLogger("fim.core")
+
+# epigrams this long (or longer) are skipped by default, they don't fit in a terminal
+MAX_CONTENT_LENGTH = 300
+# number of rows sent to executemany() at a time by the bulk import
+BULK_BATCH_SIZE = 2000
+NO_RESULTS_FOUND_TEXT = "Your princess is in another castle. (404: File Not Found) "
+# the migrations ship next to this module, not in the current directory
+SQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql")
+# set on every connection, in this order, see apply_pragmas().  busy_timeout comes first
+# so switching the journal mode waits on the other fims starting up.  WAL lets the other
+# fims read while one writes and with synchronous=normal a commit doesn't wait on fsync.
+# WAL needs shared memory, so use journal_mode=delete for a database on a network file system
+PRAGMAS = {
+    "busy_timeout": 5000,
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "mmap_size": 268435456,
+}
+# how many times a write that hit a locked database is retried, with exponential backoff
+BUSY_RETRIES = 5
+BUSY_BACKOFF = 0.01
+# near duplicates are found with MinHash signatures of word SHINGLE_SIZE-grams, split into
+# MINHASH_BANDS bands of MINHASH_ROWS values for locality sensitive hashing.  Epigrams that
+# share a band are compared exactly and linked when their Jaccard similarity is at least
+# NEAR_DUPLICATE_THRESHOLD.  With 8 bands of 4 a pair at 0.8 is a candidate 98% of the time
+SHINGLE_SIZE = 2
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4
+NEAR_DUPLICATE_THRESHOLD = 0.8
+
+
+def generate_uuid():
+    return str(uuid_stdlib.uuid4())
+
+
+def content_hash(content):
+    """ The deduplication key for an epigram's content """
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def scan_fortunes(buf):
+    """ Find the entries of a fortune file without splitting it into lines.
+
+        Entries are terminated by a line holding a single %, the delimiter lines are
+        found with find() so this works the same over str, bytes and mmap buffers.
+        Text after the last delimiter is not an entry (this matches the original
+        line by line parser).
+
+        Positional Arguments:
+        buf (str, bytes or mmap) - the contents of the fortune file
+
+        Return:
+        a generator of (offset, length, raw) where raw is the entry including its
+        trailing newline
+    """
+    if isinstance(buf, str):
+        newline, delimiter = "\n", "%"
+    else:
+        newline, delimiter = b"\n", b"%"
+    marker = newline + delimiter
+    size = len(buf)
+
+    start = 0
+    while start < size:
+        if buf[start:start + 1] == delimiter and buf[start + 1:start + 2] in (newline, buf[0:0]):
+            # the entry is empty, the delimiter line starts right here
+            end = start
+        else:
+            end = -1
+            i = buf.find(marker, start)
+            while i != -1:
+                if buf[i + 2:i + 3] in (newline, buf[0:0]):
+                    end = i + 1
+                    break
+                i = buf.find(marker, i + 1)
+
+            if end == -1:
+                return
+
+        yield start, end - start, buf[start:end]
+        start = end + 2
+
+
+# a line ends like it does for universal newlines in text mode
+LINE_END = re.compile(rb"\r\n|\r|\n")
+
+
+def scan_fortune_lines(buf, delimiter=b"%"):
+    """ scan_fortunes() for files with carriage returns.  Lines end at CRLF, CR or LF,
+        so a % followed by CRLF is a delimiter line too.  This walks the file a line
+        at a time, files without carriage returns take the faster find() path.
+
+        Positional Arguments:
+        buf (bytes or mmap) - the contents of the fortune file
+
+        Keyword Arguments:
+        delimiter (bytes) - the delimiter line, without its line ending
+
+        Return:
+        a generator of (offset, length, raw) in bytes, as for scan_fortunes()
+    """
+    size = len(buf)
+    start = pos = 0
+    while pos < size:
+        match = LINE_END.search(buf, pos)
+        (line_end, next_line) = (match.start(), match.end()) if match else (size, size)
+        if buf[pos:line_end] == delimiter:
+            yield start, pos - start, buf[start:pos]
+            start = next_line
+        pos = next_line
+
+
+def decode_fortune(raw, encoding="utf-8"):
+    """ The text of an entry found by scan_fortune_lines(), with its newlines translated """
+    return raw.decode(encoding).replace("\r\n", "\n").replace("\r", "\n").rstrip()
+
+
+def read_fortune_file(path, encoding="utf-8"):
+    """ Stream the entries of a fortune file from a memory map.
+
+        Files with carriage returns are scanned line by line instead and their
+        newlines translated, like the text mode reads of the original parser.
+
+        Positional Arguments:
+        path (str) - the fortune file
+
+        Return:
+        a generator of (offset, length, text) where offset and length are in bytes
+        and text is the stripped epigram
+    """
+    if os.path.getsize(path) == 0:
+        return
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if m.find(b"\r") != -1:
+            for (offset, length, raw) in scan_fortune_lines(m):
+                yield offset, length, decode_fortune(raw, encoding)
+            return
+
+        for (offset, length, raw) in scan_fortunes(m):
+            yield offset, length, raw.decode(encoding).rstrip()
+
+
+def list_fortune_files(uri):
+    """ The fortune files at uri, a single file or a directory of them.  strfile
+        indexes (.dat) that live next to the fortune files are not included.
+    """
+    if not os.path.exists(uri):
+        raise AttributeError(f"File {uri} does not exist")
+
+    # normalize this
+    uri = os.path.realpath(uri)
+
+    if os.path.isdir(uri):
+        # sorted, so buckets are always created in the same order
+        filenames = sorted(f for f in glob.glob(uri + "/*")
+                           if os.path.isfile(f) and not f.endswith(StrfileIndex.SUFFIX))
+        log.debug(filenames)
+        return filenames
+    elif os.path.isfile(uri):
+        return [uri]
+    else:
+        raise RuntimeError("Unexpected filetype for " + uri)
+
+
+class StrfileIndex():
+    """ The offset table of a fortune file, compatible with strfile(8) .dat files.
+
+        The .dat file is a header of five network order 32 bit integers (version,
+        number of strings, longest, shortest, flags) and the delimiter character,
+        followed by numstr + 1 offsets.  Entry i is read by seeking to its offset
+        and reading up to the next delimiter line, so one epigram can be fetched
+        without parsing the file.
+
+        Positional Arguments:
+        path (str) - the fortune file (not the .dat)
+    """
+    SUFFIX = ".dat"
+    VERSION = 2
+    HEADER = struct.Struct(">5I4s")
+    STR_RANDOM = 0x1
+    STR_ORDERED = 0x2
+    STR_ROTATED = 0x4
+    # entries are read in chunks of this many bytes
+    READ_SIZE = 4096
+
+    def __init__(self, path, numstr=0, longlen=0, shortlen=0, flags=0, delim=b"%",
+                 offsets=None, offset_width=4):
+        self.path = path
+        self.numstr = numstr
+        self.longlen = longlen
+        self.shortlen = shortlen
+        self.flags = flags
+        self.delim = delim
+        # None means the offsets are read on demand from the .dat file
+        self._offsets = offsets
+        self._offset_width = offset_width
+
+    @property
+    def dat_path(self):
+        return self.path + self.SUFFIX
+
+    @property
+    def rotated(self):
+        return bool(self.flags & self.STR_ROTATED)
+
+    @classmethod
+    def for_file(cls, path, create=True):
+        """ Load the .dat for the fortune file, building it if it is missing or
+            older than the fortune file.  If the .dat can't be written the index
+            is kept in memory.
+
+            Return:
+            a StrfileIndex, or None if there is no usable .dat and create is False
+        """
+        dat_path = path + cls.SUFFIX
+        if os.path.exists(dat_path) and os.path.getmtime(dat_path) >= os.path.getmtime(path):
+            return cls.load(path)
+
+        if not create:
+            return None
+
+        index = cls.build(path)
+        try:
+            index.save()
+        except OSError as e:
+            log.debug(f"Unable to write {dat_path}: {e}")
+        return index
+
+    @classmethod
+    def load(cls, path):
+        """ Read the header of path's .dat file, the offsets are read on demand """
+        dat_path = path + cls.SUFFIX
+        with open(dat_path, 'rb') as f:
+            header = f.read(cls.HEADER.size)
+        (version, numstr, longlen, shortlen, flags, stuff) = cls.HEADER.unpack(header)
+
+        # fortune-mod writes 32 bit offsets, the BSDs write 64 bit ones
+        table_size = os.path.getsize(dat_path) - cls.HEADER.size
+        offset_width = 8 if table_size == (numstr + 1) * 8 else 4
+
+        return cls(path, numstr=numstr, longlen=longlen, shortlen=shortlen, flags=flags,
+                   delim=stuff[:1], offset_width=offset_width)
+
+    @classmethod
+    def build(cls, path):
+        """ Index the fortune file with the streaming scanner, CRLF files included.
+            Like strfile, empty entries are not indexed and the last offset is the end
+            of the table """
+        offsets = []
+        lengths = []
+        end = 0
+
+        if os.path.getsize(path) > 0:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                # the same scan as read_fortune_file(), so the two agree on the entries
+                scan = scan_fortune_lines if m.find(b"\r") != -1 else scan_fortunes
+                for (offset, length, raw) in scan(m):
+                    # just past the delimiter line, whatever its line ending
+                    line_end = LINE_END.match(m, offset + length + 1)
+                    end = line_end.end() if line_end else offset + length + 1
+                    if raw.strip():
+                        offsets.append(offset)
+                        lengths.append(length)
+
+        return cls(path, numstr=len(offsets), longlen=max(lengths, default=0),
+                   shortlen=min(lengths, default=0), offsets=offsets + [end])
+
+    def save(self):
+        offsets = [self.offset(i) for i in range(self.numstr + 1)]
+        with open(self.dat_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.VERSION, self.numstr, self.longlen, self.shortlen,
+                                     self.flags, self.delim + b"\0\0\0"))
+            f.write(struct.pack(f">{len(offsets)}I", *offsets))
+
+    def offset(self, i):
+        """ The byte offset of entry i in the fortune file """
+        if self._offsets is not None:
+            return self._offsets[i]
+
+        width = self._offset_width
+        with open(self.dat_path, 'rb') as f:
+            f.seek(self.HEADER.size + i * width)
+            return int.from_bytes(f.read(width), "big")
+
+    def read(self, i, encoding="utf-8"):
+        """ Seek to entry i and read it up to the next delimiter line, which may end
+            in CRLF, CR or LF """
+        buf = b""
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset(i))
+            while True:
+                chunk = f.read(self.READ_SIZE)
+                buf += chunk
+                entry = next(scan_fortune_lines(buf, delimiter=self.delim), None)
+                # a delimiter at the very end of the chunk could still be the start of a longer line
+                if not chunk or (entry is not None and entry[1] + len(self.delim) < len(buf)):
+                    break
+
+        text = decode_fortune(buf if entry is None else entry[2], encoding)
+        if self.rotated:
+            text = codecs.encode(text, "rot13")
+        return text
+
+
+def parse_fortune_file(path):
+    """ Parse a whole fortune file into a list of epigrams, decoding rot13'd files.
+        This is the unit of work for the import worker processes.
+    """
+    # offensive fortunes are distributed rot13'd and flagged in their .dat
+    index = StrfileIndex.for_file(path, create=False)
+    rotated = index is not None and index.rotated
+
+    return [codecs.encode(snippet, "rot13") if rotated else snippet
+            for (offset, length, snippet) in read_fortune_file(path)]
+
+
+def list_sql_files(file_dir=SQL_DIR):
+    """ The numbered NNN_*.sql migrations as a sorted list of (version, path) """
+    uri = os.path.realpath(file_dir)
+
+    if os.path.isdir(uri):
+        sql_files = glob.glob(uri + "/*.sql")
+    elif os.path.isfile(uri):
+        sql_files = [uri]
+    else:
+        raise RuntimeError("FileNotFound: " + uri)
+
+    return sorted((int(os.path.basename(f).split("_")[0]), f) for f in sql_files)
+
+
+def default_db_path():
+    """ The database fim uses: a mounted container volume, the home dir or the image's own """
+    CONTAINER_PATH = "/var/fim/fim.db"
+    HOME_DIR = str(Path.home()) + "/.fim/fim.db"
+
+    if os.path.exists(CONTAINER_PATH):
+        # this is a container with a mounted fim dir
+        return CONTAINER_PATH
+    elif os.path.exists(HOME_DIR):
+        return HOME_DIR
+    else:
+        # This means we are running inside of the container
+        return "/app/fim.db"
+
+
+def apply_pragmas(conn, pragmas=None):
+    """ Configure a DB-API SQLite connection with PRAGMAS, overridden by `pragmas`
+
+        Positional Arguments:
+        conn - a sqlite3 connection
+
+        Keyword Arguments:
+        pragmas (dict) - name to value, e.g. {"journal_mode": "delete"}
+    """
+    settings = dict(PRAGMAS, **(pragmas or {}))
+    cursor = conn.cursor()
+    for (name, value) in settings.items():
+        if not name.isidentifier() or not _is_pragma_value(value):
+            raise ValueError(f"Invalid pragma {name}={value}")
+        cursor.execute(f"pragma {name} = {value}")
+    cursor.close()
+
+
+def _is_pragma_value(value):
+    """ An integer, negative ones included (cache_size=-20000), or a keyword like wal """
+    try:
+        int(value)
+        return True
+    except (TypeError, ValueError):
+        return str(value).replace("_", "").isalnum()
+
+
+def is_busy(error):
+    return "database is locked" in str(error) or "database is busy" in str(error)
+
+
+def retry_on_busy(fn, errors=(sqlite3.OperationalError, ), retries=None, on_retry=None):
+    """ Call fn(), calling it again (after on_retry()) if the database was locked.
+        busy_timeout already waits on locks, this covers the cases SQLite
+        refuses to wait on, like a read transaction upgrading to a write.
+
+        Positional Arguments:
+        fn - the transaction to run, it must be safe to repeat
+
+        Keyword Arguments:
+        errors (tuple) - the exception types that can mean busy
+        retries (int) - defaults to BUSY_RETRIES
+        on_retry - called before each retry, e.g. a session rollback
+
+        Return:
+        whatever fn() returns
+    """
+    retries = BUSY_RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except errors as e:
+            if attempt == retries or not is_busy(e):
+                raise
+            log.debug(f"Database is busy, retry {attempt + 1} of {retries}")
+            if on_retry is not None:
+                on_retry()
+            time.sleep(BUSY_BACKOFF * 2 ** attempt)
+
+
+def calculate_impressions(bucket_stats):
+    """
+    This is the python equivalent of the impressions_calculated view, computed from
+    the rows of bucket_stats.  The floating point operations are performed in the
+    same order as the view so the results are identical.  Like SQLite, a division
+    by zero (no impressions or no weighted epigrams yet) yields None.
+
+    :return: a list of (bucket_id, expected_weighted_percentage,
+             actual_impression_percentage, impression_delta,
+             effective_impression_percentage)
+    """
+    total_weighted_sum = float(sum(row[2] for row in bucket_stats))
+    total_impressions = float(sum(row[3] for row in bucket_stats))
+
+    rows = []
+    for (bucket_id, epigram_count, weighted_count, impression_count) in bucket_stats:
+        expected = None
+        actual = None
+        delta = None
+        effective = None
+
+        if total_weighted_sum != 0.0:
+            expected = float(weighted_count) / total_weighted_sum
+        if total_impressions != 0.0:
+            actual = impression_count / total_impressions
+        if expected is not None and actual is not None:
+            delta = expected - actual
+            effective = expected + delta
+
+        rows.append((bucket_id, expected, actual, delta, effective))
+
+    return rows
+
+
+class BucketSampler:
+    """
+    BucketSort(TM) as a reusable weighted sampler.  A bucket is eligible while its
+    share of the impressions is no more than its share of the weighted epigrams (the
+    impression_delta of the impressions_calculated view is >= 0) and eligible buckets
+    are drawn in proportion to their effective_impression_percentage, 2w/W - c/C for
+    a bucket with weighted_count w and impression_count c out of the totals W and C.
+
+    The weights live in a Fenwick tree, so a draw proposes a bucket in proportion to
+    w in O(log n) and accepts it with probability (2w/W - c/C) / (2w/W), which gives
+    exactly the effective distribution.  At least half of the proposals are accepted
+    whatever the counters are.  Changing one bucket's counters is O(log n) too, none
+    of the other buckets' entries depend on the totals.
+
+    Positional Arguments:
+    bucket_stats - rows of (bucket_id, epigram_count, weighted_count, impression_count)
+    """
+
+    def __init__(self, bucket_stats=()):
+        self._slots = {}
+        self._bucket_ids = []
+        self._weights = []
+        self._impressions = []
+        for (bucket_id, epigram_count, weighted_count, impression_count) in bucket_stats:
+            self._check(bucket_id, weighted_count, impression_count)
+            self._slots[bucket_id] = len(self._bucket_ids)
+            self._bucket_ids.append(bucket_id)
+            self._weights.append(weighted_count)
+            self._impressions.append(impression_count)
+
+        self.total_weight = sum(self._weights)
+        self.total_impressions = sum(self._impressions)
+
+        # the usual linear build, each node passes its sum on to its parent
+        self._tree = [0] + self._weights
+        for i in range(1, len(self._tree)):
+            parent = i + (i & -i)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self):
+        return len(self._bucket_ids)
+
+    def __contains__(self, bucket_id):
+        return bucket_id in self._slots
+
+    @staticmethod
+    def _check(bucket_id, weighted_count, impression_count):
+        # the counters are plain ints almost always, so those are let through first
+        if type(weighted_count) is int and type(impression_count) is int and \
+                weighted_count >= 0 and impression_count >= 0:
+            return
+        for (name, value) in (("weighted_count", weighted_count), ("impression_count", impression_count)):
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value < float("inf"):
+                raise ValueError(f"Bucket {bucket_id} has an invalid {name} of {value!r}")
+
+    def _prefix(self, i):
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def set_bucket(self, bucket_id, weighted_count=None, impression_count=None):
+        """ Add a bucket, or change the counters of one, in O(log n)
+
+            Keyword Arguments:
+            weighted_count - epigram_count * item_weight, None keeps the current value
+            impression_count - None keeps the current value
+        """
+        slot = self._slots.get(bucket_id)
+        if slot is None:
+            weighted_count = 0 if weighted_count is None else weighted_count
+            impression_count = 0 if impression_count is None else impression_count
+            self._check(bucket_id, weighted_count, impression_count)
+
+            slot = self._slots[bucket_id] = len(self._bucket_ids)
+            self._bucket_ids.append(bucket_id)
+            self._weights.append(0)
+            self._impressions.append(0)
+            # a new node covers itself and the slots below it down to its lowest bit
+            i = slot + 1
+            self._tree.append(self._prefix(i - 1) - self._prefix(i - (i & -i)))
+        else:
+            weighted_count = self._weights[slot] if weighted_count is None else weighted_count
+            impression_count = self._impressions[slot] if impression_count is None else impression_count
+            self._check(bucket_id, weighted_count, impression_count)
+
+        delta = weighted_count - self._weights[slot]
+        if delta:
+            self._weights[slot] = weighted_count
+            self.total_weight += delta
+            i = slot + 1
+            while i < len(self._tree):
+                self._tree[i] += delta
+                i += i & -i
+
+        self.total_impressions += impression_count - self._impressions[slot]
+        self._impressions[slot] = impression_count
+
+    def add_impression(self, bucket_id, count=1):
+        """ Count impressions of a bucket, in O(1) """
+        slot = self._slots.get(bucket_id)
+        if slot is None:
+            self.set_bucket(bucket_id, impression_count=count)
+        else:
+            self._impressions[slot] += count
+            self.total_impressions += count
+
+    def _find(self, u):
+        """ The first slot whose cumulative weight exceeds u """
+        slot = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            i = slot + step
+            if i < len(self._tree) and self._tree[i] <= u:
+                slot = i
+                u -= self._tree[i]
+            step >>= 1
+        return min(slot, len(self._bucket_ids) - 1)
+
+    def choose(self, rng=random):
+        """
+        Draw a bucket
+
+        Return:
+        a bucket_id, or None when there are no impressions or no weighted epigrams
+        yet, the same as the view's null deltas (no bucket is preferred then)
+        """
+        (w_total, c_total) = (self.total_weight, self.total_impressions)
+        if not w_total or not c_total:
+            return None
+
+        while True:
+            slot = self._find(rng.random() * w_total)
+            (w, c) = (self._weights[slot], self._impressions[slot])
+            # scaled by W * C: eligible when c/C <= w/W, accepted with 1 - (c/C) / (2w/W)
+            if c * w_total <= w * c_total and rng.random() * 2 * w * c_total < 2 * w * c_total - c * w_total:
+                return self._bucket_ids[slot]
+
+    def probabilities(self):
+        """ The chance choose() returns each bucket, computed in O(n)
+
+            Return:
+            A dict of bucket_id to probability, empty when choose() returns None
+        """
+        (w_total, c_total) = (self.total_weight, self.total_impressions)
+        if not w_total or not c_total:
+            return {}
+
+        effective = {bucket_id: 2 * w * c_total - c * w_total
+                     for (bucket_id, w, c) in zip(self._bucket_ids, self._weights, self._impressions)
+                     if c * w_total <= w * c_total}
+        total = sum(effective.values())
+        return {bucket_id: e / total for (bucket_id, e) in effective.items()}
+
+
+def choose_weighted_bucket(bucket_stats, rng=random):
+    """
+    Using the patented BucketSort(TM) Technology this factors in the relative
+    weights of each bucket compared to its actual impressions.  Buckets that have
+    exceeded their allowable view percentage are excluded from selection.
+
+    This is a single draw in one pass over the rows, with the same distribution as
+    BucketSampler.choose().  Callers that draw again and again should keep a
+    BucketSampler and count their impressions into it instead, building one costs
+    a few times this pass.  A negative or non numeric count raises ValueError.
+
+    :return: the bucket_id to use in the get epigram query, or None
+    """
+    for (bucket_id, epigram_count, weighted_count, impression_count) in bucket_stats:
+        BucketSampler._check(bucket_id, weighted_count, impression_count)
+    total_weight = sum(row[2] for row in bucket_stats)
+    total_impressions = sum(row[3] for row in bucket_stats)
+    if not total_weight or not total_impressions:
+        return None
+
+    # effective_impression_percentage scaled by W * C, see BucketSampler
+    buckets = []
+    weights = []
+    for (bucket_id, epigram_count, w, c) in bucket_stats:
+        if c * total_weight <= w * total_impressions:
+            buckets.append(bucket_id)
+            weights.append(2 * w * total_impressions - c * total_weight)
+
+    return rng.choices(buckets, weights=weights)[0]
+
+
+def random_pivot():
+    """ A uuid shaped key drawn from the random module (so seeding is honored) """
+    return str(uuid_stdlib.UUID(int=random.getrandbits(128)))
+
+
+def impression_cutoff(oldest, newest, fraction):
+    """ Interpolate an impression date `fraction` of the way from oldest to newest
+
+        :return: the cutoff in the same string format as the stored dates, or None
+                 if the dates cannot be parsed
+    """
+    try:
+        start = datetime.datetime.fromisoformat(str(oldest))
+        end = datetime.datetime.fromisoformat(str(newest))
+    except ValueError:
+        return None
+
+    cutoff = start + (end - start) * fraction
+    return cutoff.isoformat(sep=' ', timespec='microseconds')
+
+
+# a trailing "-- Author" line (and anything under it) isn't part of the epigram
+ATTRIBUTION = re.compile(r"\n[ \t]*(?:--|\u2014|~)[^\n]*(?:\n[^\n]*){0,2}\Z")
+WORD = re.compile(r"\w+")
+# one blake2b digest gives every 16 bit hash function of the signature at once, and each
+# band's MINHASH_ROWS values read as one 64 bit integer are its LSH key
+MINHASH = struct.Struct("<%dH" % (MINHASH_BANDS * MINHASH_ROWS))
+BAND_KEYS = struct.Struct("<%dq" % MINHASH_BANDS)
+
+
+def shingle(content, size=SHINGLE_SIZE):
+    """ The set of word n-grams of an epigram, ignoring case, punctuation, whitespace
+        and the attribution.  Epigrams shorter than size words are a single shingle.
+
+        :return: a set of str, empty if the content has no words
+    """
+    words = WORD.findall(ATTRIBUTION.sub("", content).lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[n:n + size]) for n in range(len(words) - size + 1)}
+
+
+def minhash(shingles):
+    """ The MinHash signature of a set of shingles, MINHASH_BANDS * MINHASH_ROWS values """
+    digests = [MINHASH.unpack(hashlib.blake2b(s.encode("utf-8"), digest_size=64).digest())
+               for s in shingles]
+    return tuple(map(min, zip(*digests)))
+
+
+def band_keys(signature):
+    """ The LSH keys of a signature, one signed 64 bit integer per band (which suits
+        SQLite).  Epigrams that share a key are near duplicate candidates """
+    return BAND_KEYS.unpack(MINHASH.pack(*signature))
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+NearDuplicate = namedtuple("NearDuplicate", ["epigram_uuid", "canonical_uuid", "similarity"])
+
+
+class NearDuplicateIndex():
+    """ Finds the epigrams that are nearly the same as one already in the store, the same
+        joke in two fortune files with different whitespace, punctuation or attribution.
+
+        Each canonical epigram (the first of its kind, by rowid) has its MinHash band
+        keys in the band table.  Looking up a new epigram is an index seek per band, and
+        the few candidates that share a band are compared exactly, so the cost does not
+        grow with the size of the store.  Near duplicates are not added to the table,
+        they are linked to their canonical epigram by link().
+
+    Positional Arguments:
+    - conn (sqlite3.Connection) - the database, nothing here commits
+
+    Keyword Arguments:
+    - table (str) - the band table, epigram_lsh or a temporary table for a dry run
+    - threshold (float) - the lowest Jaccard similarity that is a near duplicate
+    """
+
+    def __init__(self, conn, table="epigram_lsh", threshold=NEAR_DUPLICATE_THRESHOLD):
+        self._conn = conn
+        self._table = table
+        self._threshold = threshold
+        self._candidates = f"""
+            select distinct e.epigram_uuid, e.content
+              from {table} l join epigram e on e.epigram_uuid = l.epigram_uuid
+             where l.band_key in ({", ".join("?" * MINHASH_BANDS)})
+            """
+
+    def scan(self, first_rowid=1):
+        """ Index the epigrams from first_rowid on, in rowid order
+
+            Return:
+            A list of NearDuplicate, for the epigrams that matched one indexed before them
+        """
+        duplicates = []
+        rows = self._conn.execute("""
+            select epigram_uuid, content from epigram
+             where rowid >= ? and content is not null
+             order by rowid
+            """, (first_rowid, ))
+        for (epigram_uuid, content) in rows:
+            shingles = shingle(content)
+            if not shingles:
+                continue
+
+            keys = band_keys(minhash(shingles))
+            match = self._match(shingles, keys)
+            if match is not None:
+                duplicates.append(NearDuplicate(epigram_uuid, *match))
+            else:
+                self._conn.executemany(f"insert into {self._table} (band_key, epigram_uuid) values (?, ?)",
+                                       [(key, epigram_uuid) for key in keys])
+        return duplicates
+
+    def _match(self, shingles, keys):
+        """ The most similar indexed epigram, as (epigram_uuid, similarity), or None """
+        (best, best_similarity) = (None, self._threshold)
+        for (epigram_uuid, content) in self._conn.execute(self._candidates, keys):
+            similarity = jaccard(shingles, shingle(content))
+            if similarity > best_similarity or (best is None and similarity == best_similarity):
+                (best, best_similarity) = (epigram_uuid, similarity)
+        return None if best is None else (best, best_similarity)
+
+    def catch_up(self):
+        """ Index and link the epigrams added since the index last looked, see sql/078
+
+            Return:
+            A list of NearDuplicate
+        """
+        (indexed, ) = self._conn.execute("select indexed_rowid from epigram_lsh_sync").fetchone()
+        duplicates = self.scan(indexed + 1)
+        self.link(duplicates)
+        self.mark_indexed()
+        return duplicates
+
+    def mark_indexed(self):
+        self._conn.execute("update epigram_lsh_sync set indexed_rowid = (select ifnull(max(rowid), 0) from epigram)")
+
+    def link(self, duplicates):
+        """ Point the near duplicates at their canonical epigrams.  A group shares the
+            recency of its most recently shown member, see sql/073, so a joke already
+            shown counts as seen under every bucket it was imported into.
+        """
+        if not duplicates:
+            return
+
+        self._conn.executemany("update epigram set canonical_uuid = ? where epigram_uuid = ?",
+                               [(d.canonical_uuid, d.epigram_uuid) for d in duplicates])
+        # the trigger copies the canonical epigram's date to the rest of the group
+        self._conn.executemany("""
+            update epigram set last_impression_date =
+                   (select max(last_impression_date) from epigram
+                     where epigram_uuid = ?1 or canonical_uuid = ?1)
+             where epigram_uuid = ?1
+            """, [(canonical_uuid, ) for canonical_uuid in {d.canonical_uuid for d in duplicates}])
+        log.debug(f"Linked {len(duplicates)} near duplicates")
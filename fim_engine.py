@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import datetime
+import logging
+import queue
+import random
+import sqlite3
+import threading
+
+import numpy as np
+
+from fim import (
+    EpigramRecord,
+    ImpressionRecord,
+    FastEpigramStore,
+    write_impressions,
+)
+from fim_core import (
+    MAX_CONTENT_LENGTH,
+    BucketSampler,
+    apply_pragmas,
+    random_pivot,
+    retry_on_busy,
+)
+
+""" fim_engine - BucketSort held in NumPy arrays, for long running servers (app.py --engine memory)
+
+    NumPy is only needed by this module, the command line never imports it.
+"""
+
+log = logging.getLogger("fim.engine")
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+# last_impression_date of an epigram that has never been shown, it sorts first like NULL
+NEVER = np.iinfo(np.int64).min
+
+
+def to_micros(date):
+    """ A stored impression date (or a datetime) as microseconds since the epoch """
+    if isinstance(date, str):
+        date = datetime.datetime.fromisoformat(date)
+    return (date - EPOCH) // MICROSECOND
+
+
+class MemoryEpigramStore():
+    """ Select epigrams with BucketSort entirely in memory and write the impressions
+        through to SQLite in the background.
+
+        The per bucket counters (bucket_stats) and every epigram's bucket, length and
+        last impression are loaded into NumPy arrays at startup, with the epigrams
+        in uuid order so ties break the way the SQL ORDER BY does.  A selection is
+        the same weighted bucket choice and least recently shown seek as
+        FastEpigramStore, with the same calls into the random module, done as
+        vectorized operations over the bucket's slice of the arrays.
+
+        Impressions update the arrays at once and are queued for a writer thread,
+        which records them in batches with write_impressions.  The writer also
+        watches the database: when another connection commits (an import, a weight
+        change, a fim on the command line) the queue is flushed and the arrays are
+        reloaded.  Near duplicate groups share their recency, like sql/073.
+
+        The methods are thread safe and return the same records as FastEpigramStore,
+        without impression_ids (the rows don't exist yet).
+
+    Positional Arguments:
+    - filename (str) - the path to the SQLite database
+
+    Keyword Arguments:
+    - pragmas (dict) - overrides for PRAGMAS
+    """
+
+    NO_RESULTS_FOUND = FastEpigramStore.NO_RESULTS_FOUND
+    # the most impressions written in one transaction
+    WRITE_BATCH = 1000
+    # how often, in seconds, an idle writer checks for changes made by other connections
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self, filename, pragmas=None):
+        # migrates a new or old database
+        FastEpigramStore(filename, pragmas=pragmas).close()
+
+        self._lock = threading.Lock()
+        self._writes = queue.Queue()
+        self._conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        apply_pragmas(self._conn, pragmas)
+        self._load()
+
+        self._writer = threading.Thread(target=self._write_through, daemon=True, name="fim-engine-writer")
+        self._writer.start()
+
+    def _load(self):
+        """ Read the counters and the epigrams into the arrays, the caller holds the lock
+            (or is __init__) """
+        conn = self._conn
+        conn.execute("begin")
+        try:
+            (self._data_version, ) = conn.execute("pragma data_version").fetchone()
+            stats = conn.execute("""
+                select bucket_id, epigram_count, weighted_count, impression_count
+                  from bucket_stats order by bucket_id
+                """).fetchall()
+            buckets = conn.execute("select bucket_id, name from bucket").fetchall()
+            rows = conn.execute("""
+                select epigram_uuid, bucket_id, content, content_length, last_impression_date, canonical_uuid
+                  from epigram where bucket_id is not null order by epigram_uuid
+                """).fetchall()
+        finally:
+            conn.execute("commit")
+
+        self._stats = np.array(stats, dtype=np.int64).reshape(-1, 4)
+        self._bucket_position = {s[0]: n for (n, s) in enumerate(stats)}
+        # only the impressions move between reloads, the sampler counts them as they happen
+        self._sampler = BucketSampler(stats)
+        self._bucket_names = {}
+        for (bucket_id, name) in buckets:
+            self._bucket_names.setdefault(name, []).append(bucket_id)
+
+        # each bucket's epigrams are a contiguous slice of the arrays, in uuid order.  rank
+        # is the position in uuid order, which orders (and breaks ties) across buckets
+        self._sorted_uuids = [r[0] for r in rows]
+        order = sorted(range(len(rows)), key=lambda n: rows[n][1])
+        rows = [rows[n] for n in order]
+        self._rank = np.array(order, dtype=np.int64)
+        self._by_uuid = np.argsort(self._rank)
+        self._uuids = [r[0] for r in rows]
+        self._position = {epigram_uuid: n for (n, epigram_uuid) in enumerate(self._uuids)}
+        self._bucket = np.array([r[1] for r in rows], dtype=np.int64)
+        self._content = [r[2] for r in rows]
+        self._length = np.array([len(r[2] or "") if r[3] is None else r[3] for r in rows], dtype=np.int64)
+        self._last = np.array([NEVER if r[4] is None else to_micros(r[4]) for r in rows], dtype=np.int64)
+
+        (ids, starts) = np.unique(self._bucket, return_index=True)
+        ends = list(starts[1:]) + [len(rows)]
+        self._slices = {b: slice(int(s), int(e)) for (b, s, e) in zip(ids.tolist(), starts, ends)}
+        # the length filter is skipped for buckets without anything too long
+        self._longest = {b: int(self._length[s].max()) for (b, s) in self._slices.items()}
+
+        groups = {}
+        for (n, r) in enumerate(rows):
+            if r[5] is not None and r[5] in self._position:
+                groups.setdefault(self._position[r[5]], [self._position[r[5]]]).append(n)
+        self._groups = {}
+        for members in groups.values():
+            group = np.array(members)
+            for n in members:
+                self._groups[n] = group
+
+        log.debug(f"Loaded {len(rows)} epigrams in {len(stats)} buckets")
+
+    def close(self):
+        """ Write the queued impressions and stop the writer """
+        self._writes.put(None)
+        self._writer.join()
+        self._conn.close()
+
+    def flush(self):
+        """ Wait until every impression so far is in the database """
+        self._writes.join()
+
+    def get_bucket_stats(self):
+        """ The bucket_stats rows, including the impressions not written yet """
+        with self._lock:
+            return [tuple(s) for s in self._stats.tolist()]
+
+    def get_impression_count(self, bucket_name=None):
+        with self._lock:
+            if bucket_name is None:
+                return int(self._stats[:, 3].sum())
+            return sum(int(self._stats[self._bucket_position[b], 3])
+                       for b in self._bucket_names.get(bucket_name, []) if b in self._bucket_position)
+
+    def get_epigram_impression(self, internal_fetch_ratio=0.1, force_random=True, bucket_name=None,
+                               max_length=MAX_CONTENT_LENGTH):
+        """ Select an epigram and record the impression, see FastEpigramStore
+
+            Return:
+            An ImpressionRecord
+        """
+        imps = self.get_epigram_impressions(1, internal_fetch_ratio, force_random, bucket_name, max_length)
+        return imps[0] if imps else ImpressionRecord(None, None, self.NO_RESULTS_FOUND.bucket_id, None,
+                                                     self.NO_RESULTS_FOUND)
+
+    def get_epigram_impressions(self, count, internal_fetch_ratio=0.1, force_random=True, bucket_name=None,
+                                max_length=MAX_CONTENT_LENGTH):
+        """ Select up to count epigrams one after another, see FastEpigramStore
+
+            Return:
+            A list of ImpressionRecord, shorter than count if nothing else matches
+        """
+        imps = []
+        with self._lock:
+            for n in range(count):
+                x = self._select(internal_fetch_ratio, force_random, bucket_name, max_length)
+                if x is None:
+                    break
+                imps.append(self._add_impression(x))
+        return imps
+
+    def show_epigram(self, epigram_uuid):
+        """ Record an impression of a particular epigram
+
+            Return:
+            An ImpressionRecord, or None if there is no such epigram
+        """
+        with self._lock:
+            x = self._position.get(epigram_uuid)
+            return None if x is None else self._add_impression(x)
+
+    def _select(self, internal_fetch_ratio, force_random, bucket_name, max_length):
+        """ The position of the selected epigram, or None """
+        if bucket_name is not None:
+            scope = [self._slices[b] for b in self._bucket_names.get(bucket_name, []) if b in self._slices]
+            if len(scope) > 1:
+                positions = np.concatenate([np.arange(s.start, s.stop) for s in scope])
+                scope = positions[np.argsort(self._rank[positions])]
+            else:
+                scope = scope[0] if scope else None
+        else:
+            bucket = self._sampler.choose()
+            scope = self._by_uuid if bucket is None else self._slices.get(bucket)
+
+        if scope is None:
+            return None
+        if max_length is not None and not (isinstance(scope, slice) and
+                                           self._longest[int(self._bucket[scope.start])] < max_length):
+            keep = self._length[scope] < max_length
+            if not keep.all():
+                scope = (np.arange(scope.start, scope.stop) if isinstance(scope, slice) else scope)[keep]
+
+        x = self._select_epigram(scope, internal_fetch_ratio, force_random)
+        if x is None:
+            return None
+        return scope.start + int(x) if isinstance(scope, slice) else int(scope[x])
+
+    def _select_epigram(self, scope, internal_fetch_ratio, force_random):
+        """ The same keyset seeks as FastEpigramStore._select_epigram.  scope is a slice
+            or an array of positions, in uuid order
+
+            Return:
+            The offset of the selected epigram in scope, or None if it is empty
+        """
+        last = self._last[scope]
+        if not len(last):
+            return None
+        # argmin returns the first of equals, the smallest uuid
+        oldest = last.argmin()
+
+        if not force_random:
+            return oldest
+
+        if last[oldest] == NEVER:
+            unseen = np.flatnonzero(last == NEVER)
+            # the first unseen uuid at or after the pivot, wrapping around
+            n = self._rank[scope][unseen].searchsorted(bisect.bisect_left(self._sorted_uuids, random_pivot()))
+            return unseen[n] if n < len(unseen) else oldest
+
+        newest = last.max()
+        fraction = internal_fetch_ratio * random.random()
+        # the timedelta arithmetic of impression_cutoff, rounded the same way
+        span = datetime.timedelta(microseconds=int(newest - last[oldest])) * fraction
+        cutoff = last[oldest] + span // MICROSECOND
+
+        after = np.flatnonzero(last >= cutoff)
+        return after[last[after].argmin()]
+
+    def _add_impression(self, x):
+        now = datetime.datetime.now()
+        date = str(now)
+        micros = to_micros(now)
+
+        group = self._groups.get(x)
+        self._last[x if group is None else group] = micros
+
+        bucket_id = int(self._bucket[x])
+        if bucket_id in self._bucket_position:
+            self._stats[self._bucket_position[bucket_id], 3] += 1
+            self._sampler.add_impression(bucket_id)
+
+        epigram_uuid = self._uuids[x]
+        self._writes.put((epigram_uuid, bucket_id, date))
+        log.debug(f"Impression tracked - {epigram_uuid}")
+        return ImpressionRecord(None, epigram_uuid, bucket_id, date,
+                                EpigramRecord(epigram_uuid, bucket_id, self._content[x], int(self._length[x]), date))
+
+    def _write_through(self):
+        closing = False
+        while not closing:
+            try:
+                entries = [self._writes.get(timeout=self.CHECK_INTERVAL)]
+            except queue.Empty:
+                entries = []
+
+            while len(entries) < self.WRITE_BATCH:
+                try:
+                    entries.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in entries:
+                closing = True
+                entries.remove(None)
+                self._writes.task_done()
+            self._write(entries)
+
+            if not closing and self._changed():
+                self._reload()
+
+    def _write(self, entries):
+        try:
+            if entries:
+                # like FastEpigramStore, impressions don't change the cached API responses
+                retry_on_busy(lambda: write_impressions(self._conn, entries, bump_generation=False))
+                log.debug(f"Wrote {len(entries)} impressions")
+        except Exception:
+            log.exception(f"Lost {len(entries)} impressions")
+        finally:
+            for entry in entries:
+                self._writes.task_done()
+
+    def _changed(self):
+        """ Has another connection committed since the arrays were loaded.  Our own
+            commits don't move data_version """
+        (data_version, ) = self._conn.execute("pragma data_version").fetchone()
+        return data_version != self._data_version
+
+    def _reload(self):
+        with self._lock:
+            # the impressions made so far are part of what gets loaded
+            entries = []
+            while True:
+                try:
+                    entries.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            if None in entries:
+                entries.remove(None)
+                # close() is waiting, let the loop see it again
+                self._writes.put(None)
+                self._writes.task_done()
+            self._write(entries)
+
+            log.info("The database changed, reloading")
+            self._load()
@@ -0,0 +1,1082 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import random
+import concurrent.futures
+import codecs
+import hashlib
+import time
+import uuid as uuid_stdlib
+from collections import deque
+
+# from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker, relationship, declarative_base
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    Boolean,
+    ForeignKey,
+    create_engine,
+    event
+)
+from sqlalchemy.exc import OperationalError
+import datetime
+
+from fim_core import (
+    MAX_CONTENT_LENGTH,
+    BULK_BATCH_SIZE,
+    NO_RESULTS_FOUND_TEXT,
+    SQL_DIR,
+    calculate_impressions,
+    BucketSampler,
+    random_pivot,
+    impression_cutoff,
+    list_sql_files,
+    default_db_path,
+    apply_pragmas,
+    retry_on_busy,
+    generate_uuid,
+    content_hash,
+    read_fortune_file,
+    scan_fortunes,
+    list_fortune_files,
+    parse_fortune_file,
+    StrfileIndex,
+    NearDuplicateIndex,
+)
+
+""" fim_store - the SQLAlchemy side of fim: models, importers and the EpigramStore """
+
+log = logging.getLogger("fim.store")
+
+Session = sessionmaker()
+Base = declarative_base()
+
+# this is my homebrew id generator for bucket id generatio
+i = 0
+
+
+def mydefault():
+    global i
+    i += 1
+    return i
+
+
+class Bucket(Base):
+    """ Epigrams belong to a single bucket, which is used to classify content.
+
+        Buckets are categories and the primary mechanism of organization within
+        FIM.  They will typically map to a single content source (e.g. fortune
+        text file), however this is not a requirement.
+
+        Buckets are the primary mechanism used by the "Bucket Sort" algothorim.
+        See the readme for the details
+    """
+
+    __tablename__ = 'bucket'
+    bucket_id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+    item_weight = Column(Integer, default=1)
+
+    #    def __init__(self, name, **kwargs):
+    #        super()
+    #        self.name = name
+    #        self.bucket_id = mydefault()
+
+    def __str__(self):
+        return f"<Bucket bucket_id={self.bucket_id}, name={self.name}>"
+
+class Epigram(Base):
+    """ This is the basic unit of content in fim.
+
+        An epigram is a brief, interesting, memorable, and sometimes surprising
+        or satirical statement. The word is derived from the Greek: ἐπίγραμμα
+        epigramma "inscription" from ἐπιγράφειν epigraphein "to write on, to
+        inscribe", and the literary device has been employed for over two
+        millennia.
+
+        BTW 'epigram' was directly lifted from the fortune man page *shrugs*.
+
+    """
+    __tablename__ = 'epigram'
+
+    epigram_uuid = Column(
+        String, default=generate_uuid(), primary_key=True)
+    bucket = relationship("Bucket", backref="epigram")
+    bucket_id = Column(Integer, ForeignKey("bucket.bucket_id"))
+    created_date = Column(String, default=datetime.datetime.now())
+    modified_date = Column(String)
+    last_impression_date = Column(String)
+    content_source = Column(String)
+    content_text = Column(String)
+    content = Column(String)
+    # precomputed length(content), this is what the selection length filter uses
+    content_length = Column(Integer)
+    # sha1 of the content, unique so re-importing the same content is a no-op
+    content_hash = Column(String)
+    # the epigram this is a near duplicate of, see fim.NearDuplicateIndex
+    canonical_uuid = Column(String)
+    # where the content originated from, (i.e. intro blog post)
+    source_url = Column(String)
+    # used with content_type (i.e. asciicast overview)
+    action_url = Column(String)
+    context_url = Column(String)  # deep dive info link (i.e. github repo)
+    gpt_completion = Column(String)
+
+    def __init__(self, **kwargs):
+        self.epigram_uuid = generate_uuid()
+
+        if 'content' in kwargs:
+            self.content = kwargs['content']
+            if self.content is not None:
+                self.content_length = len(self.content)
+                self.content_hash = content_hash(self.content)
+
+        if 'bucket' in kwargs:
+            self.bucket = kwargs['bucket']
+            self.bucket_id = self.bucket.bucket_id
+        # if 'uuid' not in kwargs:
+
+    def __str__(self):
+        return f"<Epigram epigram_uuid={self.epigram_uuid}, " + \
+            f"bucket_id={self.bucket_id}, " + \
+            f"bucket={self.bucket}>"
+
+    @classmethod
+    def generate_uuid(cls):
+        return str(uuid_stdlib.uuid1())
+
+
+class Impression(Base):
+    """ Track the views for each epigram """
+    __tablename__ = 'impression'
+    impression_id = Column(Integer, primary_key=True)
+    bucket_id = Column(Integer, ForeignKey("bucket.bucket_id"))
+    bucket = relationship("Bucket", backref="impression")
+    epigram_uuid = Column(String, ForeignKey("epigram.epigram_uuid"))
+    epigram = relationship("Epigram", backref="impression")
+    impression_date = Column(String)
+    saved = Column(Boolean)
+    gpt_completion = Column(String)
+
+    def __init__(self, **kwargs):
+
+        if 'epigram' in kwargs:
+            self.epigram = kwargs['epigram']
+            self.epigram_uuid = self.epigram.epigram_uuid
+            self.impression_date = datetime.datetime.now()
+
+            if self.epigram.bucket is not None:
+                self.bucket = self.epigram.bucket
+                self.bucket_id = self.bucket.bucket_id
+
+    def __str__(self):
+        return f"<Impression impression_id={self.impression_id}, " + \
+            f"epigram_uuid={self.epigram_uuid}, " + \
+            f"bucket_id={self.bucket_id}, " + \
+            f"bucket={self.bucket}>"
+
+
+class ImportedFile(Base):
+    """ The import manifest, one row per file that has been imported.
+
+        This is used to skip files that haven't changed when a directory is
+        re-imported.
+    """
+    __tablename__ = 'import_manifest'
+    path = Column(String, primary_key=True)
+    size = Column(Integer)
+    mtime = Column(String)
+    checksum = Column(String)
+    imported_date = Column(String)
+
+    def __str__(self):
+        return f"<ImportedFile path={self.path}, checksum={self.checksum}>"
+
+    @classmethod
+    def checksum_file(cls, path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+class SchemaVersion(Base):
+    """ The migration ledger, one row per sql/NNN_*.sql file that has been applied """
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
+    name = Column(String)
+    applied_date = Column(String)
+
+    def __str__(self):
+        return f"<SchemaVersion version={self.version}, name={self.name}>"
+
+
+class Completion(Base):
+    """ A cached GPT explanation of an epigram.
+
+        The content hash is part of the key so an edited epigram is explained
+        again, as are the model and the prompt version.
+    """
+    __tablename__ = 'completion_cache'
+    epigram_uuid = Column(String, primary_key=True)
+    content_hash = Column(String, primary_key=True)
+    model = Column(String, primary_key=True)
+    prompt_version = Column(Integer, primary_key=True)
+    completion = Column(String)
+    created_date = Column(String)
+    last_used_date = Column(String)
+
+    def __str__(self):
+        return f"<Completion epigram_uuid={self.epigram_uuid}, model={self.model}, " + \
+            f"prompt_version={self.prompt_version}>"
+
+
+class BaseImporter():
+    """ Base class for all of the content type """
+
+    def __init__(self, uri):
+        pass
+
+    def process(self):
+        yield None
+
+    def sources(self):
+        """ The files this importer reads, these are tracked in the import manifest.
+            Importers that don't read files return an empty list.
+        """
+        return []
+
+    def process_content(self, sources=None):
+        """ Yield (bucket, content) pairs for each epigram.
+
+            This is what the bulk import path consumes, importers that can produce
+            content without building an Epigram for every row should override it.
+
+            Keyword Arguments:
+            sources (list) - only process these entries of sources()
+        """
+        for e in self.process():
+            yield e.bucket, e.content
+
+
+class FortuneFileImporter(BaseImporter):
+    """ This file handles the loading of epigram from files in the legacy
+        fortune format.  This is a simple structure with content delimited by
+        % characters on single markers.  Like:
+
+        redfish
+        %
+        bluefish
+        %
+        onefish
+        twofish
+        %
+        something else
+        %
+
+    Positional Arguments:
+    - uri (str) - the file path to the fortunes.  If this is a directory,
+                  then the entire directory will be loaded
+
+
+    Keyword Arguments:
+    - bucket (Bucket) - the bucket that this fortune file should belone to
+                          if not specified, this is the the basename of the
+                          of the file w\\o extension
+    - workers (int) - parse this many files at once in worker processes, the
+                      content is still yielded in file order
+    """
+
+    def __init__(self, uri, bucket=None, workers=1):
+        self._filenames = list_fortune_files(uri)
+        self._bucket = bucket
+        self._workers = workers
+        self._buckets = {}
+
+    def process(self):
+        for (bucket, snippet) in self.process_content():
+            yield Epigram(content=snippet, bucket=bucket)
+
+    def sources(self):
+        return list(self._filenames)
+
+    def process_content(self, sources=None):
+        if sources is None:
+            sources = self._filenames
+
+        if self._workers > 1 and len(sources) > 1:
+            parsed = self._parse_in_workers(sources)
+        else:
+            parsed = ((fname, self._parse_lazily(fname)) for fname in sources)
+
+        for (fname, snippets) in parsed:
+            bucket = None
+            if self._bucket is None:
+                bucket = self._determine_bucket(fname)
+            else:
+                bucket = self._bucket
+
+            for snippet in snippets:
+                yield bucket, snippet
+
+    @staticmethod
+    def _parse_lazily(fname):
+        """ The single process equivalent of parse_fortune_file, streamed """
+        index = StrfileIndex.for_file(fname, create=False)
+        rotated = index is not None and index.rotated
+
+        for (offset, length, snippet) in read_fortune_file(fname):
+            yield codecs.encode(snippet, "rot13") if rotated else snippet
+
+    def _parse_in_workers(self, sources):
+        """ Parse the files in a process pool, yielding (fname, snippets) in file order.
+            Only a couple of files per worker are in flight, so a slow consumer
+            (the database writer) keeps memory bounded.
+        """
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self._workers) as pool:
+            pending = deque()
+            remaining = iter(sources)
+
+            for fname in remaining:
+                pending.append((fname, pool.submit(parse_fortune_file, fname)))
+                if len(pending) >= self._workers * 2:
+                    break
+
+            while pending:
+                (fname, future) = pending.popleft()
+                for next_fname in remaining:
+                    pending.append((next_fname, pool.submit(parse_fortune_file, next_fname)))
+                    break
+                yield fname, future.result()
+
+    def _determine_bucket(self, file_name):
+        base_name = os.path.basename(file_name)
+        bucket_name = os.path.splitext(base_name)[0]
+
+        # files with the same name share a bucket, the store maps it to an existing one
+        if bucket_name not in self._buckets:
+            self._buckets[bucket_name] = Bucket(name=bucket_name)
+        return self._buckets[bucket_name]
+
+    @classmethod
+    def process_fortune_file(cls, file_contents):
+        for (offset, length, raw) in scan_fortunes(file_contents):
+            yield raw.rstrip()
+
+
+class SoloEpigramImporter(BaseImporter):
+    """ Add a single epigram """
+
+    def __init__(self, epigram):
+        self._epigram = epigram
+
+    def process(self):
+        yield self._epigram
+
+
+class EpigramStore():
+    """ This class encapsulates the internal datastore (SQLite)"""
+
+    ERROR_BUCKET = Bucket(bucket_id=123, name="error")
+    NO_RESULTS_FOUND = Epigram(content=NO_RESULTS_FOUND_TEXT, bucket_id=123)
+    GENERAL_ERROR = Epigram(content="Always bring a towel (500: General Error)", bucket_id=123)
+    SQL_DIR = SQL_DIR
+    MAX_CONTENT_LENGTH = MAX_CONTENT_LENGTH
+    BULK_BATCH_SIZE = BULK_BATCH_SIZE
+
+    def __init__(self, filename, pragmas=None):
+        """ Construct the store (connect to db, optionally retrieve all rows)
+
+            Positional Arguments:
+            filename (str) - the path to the SQLite database
+
+            Keyword Arguments:
+            pragmas (dict) - overrides for fim_core.PRAGMAS, applied to every connection
+        """
+        self._filename = filename
+        self._sampler = None
+        self._sampler_key = None
+
+        db_uri = 'sqlite:///' + self._filename
+        self._engine = create_engine(db_uri, echo=False)
+        event.listen(self._engine, "connect",
+                     lambda dbapi_connection, record: apply_pragmas(dbapi_connection, pragmas))
+        log.debug("Initializing db" + db_uri)
+        Session.configure(bind=self._engine)
+        self._session = Session()
+        self._migrate()
+
+    def _migrate(self, file_dir=SQL_DIR):
+        """ Bring the schema up to date.  A current database costs a single read of
+            the schema_version ledger, nothing is created, dropped or altered.
+
+            When files are pending the ORM tables are created, new model columns
+            are added and each pending file is executed and recorded, in order.
+            Schema changes must therefore always come with a new numbered file.
+
+            Keyword Arguments:
+            file_dir (str) - the directory holding the NNN_*.sql files
+
+            Return:
+            the list of versions that were applied
+        """
+        applied = self._applied_versions()
+        pending = [(version, fname) for (version, fname) in self._sql_files(file_dir)
+                   if version not in applied]
+        if not pending:
+            return []
+
+        log.debug(f"Applying {len(pending)} schema migrations")
+        Base.metadata.create_all(self._engine)
+        self._add_missing_columns()
+
+        ledger = SchemaVersion.__table__.insert().prefix_with("OR IGNORE")
+        for (version, fname) in pending:
+            with open(fname, 'r') as sql_text:
+                log.debug(f"Processing %s file" % (fname))
+                self._execute_sql(sql_text.read())
+
+            with self._engine.begin() as conn:
+                conn.execute(ledger, {"version": version,
+                                      "name": os.path.basename(fname),
+                                      "applied_date": datetime.datetime.now().isoformat()})
+
+        self._sync_bucket_stats()
+        return [version for (version, fname) in pending]
+
+    def _applied_versions(self):
+        with self._engine.connect() as conn:
+            exists = conn.exec_driver_sql(
+                "select 1 from sqlite_master where type = 'table' and name = 'schema_version'").first()
+            if exists is None:
+                return set()
+            return {row[0] for row in conn.exec_driver_sql("select version from schema_version")}
+
+    def _add_missing_columns(self):
+        """ create_all() doesn't alter existing tables, so add any model columns that
+            are missing from databases created by older versions """
+        added = []
+        with self._engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                existing = [row[1] for row in
+                            conn.exec_driver_sql(f"pragma table_info({table.name})")]
+                for column in table.columns:
+                    if column.name not in existing:
+                        log.info(f"Adding column {table.name}.{column.name}")
+                        column_type = column.type.compile(dialect=self._engine.dialect)
+                        conn.exec_driver_sql(
+                            f"alter table {table.name} add column {column.name} {column_type}")
+                        added.append(f"{table.name}.{column.name}")
+
+            if "epigram.content_length" in added:
+                conn.exec_driver_sql("update epigram set content_length = length(content)")
+
+            if "epigram.content_hash" in added:
+                self._backfill_content_hashes(conn)
+
+        return added
+
+    @staticmethod
+    def _backfill_content_hashes(conn):
+        """ Hash the existing epigrams.  Databases that were imported more than once
+            hold duplicates, only the oldest copy gets the hash (the unique index
+            ignores NULLs) so the rest are left alone along with their impressions.
+        """
+        seen = set()
+        updates = []
+        for (rowid, content) in conn.exec_driver_sql(
+                "select rowid, content from epigram where content is not null order by rowid").all():
+            h = content_hash(content)
+            if h not in seen:
+                seen.add(h)
+                updates.append((h, rowid))
+
+        log.info(f"Hashed {len(updates)} epigrams")
+        conn.exec_driver_sql("update epigram set content_hash = ? where rowid = ?", updates)
+
+    _sql_files = staticmethod(list_sql_files)
+
+    def _execute_sql(self, sql_text):
+        # begin() commits, connect() would roll back any rows a file inserts
+        with self._engine.begin() as conn:
+            conn.exec_driver_sql(sql_text)
+
+    def _sync_bucket_stats(self):
+        """ The bucket_stats table is kept current by triggers, but databases
+            created before it existed need a one time backfill """
+        with self._engine.connect() as conn:
+            missing = conn.exec_driver_sql("""
+            select count(1) from bucket
+             where bucket_id not in (select bucket_id from bucket_stats)
+            """).scalar()
+
+        if missing:
+            self.rebuild_bucket_stats()
+
+    def rebuild_bucket_stats(self):
+        """ Recompute bucket_stats from scratch using the same aggregation
+            as the bucket_sort view """
+        log.debug("Rebuilding bucket_stats")
+        with self._engine.begin() as conn:
+            conn.exec_driver_sql("delete from bucket_stats")
+            conn.exec_driver_sql("""
+            insert into bucket_stats (bucket_id, epigram_count, weighted_count, impression_count)
+            select b.bucket_id,
+                   ifnull(e.epigram_count, 0),
+                   ifnull(e.epigram_count * b.item_weight, 0),
+                   ifnull(i.impression_count, 0)
+              from bucket b
+                   left join (select bucket_id, count(1) as epigram_count
+                                from epigram group by bucket_id) e
+                          on b.bucket_id = e.bucket_id
+                   left join (select bucket_id, count(1) as impression_count
+                                from impression group by bucket_id) i
+                          on b.bucket_id = i.bucket_id
+            """)
+
+    def get_bucket_stats(self):
+        """
+        Retrieve the raw per bucket counters maintained in bucket_stats
+
+        :return: a list of (bucket_id, epigram_count, weighted_count, impression_count)
+        """
+        with self._engine.connect() as conn:
+            return conn.exec_driver_sql("""
+            select bucket_id, epigram_count, weighted_count, impression_count
+              from bucket_stats order by bucket_id
+            """).all()
+
+    # shared with FastEpigramStore, so both stores make the same choices
+    calculate_impressions = staticmethod(calculate_impressions)
+
+    def _get_weighted_bucket(self):
+        """
+        Pick a bucket with BucketSort(TM), see fim_core.BucketSampler.  The sampler is
+        kept between draws and add_impression counts into it, so it is only rebuilt
+        when the generation moves or impressions were recorded by someone else
+
+        :return: the bucket_id to use in the get epigram query
+        """
+        with self._engine.connect() as conn:
+            key = tuple(conn.exec_driver_sql("""
+            select generation, (select ifnull(max(impression_id), 0) from impression)
+              from store_generation
+            """).one())
+
+        if key != self._sampler_key:
+            self._sampler = BucketSampler(self.get_bucket_stats())
+            self._sampler_key = key
+        return self._sampler.choose()
+
+    def get_epigram_impression(self, uuid=None, internal_fetch_ratio=0.1, force_random=True, bucket_name=None,
+                               bucket=None, max_length=MAX_CONTENT_LENGTH):
+        """ Get a epigram considering filter criteria and weight rules
+
+            Keyword Arguments:
+            uuid (str) - return this specific epigram
+            internal_fetch_ratio (int) - see the README.adoc for info on the
+                                                  weighting algorithm
+            bucket_name (str) - the natural key for the buckets
+            bucket - a bucket object
+            max_length (int) - only epigrams shorter than this are selected,
+                               None disables the filter
+
+            Return:
+            An Epigram (obviously)
+        """
+        return retry_on_busy(
+            lambda: self._get_epigram_impression(internal_fetch_ratio, force_random, bucket_name, max_length),
+            errors=(OperationalError, ), on_retry=self._session.rollback)
+
+    def _get_epigram_impression(self, internal_fetch_ratio, force_random, bucket_name, max_length):
+        q = self._session.query(Epigram).filter(Epigram.bucket_id.isnot(None))
+
+        if max_length is not None:
+            q = q.filter(Epigram.content_length < max_length)
+
+        if bucket_name is not None:
+            bucket_ids = [b.bucket_id for b in
+                          self._session.query(Bucket).filter(Bucket.name == bucket_name)]
+            q = q.filter(Epigram.bucket_id.in_(bucket_ids))
+        else:
+            bucket = self._get_weighted_bucket()
+            if bucket is not None:
+                q = q.filter(Epigram.bucket_id == bucket)
+
+        x = self._select_epigram(q, internal_fetch_ratio, force_random)
+
+        log.debug(f"Retrieved Epigram {x}")
+        if x is None:
+            return Impression(epigram=self.NO_RESULTS_FOUND)
+        else:
+            imp = self.add_impression(x)
+            return imp
+
+    def _select_epigram(self, q, internal_fetch_ratio, force_random):
+        """ Pick the least recently shown epigram from the query, with some jitter.
+
+            Every lookup here is a keyset seek on the (bucket_id, last_impression_date,
+            epigram_uuid, content_length) index so the cost does not grow with the
+            bucket size:
+
+            * epigrams that have never been shown are sampled uniformly by seeking
+              to a random uuid and taking the next one (uuid4s are uniformly distributed)
+            * once everything has been shown, a cutoff is chosen in the oldest
+              internal_fetch_ratio slice of the bucket's impression history and the
+              first epigram at or after the cutoff is taken
+
+            Positional Arguments:
+            q - the filtered Epigram query
+            internal_fetch_ratio (float) - the fraction of the history to jitter over
+            force_random (bool) - if False, always return the least recently shown
+
+            Return:
+            An Epigram or None if the query matched nothing
+        """
+        oldest = q.order_by(Epigram.last_impression_date.asc(),
+                            Epigram.epigram_uuid.asc()).first()
+
+        if oldest is None or not force_random:
+            return oldest
+
+        if oldest.last_impression_date is None:
+            pivot = self._random_pivot()
+            log.debug(f"seeking unseen epigrams from {pivot}")
+            x = q.filter(Epigram.last_impression_date.is_(None)) \
+                .filter(Epigram.epigram_uuid >= pivot) \
+                .order_by(Epigram.last_impression_date.asc(),
+                          Epigram.epigram_uuid.asc()).first()
+            # wrap around to the smallest uuid
+            return oldest if x is None else x
+
+        newest = q.order_by(Epigram.last_impression_date.desc()).first()
+        cutoff = self._impression_cutoff(oldest.last_impression_date,
+                                         newest.last_impression_date,
+                                         internal_fetch_ratio * random.random())
+        if cutoff is None:
+            return oldest
+
+        log.debug(f"seeking epigrams shown after {cutoff}")
+        x = q.filter(Epigram.last_impression_date >= cutoff) \
+            .order_by(Epigram.last_impression_date.asc(),
+                      Epigram.epigram_uuid.asc()).first()
+        return oldest if x is None else x
+
+    _random_pivot = staticmethod(random_pivot)
+    _impression_cutoff = staticmethod(impression_cutoff)
+
+    def get_last_impression(self):
+        # not by last_impression_date, a near duplicate group shares it, see sql/073
+        q = self._session.query(Impression) \
+            .order_by(Impression.impression_date.desc(), Impression.impression_id.desc())
+        return q.first()
+
+    def _completion_key(self, epigram, model, prompt_version):
+        return {"epigram_uuid": epigram.epigram_uuid,
+                "content_hash": epigram.content_hash or content_hash(epigram.content),
+                "model": model,
+                "prompt_version": prompt_version}
+
+    def get_completion(self, epigram, model, prompt_version, ttl=None):
+        """ Look up a cached GPT explanation
+
+        Positional Arguments:
+        epigram (Epigram) - the epigram that was explained
+        model (str) - the model that explained it
+        prompt_version (int) - the version of the prompt used
+
+        Keyword Arguments:
+        ttl (float) - ignore (and drop) explanations older than this many seconds
+
+        Return:
+        the completion text, or None
+        """
+        cached = self._session.get(Completion, self._completion_key(epigram, model, prompt_version))
+        if cached is None:
+            return None
+
+        now = datetime.datetime.now()
+        if ttl is not None and cached.created_date < self._timestamp(now - datetime.timedelta(seconds=ttl)):
+            log.debug(f"Expired {cached}")
+            self._session.delete(cached)
+            self._session.commit()
+            return None
+
+        cached.last_used_date = self._timestamp(now)
+        self._session.commit()
+        return cached.completion
+
+    def save_completion(self, epigram, model, prompt_version, completion, max_entries=None):
+        """ Cache a GPT explanation, replacing any for the same key
+
+        Positional Arguments:
+        see get_completion, plus
+        completion (str) - the explanation
+
+        Keyword Arguments:
+        max_entries (int) - evict the least recently used explanations past this many
+        """
+        now = self._timestamp(datetime.datetime.now())
+        self._session.merge(Completion(completion=completion, created_date=now, last_used_date=now,
+                                       **self._completion_key(epigram, model, prompt_version)))
+
+        if max_entries is not None:
+            for evicted in self._session.query(Completion) \
+                    .order_by(Completion.last_used_date.desc()).offset(max_entries):
+                log.debug(f"Evicting {evicted}")
+                self._session.delete(evicted)
+        self._session.commit()
+
+    @staticmethod
+    def _timestamp(when):
+        return when.isoformat(sep=' ', timespec='microseconds')
+
+    def add_epigram(self, epigram):
+        """ Add an epigram to the store
+
+        Positional Arguments:
+        epigram - the epigram to add
+
+        Returns: the newly generated epigram
+
+        """
+        solo = SoloEpigramImporter(epigram)
+        self.add_epigrams_via_importer(solo)
+
+    def add_epigrams_via_importer(self, importer):
+        """ Method that does stuff
+
+            Positional Arguments:
+            content (str) - the plain text content of the epigram
+
+            Keyword Arguments:
+            uuid (str) - a unique id for the item (generated if blank)
+
+            Return:
+            object (str) - desc
+        """
+        hashes = set()
+        for e in importer.process():
+            # the epigram is already attached to its bucket, don't flush it half built
+            with self._session.no_autoflush:
+                duplicate = e.content_hash in hashes or \
+                    self._session.query(Epigram.epigram_uuid) \
+                        .filter(Epigram.content_hash == e.content_hash).first() is not None
+
+                if duplicate and e.content_hash is not None:
+                    log.debug("Skipping duplicate Epigram " + str(e))
+                    e.bucket = None
+                    continue
+
+                if e.bucket is not None and e.bucket.bucket_id is None:
+                    existing = self.get_bucket(e.bucket.name)
+                    if existing is not None:
+                        e.bucket = existing
+
+            hashes.add(e.content_hash)
+
+            log.debug("Inserting Epigram " + str(e))
+            self._session.add(e)
+
+        self._session.flush()
+        self._link_near_duplicates(self._session.connection())
+        self._session.commit()
+
+    @staticmethod
+    def _link_near_duplicates(conn):
+        """ Index the epigrams added since the index last looked and link the near
+            duplicates, in the caller's transaction """
+        duplicates = NearDuplicateIndex(conn.connection.driver_connection).catch_up()
+        if duplicates:
+            log.info(f"Linked {len(duplicates)} near duplicate epigrams")
+        return duplicates
+
+    def _link_imported(self):
+        """ Link the near duplicates among the epigrams a bulk import inserted (and any
+            an earlier import without dedupe left behind), after the import committed """
+        start = time.perf_counter()
+        conn = self._session.connection()
+        duplicates = self._link_near_duplicates(conn)
+        if duplicates:
+            # the recency of whole groups may have changed
+            self._content_changed(conn)
+        self._session.commit()
+        log.info(f"Looked for near duplicates in {time.perf_counter() - start:.2f}s")
+        return duplicates
+
+    @staticmethod
+    def _content_changed(conn):
+        """ Empty the selection queue and bump the store generation """
+        conn.exec_driver_sql("delete from selection_queue")
+        conn.exec_driver_sql("""
+            update store_generation set generation = generation + 1,
+                   modified = cast(strftime('%s', 'now') as integer)
+            """)
+
+    def bulk_add_epigrams_via_importer(self, importer, batch_size=BULK_BATCH_SIZE, force=False,
+                                       dedupe=False):
+        """ Stream the importer's content into batched executemany() inserts.
+
+            This bypasses the ORM unit of work (no Epigram objects, relationships or
+            identity map entries), so memory stays flat regardless of the import size.
+            Everything is committed in a single transaction at the end.
+
+            Imports are incremental: files whose size and mtime (or checksum) match
+            the import manifest are skipped, epigrams whose content is already in
+            the store are ignored and buckets are reused by name.
+
+            The search index is updated, the selection queue emptied and the store
+            generation bumped once at the end rather than by the per row triggers,
+            see sql/064.
+
+            Near duplicates are not looked for unless dedupe is set, then the new
+            epigrams are looked up in the near duplicate index and linked to the
+            epigram they duplicate once the import has committed.  Epigrams
+            imported without it are indexed by the next import with dedupe (the
+            command line default) or by fim dedupe.
+
+            Positional Arguments:
+            importer (BaseImporter) - the source of the content
+
+            Keyword Arguments:
+            batch_size (int) - the number of rows per executemany() call
+            force (bool) - parse every file, even if the manifest says it is unchanged
+            dedupe (bool) - link the near duplicates among the new epigrams
+
+            Return:
+            the number of epigrams inserted
+        """
+        start = time.perf_counter()
+        conn = self._session.connection()
+        insert = Epigram.__table__.insert().prefix_with("OR IGNORE")
+        bucket_ids = {}
+        batch = []
+        count = 0
+        now = datetime.datetime.now()
+        first_rowid = conn.exec_driver_sql("select ifnull(max(rowid), 0) + 1 from epigram").scalar()
+        conn.exec_driver_sql("update epigram_fts_sync set deferred = 1")
+
+        sources = importer.sources()
+        if sources:
+            sources = self._update_import_manifest(sources, force=force)
+            log.info(f"Importing {len(sources)} changed files")
+        else:
+            sources = None
+
+        for (bucket, content) in importer.process_content(sources):
+            if bucket not in bucket_ids:
+                bucket_ids[bucket] = self._insert_bucket(conn, bucket)
+
+            batch.append({
+                "epigram_uuid": generate_uuid(),
+                "bucket_id": bucket_ids[bucket],
+                "created_date": now,
+                "content": content,
+                "content_length": len(content),
+                "content_hash": content_hash(content),
+            })
+
+            if len(batch) >= batch_size:
+                count += conn.execute(insert, batch).rowcount
+                batch = []
+
+        if batch:
+            count += conn.execute(insert, batch).rowcount
+
+        conn.exec_driver_sql("""
+            insert into epigram_fts (rowid, content) select rowid, content from epigram where rowid >= ?
+            """, (first_rowid, ))
+        if count:
+            # what the per row insert triggers do, once for the whole import, see sql/075 and sql/077
+            self._content_changed(conn)
+        conn.exec_driver_sql("update epigram_fts_sync set deferred = 0")
+        self._session.commit()
+
+        elapsed = time.perf_counter() - start
+        log.info(f"Imported {count} epigrams in {elapsed:.2f}s "
+                 f"({count / elapsed if elapsed else 0:.0f} rows/s)")
+
+        if dedupe:
+            self._link_imported()
+        return count
+
+    def _update_import_manifest(self, sources, force=False):
+        """ Compare the files against the import manifest and record their current state.
+            The manifest rows are committed along with the imported epigrams.
+
+            Positional Arguments:
+            sources (list) - the file paths to check
+
+            Keyword Arguments:
+            force (bool) - treat every file as changed
+
+            Return:
+            the list of files that need to be imported
+        """
+        changed = []
+        for path in sources:
+            stat = os.stat(path)
+            mtime = str(stat.st_mtime_ns)
+            entry = self._session.get(ImportedFile, path)
+
+            if not force and entry is not None \
+                    and entry.size == stat.st_size and entry.mtime == mtime:
+                log.debug(f"Skipping unchanged file {path}")
+                continue
+
+            checksum = ImportedFile.checksum_file(path)
+            if entry is None:
+                entry = ImportedFile(path=path)
+                self._session.add(entry)
+            elif not force and entry.checksum == checksum:
+                log.debug(f"Skipping touched but unchanged file {path}")
+                checksum = None
+
+            if checksum is not None:
+                changed.append(path)
+                entry.checksum = checksum
+                entry.imported_date = datetime.datetime.now()
+
+            entry.size = stat.st_size
+            entry.mtime = mtime
+
+        return changed
+
+    @staticmethod
+    def _insert_bucket(conn, bucket):
+        """ Persist a transient bucket with Core and return its bucket_id.  A
+            bucket with the same name is reused if one exists """
+        if bucket is None:
+            return None
+
+        item_weight = 1 if bucket.item_weight is None else bucket.item_weight
+
+        if bucket.bucket_id is None:
+            bucket.bucket_id = conn.execute(
+                Bucket.__table__.select().with_only_columns(Bucket.bucket_id)
+                .where(Bucket.name == bucket.name).order_by(Bucket.bucket_id).limit(1)).scalar()
+
+        if bucket.bucket_id is not None:
+            conn.execute(Bucket.__table__.insert().prefix_with("OR IGNORE"),
+                         {"bucket_id": bucket.bucket_id, "name": bucket.name,
+                          "item_weight": item_weight})
+        else:
+            result = conn.execute(Bucket.__table__.insert(),
+                                  {"name": bucket.name, "item_weight": item_weight})
+            bucket.bucket_id = result.inserted_primary_key[0]
+
+        return bucket.bucket_id
+
+    def add_impression(self, epigram):
+        """ Add the impression for the epigram
+
+            Positional Arguments:
+            epigram (Epigram) - the epigram viewed
+        """
+        imp = Impression(epigram=epigram)
+        log.debug(f"Impression tracked - {imp}")
+        epigram.last_impression_date = datetime.datetime.now()
+        self._session.add(imp)
+        self._session.flush()
+        self._count_impression(imp.bucket_id, imp.impression_id)
+        self._session.commit()
+        return imp
+
+    def _count_impression(self, bucket_id, impression_id):
+        """ Count an impression in the sampler, or drop the sampler if anything else
+            was recorded since it last counted """
+        if self._sampler is None:
+            return
+
+        (generation, last_id) = self._sampler_key
+        if impression_id != last_id + 1:
+            self._sampler = self._sampler_key = None
+            return
+        if bucket_id in self._sampler:
+            self._sampler.add_impression(bucket_id)
+        self._sampler_key = (generation, impression_id)
+
+    def get_impression_count(self, bucket_name=None, unique=False):
+        """
+        This function will retrieve a count of the impressions.  By default,
+        it will return the number of all impressions.  You can filter via
+        these keyword arguments:
+
+        * epigram_uuid (not implemented)
+        * bucket_name (str) - constrain to a single bucket
+        * unique (bool) - only count unique impressions
+        """
+
+        q = self._session.query(Impression).join(Bucket)
+
+        if bucket_name is not None:
+            q = q.filter(Bucket.name == bucket_name)
+
+        return q.count()
+
+    def get_epigram(self, epigram_uuid):
+        """ Retrieve the Epigram with this uuid, or None """
+        return self._session.get(Epigram, epigram_uuid)
+
+    def get_bucket(self, bucket_name):
+        """
+        Retrieve the Bucket specified by the name
+
+        :return: a Bucket object
+        """
+        return self._session.query(Bucket).filter(Bucket.name == bucket_name).first()
+
+    def get_buckets(self):
+        """
+        Retrieve all the Buckets in the system
+        """
+        return self._session.query(Bucket).all()
+
+    def commit(self):
+        return self._session.commit()
+
+    def close(self):
+        self._session.close()
+        self._engine.dispose()
+
+
+class FIM():
+    _db = None
+
+    """ This class """
+    pass
+
+    def __init__(self, pragmas=None, **kwargs):
+        self._load_db(pragmas)
+
+    def _load_db(self, pragmas=None):
+        self._db = EpigramStore(default_db_path(), pragmas=pragmas)
+
+    def import_fortune(self, path, batch_size=EpigramStore.BULK_BATCH_SIZE, force=False, workers=1,
+                       dedupe=True):
+        return self._db.bulk_add_epigrams_via_importer(
+            FortuneFileImporter(path, workers=workers), batch_size=batch_size, force=force, dedupe=dedupe)
+
+    def get_epigram_impression(self, bucket_name, max_length=EpigramStore.MAX_CONTENT_LENGTH):
+        return self._db.get_epigram_impression(bucket_name=bucket_name, max_length=max_length)
+
+    def get_last_impression(self):
+        return self._db.get_last_impression()
+
+    @property
+    def db(self):
+        return self._db
+
+    def save_gpt_output(self, impression: Impression, output):
+        impression.gpt_completion = output
+        self.commit_db()
+
+    def commit_db(self):
+        self._db.commit()
+
+
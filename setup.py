@@ -3,7 +3,7 @@ from distutils.core import setup
 setup(
     name='FIM',
     version='0.1.0',
-    packages=['fim',],
+    py_modules=['fim', 'fim_core', 'fim_store', 'fim_engine'],
     license='APL',
     long_description=open('README.adoc').read(),
 )
@@ -0,0 +1,9 @@
+-- incrementally maintained replacement for the bucket_sort / total_counts aggregation.
+-- the triggers in 031 - 039 keep this in sync with the bucket, epigram and impression tables
+create table if not exists bucket_stats
+(
+    bucket_id        integer not null primary key references bucket (bucket_id),
+    epigram_count    integer not null default 0,
+    weighted_count   integer not null default 0,
+    impression_count integer not null default 0
+);
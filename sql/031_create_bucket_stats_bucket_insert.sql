@@ -0,0 +1,11 @@
+create trigger if not exists bucket_stats_bucket_insert
+    after insert
+    on bucket
+begin
+    insert or replace into bucket_stats (bucket_id, epigram_count, weighted_count, impression_count)
+    select new.bucket_id,
+           e.epigram_count,
+           e.epigram_count * ifnull(new.item_weight, 0),
+           (select count(1) from impression i where i.bucket_id = new.bucket_id)
+    from (select count(1) as epigram_count from epigram where bucket_id = new.bucket_id) e;
+end;
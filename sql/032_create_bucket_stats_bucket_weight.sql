@@ -0,0 +1,8 @@
+create trigger if not exists bucket_stats_bucket_weight
+    after update of item_weight
+    on bucket
+begin
+    update bucket_stats
+    set weighted_count = epigram_count * ifnull(new.item_weight, 0)
+    where bucket_id = new.bucket_id;
+end;
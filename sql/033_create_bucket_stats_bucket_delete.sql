@@ -0,0 +1,6 @@
+create trigger if not exists bucket_stats_bucket_delete
+    after delete
+    on bucket
+begin
+    delete from bucket_stats where bucket_id = old.bucket_id;
+end;
@@ -0,0 +1,11 @@
+create trigger if not exists bucket_stats_epigram_delete
+    after delete
+    on epigram
+    when old.bucket_id is not null
+begin
+    update bucket_stats
+    set epigram_count  = epigram_count - 1,
+        weighted_count = (epigram_count - 1) *
+                         ifnull((select item_weight from bucket where bucket_id = old.bucket_id), 0)
+    where bucket_id = old.bucket_id;
+end;
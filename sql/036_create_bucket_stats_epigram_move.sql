@@ -0,0 +1,17 @@
+create trigger if not exists bucket_stats_epigram_move
+    after update of bucket_id
+    on epigram
+    when old.bucket_id is not new.bucket_id
+begin
+    update bucket_stats
+    set epigram_count  = epigram_count - 1,
+        weighted_count = (epigram_count - 1) *
+                         ifnull((select item_weight from bucket where bucket_id = old.bucket_id), 0)
+    where bucket_id = old.bucket_id;
+
+    update bucket_stats
+    set epigram_count  = epigram_count + 1,
+        weighted_count = (epigram_count + 1) *
+                         ifnull((select item_weight from bucket where bucket_id = new.bucket_id), 0)
+    where bucket_id = new.bucket_id;
+end;
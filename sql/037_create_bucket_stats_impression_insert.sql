@@ -0,0 +1,9 @@
+create trigger if not exists bucket_stats_impression_insert
+    after insert
+    on impression
+    when new.bucket_id is not null
+begin
+    update bucket_stats
+    set impression_count = impression_count + 1
+    where bucket_id = new.bucket_id;
+end;
@@ -0,0 +1,9 @@
+create trigger if not exists bucket_stats_impression_delete
+    after delete
+    on impression
+    when old.bucket_id is not null
+begin
+    update bucket_stats
+    set impression_count = impression_count - 1
+    where bucket_id = old.bucket_id;
+end;
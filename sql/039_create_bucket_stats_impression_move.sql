@@ -0,0 +1,8 @@
+create trigger if not exists bucket_stats_impression_move
+    after update of bucket_id
+    on impression
+    when old.bucket_id is not new.bucket_id
+begin
+    update bucket_stats set impression_count = impression_count - 1 where bucket_id = old.bucket_id;
+    update bucket_stats set impression_count = impression_count + 1 where bucket_id = new.bucket_id;
+end;
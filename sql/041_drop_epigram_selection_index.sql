@@ -0,0 +1,2 @@
+-- superseded by ix_epigram_recency, which also covers content_length
+drop index if exists ix_epigram_selection;
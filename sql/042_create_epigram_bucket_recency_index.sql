@@ -0,0 +1,3 @@
+-- keyset index for selecting the least recently shown epigram in a bucket.  content_length
+-- is carried in the index so the length filter is checked without visiting the table
+create index if not exists ix_epigram_bucket_recency on epigram (bucket_id, last_impression_date, epigram_uuid, content_length);
@@ -0,0 +1,2 @@
+-- keyset index for selecting the least recently shown epigram without a bucket filter
+create index if not exists ix_epigram_recency on epigram (last_impression_date, epigram_uuid, content_length);
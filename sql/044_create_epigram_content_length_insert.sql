@@ -0,0 +1,8 @@
+-- the importers fill in content_length, this catches rows written by anything else
+create trigger if not exists epigram_content_length_insert
+    after insert
+    on epigram
+    when new.content_length is null and new.content is not null
+begin
+    update epigram set content_length = length(new.content) where rowid = new.rowid;
+end;
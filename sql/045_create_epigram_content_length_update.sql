@@ -0,0 +1,6 @@
+create trigger if not exists epigram_content_length_update
+    after update of content
+    on epigram
+begin
+    update epigram set content_length = length(new.content) where rowid = new.rowid;
+end;
@@ -0,0 +1,2 @@
+-- epigrams are deduplicated by content, inserts of known content are ignored
+create unique index if not exists ux_epigram_content_hash on epigram (content_hash) where content_hash is not null;
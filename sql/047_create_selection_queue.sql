@@ -0,0 +1,13 @@
+-- the next selections, precomputed in bulk by FastEpigramStore so an invocation is a single pop.
+-- a row is only valid while the total impression count is impression_total, so any impression
+-- recorded outside the queue makes the rest of it stale.  the triggers in 048 - 053 empty it
+-- whenever the buckets, their weights or the content change
+create table if not exists selection_queue
+(
+    position              integer not null primary key,
+    epigram_uuid          text    not null,
+    max_length            integer,
+    internal_fetch_ratio  real    not null,
+    force_random          integer not null,
+    impression_total      integer not null
+);
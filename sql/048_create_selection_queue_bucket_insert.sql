@@ -0,0 +1,6 @@
+create trigger if not exists selection_queue_bucket_insert
+    after insert
+    on bucket
+begin
+    delete from selection_queue;
+end;
@@ -0,0 +1,6 @@
+create trigger if not exists selection_queue_bucket_weight
+    after update of item_weight
+    on bucket
+begin
+    delete from selection_queue;
+end;
@@ -0,0 +1,6 @@
+create trigger if not exists selection_queue_epigram_insert
+    after insert
+    on epigram
+begin
+    delete from selection_queue;
+end;
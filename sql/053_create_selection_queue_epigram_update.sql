@@ -0,0 +1,6 @@
+create trigger if not exists selection_queue_epigram_update
+    after update of bucket_id, content, content_length
+    on epigram
+begin
+    delete from selection_queue;
+end;
@@ -0,0 +1,9 @@
+-- a single row counting changes to the content: buckets, their weights and the epigrams.
+-- the triggers in 056 - 061 bump it, and so does compacting the impression journal.
+-- read only resources are cached against it, modified is when it last moved in unix seconds
+create table if not exists store_generation
+(
+    id          integer not null primary key check (id = 1),
+    generation  integer not null,
+    modified    integer not null
+);
@@ -0,0 +1,2 @@
+insert or ignore into store_generation (id, generation, modified)
+values (1, 1, cast(strftime('%s', 'now') as integer));
@@ -0,0 +1,6 @@
+create trigger if not exists store_generation_bucket_update
+    after update of name, item_weight
+    on bucket
+begin
+    update store_generation set generation = generation + 1, modified = cast(strftime('%s', 'now') as integer);
+end;
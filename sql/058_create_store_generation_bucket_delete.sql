@@ -0,0 +1,6 @@
+create trigger if not exists store_generation_bucket_delete
+    after delete
+    on bucket
+begin
+    update store_generation set generation = generation + 1, modified = cast(strftime('%s', 'now') as integer);
+end;
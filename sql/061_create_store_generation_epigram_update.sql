@@ -0,0 +1,6 @@
+create trigger if not exists store_generation_epigram_update
+    after update of bucket_id, content, content_length
+    on epigram
+begin
+    update store_generation set generation = generation + 1, modified = cast(strftime('%s', 'now') as integer);
+end;
@@ -0,0 +1,2 @@
+-- the completion_cache table is created from the Completion model, this orders its evictions
+create index if not exists completion_cache_last_used on completion_cache (last_used_date);
@@ -0,0 +1,9 @@
+-- full text index of epigram.content for fim search.  it is an external content table, the text
+-- lives only in epigram and the index refers to it by rowid.  the triggers in 066 - 068 keep it
+-- in sync with every import path.  VACUUM may renumber epigram rowids, run fim search --rebuild after one
+create virtual table if not exists epigram_fts using fts5
+(
+    content,
+    content = 'epigram',
+    tokenize = 'porter unicode61'
+);
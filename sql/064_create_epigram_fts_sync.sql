@@ -0,0 +1,8 @@
+-- a bulk import sets deferred inside its transaction, skipping the per row insert trigger, and
+-- indexes everything it inserted in one statement before committing.  no other connection ever
+-- sees it set
+create table if not exists epigram_fts_sync
+(
+    id        integer not null primary key check (id = 1),
+    deferred  integer not null
+);
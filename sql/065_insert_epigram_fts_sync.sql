@@ -0,0 +1 @@
+insert or ignore into epigram_fts_sync (id, deferred) values (1, 0);
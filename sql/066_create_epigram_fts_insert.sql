@@ -0,0 +1,7 @@
+create trigger if not exists epigram_fts_insert
+    after insert
+    on epigram
+    when (select deferred from epigram_fts_sync) = 0
+begin
+    insert into epigram_fts (rowid, content) values (new.rowid, new.content);
+end;
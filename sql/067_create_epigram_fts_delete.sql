@@ -0,0 +1,6 @@
+create trigger if not exists epigram_fts_delete
+    after delete
+    on epigram
+begin
+    insert into epigram_fts (epigram_fts, rowid, content) values ('delete', old.rowid, old.content);
+end;
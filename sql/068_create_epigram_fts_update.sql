@@ -0,0 +1,7 @@
+create trigger if not exists epigram_fts_update
+    after update of content
+    on epigram
+begin
+    insert into epigram_fts (epigram_fts, rowid, content) values ('delete', old.rowid, old.content);
+    insert into epigram_fts (rowid, content) values (new.rowid, new.content);
+end;
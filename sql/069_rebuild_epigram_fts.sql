@@ -0,0 +1,2 @@
+-- index the epigrams imported before 063
+insert into epigram_fts (epigram_fts) values ('rebuild');
@@ -0,0 +1,8 @@
+-- the MinHash band keys of the canonical epigrams, see fim.NearDuplicateIndex.  near duplicates
+-- are linked through epigram.canonical_uuid instead.  the importers add the epigrams they insert,
+-- databases created before this file are indexed by fim dedupe
+create table if not exists epigram_lsh
+(
+    band_key      integer not null,
+    epigram_uuid  text    not null
+);
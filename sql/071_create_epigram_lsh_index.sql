@@ -0,0 +1 @@
+create index if not exists ix_epigram_lsh on epigram_lsh (band_key, epigram_uuid);
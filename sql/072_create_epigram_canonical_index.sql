@@ -0,0 +1,2 @@
+-- finds the near duplicates of an epigram, only the duplicates have a canonical_uuid
+create index if not exists ix_epigram_canonical on epigram (canonical_uuid) where canonical_uuid is not null;
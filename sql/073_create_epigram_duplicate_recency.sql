@@ -0,0 +1,14 @@
+-- a near duplicate group shares one recency: showing any member marks the rest as seen, so the
+-- selection passes over them like any other recently shown epigram
+create trigger if not exists epigram_duplicate_recency
+    after update of last_impression_date
+    on epigram
+    when new.last_impression_date is not null
+     and (new.canonical_uuid is not null
+          or exists (select 1 from epigram where canonical_uuid = new.epigram_uuid))
+begin
+    update epigram set last_impression_date = new.last_impression_date
+     where (epigram_uuid = new.canonical_uuid or canonical_uuid = ifnull(new.canonical_uuid, new.epigram_uuid))
+       and epigram_uuid != new.epigram_uuid
+       and last_impression_date is not new.last_impression_date;
+end;
@@ -0,0 +1 @@
+drop trigger if exists selection_queue_epigram_insert;
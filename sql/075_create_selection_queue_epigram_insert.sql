@@ -0,0 +1,9 @@
+-- 051 emptied the queue once per inserted row.  a bulk import sets epigram_fts_sync.deferred
+-- (see 064) and empties it once itself, so this only fires for the unit of work inserts
+create trigger if not exists selection_queue_epigram_insert
+    after insert
+    on epigram
+    when (select deferred from epigram_fts_sync) = 0
+begin
+    delete from selection_queue;
+end;
@@ -0,0 +1 @@
+drop trigger if exists store_generation_epigram_insert;
@@ -0,0 +1,9 @@
+-- 059 bumped the generation once per inserted row.  a bulk import sets epigram_fts_sync.deferred
+-- (see 064) and bumps it once itself, so this only fires for the unit of work inserts
+create trigger if not exists store_generation_epigram_insert
+    after insert
+    on epigram
+    when (select deferred from epigram_fts_sync) = 0
+begin
+    update store_generation set generation = generation + 1, modified = cast(strftime('%s', 'now') as integer);
+end;
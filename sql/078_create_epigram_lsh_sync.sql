@@ -0,0 +1,8 @@
+-- the highest epigram rowid the near duplicate index has looked at.  a bulk import without
+-- dedupe leaves it behind, the next import that links (or fim dedupe) catches up from here.
+-- databases created before this file are taken as indexed, fim dedupe indexes the rest
+create table if not exists epigram_lsh_sync
+(
+    id             integer not null primary key check (id = 1),
+    indexed_rowid  integer not null
+);
@@ -0,0 +1 @@
+insert or ignore into epigram_lsh_sync (id, indexed_rowid) values (1, (select ifnull(max(rowid), 0) from epigram));